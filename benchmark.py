@@ -0,0 +1,131 @@
+import os
+import copy
+import json
+import time
+import asyncio
+import argparse
+from pathlib import Path
+from logger_setup import logger
+
+from main import resolve_table_configs, run_batch
+from modules.llm_cassette import REPLAY_MODE, RECORDED_LATENCY, NO_LATENCY
+
+# The stages of the table pipeline, in the order they run, see main.run_table_pipeline.
+# The SQL is streamed to the file while it is generated, so "sql_generation" includes the write
+STAGES = ["load_schema", "setup", "table_description", "enrichment", "save_schema", "sql_generation"]
+
+
+#  ---------------------------------------------------------------------------
+# This function prepares the configuration of a table for a benchmark run
+#  ---------------------------------------------------------------------------
+def prepare_benchmark_config(yaml_source_path, config_data, output_dir):
+    """
+    Returns a copy of the configuration of a table, writing its outputs to the benchmark
+    directory. The description cache, incremental mode and the journal are disabled, so
+    every LLM call of the pipeline is served from the cassette.
+
+    :param yaml_source_path: The location of the YAML file, or the label of the table.
+    :param config_data: The YAML configuration of the table.
+    :param output_dir: The directory receiving the output schema and SQL files.
+    :return: The benchmark configuration of the table
+    """
+    config_data = copy.deepcopy(config_data)
+    name = Path(str(yaml_source_path)).stem
+
+    config_data['files']['output_schema'] = os.path.join(output_dir, f"{name}_enriched.json")
+    config_data['files']['sql_output'] = os.path.join(output_dir, f"{name}.sql")
+    config_data['cache'] = dict(config_data.get('cache') or {}, enabled=False)
+    config_data['enrichment'] = dict(config_data.get('enrichment') or {}, incremental=False, checkpoint=False)
+
+    return config_data
+
+
+
+#  ---------------------------------------------------------------------------
+# This function sums up the stage timings of all tables of all repetitions
+#  ---------------------------------------------------------------------------
+def build_report(runs):
+    """
+    Builds the benchmark report from the summaries of every repetition.
+
+    :param runs: A list of (wall_seconds, summaries) tuples, one per repetition.
+    :return: A dictionary with the wall time and the summed stage times of every repetition
+    """
+    report = {"runs": []}
+    for wall_seconds, summaries in runs:
+        stage_seconds = {stage: 0.0 for stage in STAGES}
+        for summary in summaries:
+            for stage, seconds in summary.get("stage_seconds", {}).items():
+                stage_seconds[stage] = round(stage_seconds.get(stage, 0.0) + seconds, 3)
+
+        report["runs"].append({
+            "wall_seconds":   round(wall_seconds, 3),
+            "tables":         len(summaries),
+            "failed":         sum(summary["status"] != "succeeded" for summary in summaries),
+            "llm_calls":      sum(summary.get("llm_calls", 0) for summary in summaries),
+            "stage_seconds":  stage_seconds,
+            "tables_summary": summaries,
+        })
+
+    return report
+
+
+
+def main():
+    """
+    Benchmarks the complete pipeline against a recorded cassette of LLM calls (record one
+    with `main.py --cassette <file> --cassette-mode record`). The same real model outputs
+    are replayed for every run, so changes to chunking, parsing and SQL generation can be
+    compared without calling the model. Reports the wall time of every pipeline stage.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline against a recorded LLM cassette.")
+    parser.add_argument('--yaml', type=str, help='The location of the YAML file')
+    table_group = parser.add_mutually_exclusive_group()
+    table_group.add_argument('--manifest', type=str, help='A YAML manifest with a "tables" list of YAML files')
+    table_group.add_argument('--yaml-glob', type=str, help='A glob pattern matching the YAML files to process')
+    parser.add_argument('--cassette', type=str, required=True, help='The cassette file to replay the LLM calls from')
+    parser.add_argument('--replay-latency', choices=[RECORDED_LATENCY, NO_LATENCY], default=NO_LATENCY,
+                        help='Replay the responses with the recorded latency, or immediately')
+    parser.add_argument('--table-concurrency', type=int, default=4, help='The number of tables processed at the same time')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of benchmark runs')
+    parser.add_argument('--output-dir', type=str, default='benchmark', help='The directory receiving the outputs')
+    parser.add_argument('--report', type=str, default='benchmark_report.json', help='The location of the JSON report')
+
+    args = parser.parse_args()
+    if not (args.yaml or args.manifest or args.yaml_glob):
+        parser.error("--yaml, --manifest or --yaml-glob is required")
+    args.dataset = None
+
+    configs = resolve_table_configs(args)
+    if not configs:
+        logger.error("Failed to load YAML configuration.")
+        return
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    configs = [(path, prepare_benchmark_config(path, config_data, args.output_dir)) for path, config_data in configs]
+    cassette_settings = {"path": args.cassette, "mode": REPLAY_MODE, "latency": args.replay_latency}
+
+    runs = []
+    for run_number in range(max(1, args.repeat)):
+        start_time = time.perf_counter()
+        summaries = asyncio.run(run_batch(configs, args.table_concurrency, cassette_settings))
+        runs.append((time.perf_counter() - start_time, summaries))
+
+    report = build_report(runs)
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    # Print the stage timings of every run side by side
+    print(f"{'stage':<20}" + "".join(f"{'run ' + str(i + 1):>12}" for i in range(len(report['runs']))))
+    for stage in STAGES:
+        print(f"{stage:<20}" + "".join(f"{run['stage_seconds'].get(stage, 0.0):>12.3f}" for run in report['runs']))
+    print(f"{'wall time':<20}" + "".join(f"{run['wall_seconds']:>12.3f}" for run in report['runs']))
+    print(f"{'failed tables':<20}" + "".join(f"{run['failed']:>12}" for run in report['runs']))
+
+    logger.info(f"Benchmark report saved to: '{args.report}'")
+
+
+
+# Execute the script
+if __name__ == "__main__":
+    main()
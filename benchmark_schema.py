@@ -0,0 +1,227 @@
+import io
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+from logger_setup import logger
+
+from modules.FHIResourceManager import FHIRResourceManager
+from modules.BigQuerySchemaManager import BigQuerySchemaManager
+from modules.create_table_sql import process_fields
+from modules.schema_ir import SchemaIR
+from modules.schema_paths import extract_enrichments, merge_enrichments
+from modules.tokenizer import count_tokens
+from modules.synthetic_schema import SCHEMA_PRESETS, generate_schema, count_fields
+
+# The default location of the stored baselines
+DEFAULT_BASELINE_PATH = os.path.join("benchmarks", "schema_baselines.json")
+
+# A stage regresses when it is this much slower, or uses this much more memory, than the baseline
+DEFAULT_TOLERANCE = 1.5
+
+# Stages faster than this are too noisy to compare with the baseline
+MIN_COMPARED_SECONDS = 0.005
+
+
+#  ---------------------------------------------------------------------------
+# This function builds the stages of the benchmark, every stage is a function
+# receiving a fresh copy of its input
+#  ---------------------------------------------------------------------------
+def build_stages(schema, work_dir):
+    """
+    Returns the benchmark stages as a list of (name, prepare, run) tuples. `prepare`
+    builds the input of a stage outside of the measurement, `run` is measured.
+
+    :param schema: The synthetic schema.
+    :param work_dir: A scratch directory for the JSON files.
+    :return: The list of stages
+    """
+    fhir_mgr = FHIRResourceManager(None, "benchmark.synthetic.fhir_encounters")
+    bq_manager = BigQuerySchemaManager.__new__(BigQuerySchemaManager)
+    schema_path = os.path.join(work_dir, "schema.json")
+    enrichments = extract_enrichments(schema)
+
+    def bigquery_fields():
+        from google.cloud import bigquery
+        return [bigquery.SchemaField.from_api_repr(field) for field in copy.deepcopy(schema)]
+
+    def save_json(fields):
+        with open(schema_path, "w", encoding="utf-8") as f:
+            json.dump(fields, f, indent=2)
+
+    def load_json(_):
+        with open(schema_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def filter_empty_structs(fields):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return fhir_mgr.filter_empty_structs(fields)
+
+    cleaned = filter_empty_structs(copy.deepcopy(schema))
+
+    return [
+        ("json_save",            lambda: schema,                  save_json),
+        ("json_load",            lambda: save_json(schema),       load_json),
+        ("token_counting",       lambda: json.dumps(schema),      count_tokens),
+        ("compile_schema_ir",    lambda: schema,                  SchemaIR.from_fields),
+        ("merge_enrichments",    lambda: schema,                  lambda fields: merge_enrichments(fields, enrichments)),
+        ("filter_empty_structs", lambda: copy.deepcopy(schema),   filter_empty_structs),
+        ("create_table_sql",     lambda: cleaned,                 fhir_mgr.generate_create_table_sql),
+        ("alter_table_sql",      lambda: cleaned,                 fhir_mgr.generate_alter_table_sql),
+        ("process_fields",       lambda: cleaned,                 process_fields),
+        ("bq_process_fields",    bigquery_fields,                 bq_manager._process_schema_fields),
+    ]
+
+
+
+#  ---------------------------------------------------------------------------
+# This function measures the wall time and peak memory of every stage
+#  ---------------------------------------------------------------------------
+def run_stages(stages, repeat):
+    """
+    Runs every stage `repeat` times and keeps the fastest time, then runs it once
+    more under tracemalloc to measure its peak memory.
+
+    :param stages: The list of (name, prepare, run) tuples, see build_stages.
+    :param repeat: The number of timed runs of every stage.
+    :return: A dictionary with the "seconds" and "peak_mb" of every stage
+    """
+    results = {}
+    for name, prepare, run in stages:
+        try:
+            timings = []
+            for _ in range(max(1, repeat)):
+                stage_input = prepare()
+                start_time = time.perf_counter()
+                run(stage_input)
+                timings.append(time.perf_counter() - start_time)
+
+            stage_input = prepare()
+            tracemalloc.start()
+            run(stage_input)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            results[name] = {"seconds": round(min(timings), 4), "peak_mb": round(peak / (1024 * 1024), 2)}
+
+        except ImportError as e:
+            logger.warning(f"Skipping stage '{name}': {e}")
+
+        finally:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    return results
+
+
+
+#  ---------------------------------------------------------------------------
+# This function compares the results with the stored baseline
+#  ---------------------------------------------------------------------------
+def find_regressions(results, baseline, tolerance):
+    """
+    Returns the stages which are slower, or use more memory, than the baseline allows.
+
+    :param results: The results of this run, see run_stages.
+    :param baseline: The stored results of the same schema shape.
+    :param tolerance: The allowed ratio between the result and the baseline.
+    :return: A list of human readable regression messages
+    """
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if not reference:
+            continue
+
+        if reference["seconds"] >= MIN_COMPARED_SECONDS and result["seconds"] > reference["seconds"] * tolerance:
+            regressions.append(f"{name}: {result['seconds']}s, baseline {reference['seconds']}s")
+        if reference["peak_mb"] > 0 and result["peak_mb"] > reference["peak_mb"] * tolerance:
+            regressions.append(f"{name}: {result['peak_mb']} MB, baseline {reference['peak_mb']} MB")
+
+    return regressions
+
+
+
+def main():
+    """
+    Benchmarks the CPU-side stages of the pipeline (JSON load and save, token counting,
+    merging descriptions, and SQL generation) on synthetic FHIR-like schemas.
+
+    The results are compared with the baselines stored for the same schema shape, a
+    regression makes the command exit with status 1. Use --save-baseline to store the
+    results of this run as the new baseline.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the CPU-side pipeline on synthetic schemas.")
+    parser.add_argument('--preset', choices=sorted(SCHEMA_PRESETS), default='large', help='The shape of the schema')
+    parser.add_argument('--width', type=int, help='The number of top-level fields')
+    parser.add_argument('--depth', type=int, help='The nesting depth of the RECORD fields')
+    parser.add_argument('--fanout', type=int, help='The number of subfields of every RECORD')
+    parser.add_argument('--record-ratio', type=float, help='The fraction of top-level fields that are RECORDs')
+    parser.add_argument('--description-length', type=int, help='The number of characters of every description')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the schema generator')
+    parser.add_argument('--repeat', type=int, default=5, help='The number of timed runs of every stage')
+    parser.add_argument('--baseline', type=str, default=DEFAULT_BASELINE_PATH, help='The location of the baselines')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='The allowed slowdown ratio')
+    args = parser.parse_args()
+
+    # The preset provides the defaults, the command line arguments override them
+    shape = dict(SCHEMA_PRESETS[args.preset])
+    for key in shape:
+        if getattr(args, key) is not None:
+            shape[key] = getattr(args, key)
+    shape["seed"] = args.seed
+
+    schema = generate_schema(**shape)
+    leaves, depth = count_fields(schema)
+    shape_key = ",".join(f"{key}={value}" for key, value in sorted(shape.items()))
+    print(f"Synthetic schema: {leaves} leaf fields, depth {depth} ({shape_key})")
+
+    # The recursive stages descend once per nesting level
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 100 * depth))
+
+    # The SQL generation logs every call, keep the benchmark output readable
+    logger.disabled = True
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run_stages(build_stages(schema, work_dir), args.repeat)
+    finally:
+        logger.disabled = False
+
+    baselines = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baselines = json.load(f)
+    baseline = baselines.get(shape_key, {})
+
+    print(f"{'stage':<22}{'seconds':>10}{'baseline':>10}{'peak MB':>10}{'baseline':>10}")
+    for name, result in results.items():
+        reference = baseline.get(name, {})
+        print(f"{name:<22}{result['seconds']:>10.4f}{reference.get('seconds', float('nan')):>10.4f}"
+              f"{result['peak_mb']:>10.2f}{reference.get('peak_mb', float('nan')):>10.2f}")
+
+    if args.save_baseline:
+        baselines[shape_key] = results
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to: '{args.baseline}'")
+        return
+
+    regressions = find_regressions(results, baseline, args.tolerance)
+    if regressions:
+        print("Regressions compared with the baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+
+
+# Execute the script
+if __name__ == "__main__":
+    main()
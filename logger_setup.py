@@ -73,6 +73,24 @@ class HCALogger(logging.Logger):
 
 # The decorator to handle logging entry, exit, and indentation
 def log_entry_exit(func):
+    # Coroutine functions need an async wrapper, otherwise we would log the
+    # exit as soon as the coroutine object is created instead of when it completes.
+    # Because the depth is kept in a context variable, every asyncio task gets
+    # its own indentation level.
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            logger.info("Entering %s", func.__name__)
+            logger.increase_indent()
+
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                logger.decrease_indent()
+                logger.info("Exiting %s", func.__name__)
+
+        return async_wrapper
+
     @wraps(func)  # Ensure the wrapped function retains its original attributes
     def wrapper(*args, **kwargs):
         # Log entry and increase indentation
@@ -1,15 +1,39 @@
+import os
+import copy
+import glob
+import time
 import yaml
 import json
+import asyncio
 import argparse
-import argparse
+import functools
 from pathlib import Path
 from dotenv import load_dotenv
 from logger_setup import logger, log_entry_exit
 
 from modules.create_table_sql import generate_create_table_sql 
-from modules.FHIResourceManager import FHIRResourceManager 
-from modules.llm_utils import get_llm
+from modules.FHIResourceManager import FHIRResourceManager, DEFAULT_MAX_CONCURRENCY, DEFAULT_ALTER_LIMITS
+from modules.BigQuerySchemaManager import BigQuerySchemaManager
+from modules.llm_utils import (get_llm, get_model_token_limits, count_tokens,
+                               DEFAULT_REQUEST_TIMEOUT_SECONDS, DEFAULT_CLIENT_MAX_RETRIES)
+from modules import rate_limiter
+from modules.rate_limiter import RateLimitedLLM
+from modules.description_cache import DescriptionCache, DEFAULT_CACHE_PATH, DEFAULT_CACHE_MAX_SIZE_MB
+from modules.schema_fingerprints import compute_fingerprints, get_fingerprints_path, load_fingerprints, save_fingerprints
+from modules.shared_field_registry import SharedFieldRegistry, DEFAULT_SHARED_FIELDS, DEFAULT_SHARED_FIELD_MIN_TABLES
+from modules.enrichment_journal import EnrichmentJournal, get_journal_path
+from modules.model_router import ModelRouter, ModelTier
+from modules.llm_cassette import CassetteLLM, get_cassette, RECORD_MODE, REPLAY_MODE, RECORDED_LATENCY, NO_LATENCY
+from modules.sql_writer import write_sql
+from modules.schema_patch import build_schema_patch
+from modules.local_bigquery import LocalBigQueryClient
+from modules.batch_job import (BatchResultsLLM, build_request, write_batch_requests, read_batch_results,
+                               answer_batch_requests)
+from prompts.prompt_registry import get_prompt_registry
+
 
+# The schemas the descriptions can be compared with in "alter" mode, see parse_alter_baseline_setting
+ALTER_BASELINES = ("none", "previous", "live")
 
 # This is the max length of the description that can be stored in BigQuery
 # for either a column or a table, we did not make this a YAML parameter
@@ -61,24 +85,59 @@ def save_final_sql(sql_statements, output_path):
     """
         This function saves the final SQL statements to the sepcified output path.
 
+        The statements are streamed to the file through a buffered writer, and 
+        compressed with gzip if the output path ends with ".gz".
+
         Args:
-            sql_statements (str): The SQL statements to be saved.
+            sql_statements (str or iterable): The SQL statements to be saved, as a 
+                single string or as the fragments yielded by FHIRResourceManager.iter_sql.
             output_path (str): The path where the SQL statements will be saved.
     """
-
-    # final_sql = "".join(sql_statements)    
-    
-    # # Ensure SQL statements contain actual newlines,
-    # # and save the file with proper formatting
     logger.info("Performing initial saving...")
 
-    # Write the cleaned SQL code to the output file
-    with open(output_path, 'w', encoding='utf-8') as outfile:
-        outfile.writelines(sql_statements)
+    # Write the SQL code to the output file
+    write_sql(sql_statements, output_path)
     
     logger.info("Final Save completed, cleaned SQL code saved")
 
 
+@log_entry_exit
+def save_schema_patch(schema_patch, output_path):
+    """
+        This function saves the tables.patch payload of the "patch" mode to the specified output path.
+
+        Args:
+            schema_patch (dict): The payload, see schema_patch.build_schema_patch.
+            output_path (str): The path where the payload will be saved.
+    """
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(schema_patch, f, indent=2)
+
+
+@log_entry_exit
+def get_patch_output_path(config_data, output_schema_location):
+    """
+        Returns the location of the tables.patch payload of the "patch" mode, the optional
+        'files.patch_output' setting, by default a JSON file next to the output schema,
+        e.g. "fhir/hde_encounters_enriched.patch.json". The payload is JSON, so it is never
+        written to the SQL output.
+
+        Args:
+            config_data (dict): The YAML data.
+            output_schema_location (str): The location of the enriched output schema.
+    """
+    patch_output = (config_data['files'].get('patch_output') or '').strip()
+    if patch_output:
+        return patch_output
+
+    root, _ = os.path.splitext(output_schema_location)
+    return f"{root}.patch.json"
+
+
 @log_entry_exit
 def read_yaml_file(file_path: str) -> dict:
     """
@@ -129,98 +188,846 @@ def parse_yaml_data(config_data):
     # LLM INfo
     llm_model = config_data['llm']['model'].strip()
 
+    # The maximum number of concurrent LLM requests is optional
+    max_concurrency = int(config_data['llm'].get('max_concurrency', DEFAULT_MAX_CONCURRENCY))
+
+    # The token limits default to the known limits of the model, but can be overridden
+    token_limits = get_model_token_limits(
+                        llm_model,
+                        context_window=config_data['llm'].get('context_window'),
+                        max_output_tokens=config_data['llm'].get('max_output_tokens'))
+
     # Finally, return the configuration information as a large tuple
     return app_name, app_version, input_schema_location, output_schema_location, sql_output_location, \
-           project_id, dataset_id, table_id, full_table_name, location, mode, llm_model
+           project_id, dataset_id, table_id, full_table_name, location, mode, llm_model, max_concurrency, \
+           token_limits
 
 
 
-# Main function to orchestrate the process
-def main():
+#  ---------------------------------------------------------------------------
+# This function will parse the optional 'cache' section of the YAML data
+#  ---------------------------------------------------------------------------
+@log_entry_exit
+def parse_cache_settings(config_data):
     """
-    Parses arguments, reads YAML configuration, and orchestrates the process of
-    generating enriched descriptions for FHIR schema fields and generating SQL statements
-    to either create a new table, or update an existing table with ALTER statements.
+    Parses the optional 'cache' section of the YAML data.
+
+    :param config_data: The YAML data to parse.
+    :return: A dictionary with the "enabled", "path" and "max_size_mb" settings
     """
+    cache_config = config_data.get('cache') or {}
 
-    # Argument parser for YAML file location
-    parser = argparse.ArgumentParser(description="Generate rich descriptions for FHIR schema fields.")
-    parser.add_argument('--yaml', type=str, required=True, help='The location of the YAML file')
+    return {
+        "enabled":     bool(cache_config.get('enabled', False)),
+        "path":        str(cache_config.get('path', DEFAULT_CACHE_PATH)).strip(),
+        "max_size_mb": float(cache_config.get('max_size_mb', DEFAULT_CACHE_MAX_SIZE_MB)),
+    }
 
-    # Parse arguments and extract the YAML source path
-    args = parser.parse_args()
-    yaml_source_path = Path(args.yaml)
-    logger.info(f"YAML Source Path: {yaml_source_path}")
 
-    # Read YAML configuration file
-    config_data = read_yaml_file(yaml_source_path)
 
-    if not config_data:
-        logger.error("Failed to load YAML configuration.")
-        return
+#  ---------------------------------------------------------------------------
+# This function will parse the optional 'bigquery.alter_batching' section of the YAML data
+#  ---------------------------------------------------------------------------
+@log_entry_exit
+def parse_alter_batch_settings(config_data):
+    """
+    Parses the optional 'bigquery.alter_batching' section of the YAML data, the size
+    limits of the ALTER TABLE statements generated in "alter" mode.
+
+    :param config_data: The YAML data to parse.
+    :return: A dictionary with the "max_statement_bytes" and "max_clauses" settings
+    """
+    alter_batch_config = config_data['bigquery'].get('alter_batching') or {}
+
+    return {
+        "max_statement_bytes": int(alter_batch_config.get('max_statement_bytes', 
+                                                          DEFAULT_ALTER_LIMITS["max_statement_bytes"])),
+        "max_clauses":         int(alter_batch_config.get('max_clauses', DEFAULT_ALTER_LIMITS["max_clauses"])),
+    }
+
+
+
+#  ---------------------------------------------------------------------------
+# This function will parse the optional client settings of the 'bigquery' section
+#  ---------------------------------------------------------------------------
+@log_entry_exit
+def parse_bigquery_client_settings(config_data):
+    """
+    Parses the optional client settings of the 'bigquery' section of the YAML data.
+
+    :param config_data: The YAML data to parse.
+    :return: A dictionary with the "local_client_dir" (the directory of the local BigQuery 
+             stand-in, None to use BigQuery) and "apply_patch" (apply the schema patch of 
+             the "patch" mode to the table) settings
+    """
+    bigquery_config = config_data['bigquery']
+    local_client_dir = bigquery_config.get('local_client_dir')
+
+    return {
+        "local_client_dir": str(local_client_dir).strip() if local_client_dir else None,
+        "apply_patch":      bool(bigquery_config.get('apply_patch', False)),
+    }
+
+
+
+@log_entry_exit
+def get_bigquery_manager(project_id, dataset_id, local_client_dir=None):
+    """
+    Returns the BigQuerySchemaManager of a dataset. When a local client directory is 
+    configured, the manager uses the LocalBigQueryClient stand-in instead of BigQuery, 
+    so the metadata calls can be tested without a GCP project.
+
+    :param project_id: The project of the dataset.
+    :param dataset_id: The dataset.
+    :param local_client_dir: The directory of the local BigQuery stand-in, or None.
+    :return: The BigQuerySchemaManager instance
+    """
+    client = LocalBigQueryClient(local_client_dir, project_id) if local_client_dir else None
+    return BigQuerySchemaManager(project_id, dataset_id, client=client)
+
+
+
+#  ---------------------------------------------------------------------------
+# This function will parse the optional 'bigquery.alter_baseline' setting of 
+# the YAML data, and load the baseline schema it refers to
+#  ---------------------------------------------------------------------------
+@log_entry_exit
+def parse_alter_baseline_setting(config_data):
+    """
+    Parses the optional 'bigquery.alter_baseline' setting of the YAML data, the schema
+    the descriptions are compared with in "alter" mode:
+
+    - none:      every column with a description is altered (the default).
+    - previous:  the output schema of the previous run.
+    - live:      the current schema of the table in BigQuery.
+
+    :param config_data: The YAML data to parse.
+    :return: One of "none", "previous" or "live"
+    """
+    alter_baseline = str(config_data['bigquery'].get('alter_baseline') or "none").strip().lower()
+    if alter_baseline not in ALTER_BASELINES:
+        raise ValueError(f"Invalid 'bigquery.alter_baseline' setting '{alter_baseline}', "
+                         f"expected one of {ALTER_BASELINES}.")
+    return alter_baseline
+
+
+
+@log_entry_exit
+def load_alter_baseline(alter_baseline, project_id, dataset_id, table_id, output_schema_location, 
+                        local_client_dir=None):
+    """
+    Loads the baseline schema of the "alter" mode, see parse_alter_baseline_setting.
+
+    :param alter_baseline: One of "none", "previous" or "live".
+    :param project_id: The project of the table.
+    :param dataset_id: The dataset of the table.
+    :param table_id: The name of the table.
+    :param output_schema_location: The location of the output schema of the previous run.
+    :param local_client_dir: The directory of the local BigQuery stand-in, see get_bigquery_manager.
+    :return: The baseline schema, or None if there is no baseline (every column is altered)
+    """
+    if alter_baseline == "previous":
+        if not os.path.isfile(output_schema_location):
+            logger.warning(f"No previous output schema at '{output_schema_location}', altering every column.")
+            return None
+        return load_schema(output_schema_location)
+
+    if alter_baseline == "live":
+        try:
+            bq_manager = get_bigquery_manager(project_id, dataset_id, local_client_dir)
+            return json.loads(bq_manager.get_table_schema(table_id, format="JSON"))
+        except Exception as e:
+            logger.warning(f"Could not fetch the schema of '{project_id}.{dataset_id}.{table_id}', "
+                           f"altering every column: {e}")
+            return None
+
+    return None
+
+
+
+#  ---------------------------------------------------------------------------
+# This function will parse the optional 'enrichment' section of the YAML data
+#  ---------------------------------------------------------------------------
+@log_entry_exit
+def parse_enrichment_settings(config_data):
+    """
+    Parses the optional 'enrichment' section of the YAML data.
+
+    :param config_data: The YAML data to parse.
+    :return: A dictionary with the "incremental", "share_columns", "shared_fields",
+             "shared_field_min_tables", "streaming", "checkpoint", "compact_prompts" 
+             and "delta_responses" settings
+    """
+    enrichment_config = config_data.get('enrichment') or {}
+
+    return {
+        "incremental":             bool(enrichment_config.get('incremental', False)),
+        "share_columns":           bool(enrichment_config.get('share_columns', False)),
+        "shared_fields":           list(enrichment_config.get('shared_fields') or DEFAULT_SHARED_FIELDS),
+        "shared_field_min_tables": int(enrichment_config.get('shared_field_min_tables', DEFAULT_SHARED_FIELD_MIN_TABLES)),
+        "streaming":               bool(enrichment_config.get('streaming', False)),
+        "checkpoint":              bool(enrichment_config.get('checkpoint', False)),
+        "compact_prompts":         bool(enrichment_config.get('compact_prompts', False)),
+        "delta_responses":         bool(enrichment_config.get('delta_responses', False)),
+    }
+
+
+
+#  ---------------------------------------------------------------------------
+# This function will parse the optional client settings of the 'llm' section
+#  ---------------------------------------------------------------------------
+@log_entry_exit
+def parse_llm_client_settings(config_data):
+    """
+    Parses the optional client settings of the 'llm' section of the YAML data.
+    The API keys are never stored in the YAML file, 'api_key_env_vars' lists the 
+    environment variables (or .env entries) holding them.
+
+    :param config_data: The YAML data to parse.
+    :return: A dictionary with the "api_keys", "timeout" and "max_retries" settings
+    """
+    llm_config = config_data['llm']
+
+    api_keys = []
+    for env_var in llm_config.get('api_key_env_vars') or []:
+        api_key = os.getenv(env_var)
+        if not api_key:
+            raise ValueError(f"Environment variable '{env_var}' listed in 'llm.api_key_env_vars' is not set.")
+        api_keys.append(api_key)
+
+    return {
+        "api_keys":    api_keys,
+        "timeout":     float(llm_config.get('timeout_seconds', DEFAULT_REQUEST_TIMEOUT_SECONDS)),
+        "max_retries": int(llm_config.get('client_max_retries', DEFAULT_CLIENT_MAX_RETRIES)),
+    }
+
+
+
+#  ---------------------------------------------------------------------------
+# This function will parse the optional 'llm.routing' section of the YAML data
+#  ---------------------------------------------------------------------------
+@log_entry_exit
+def parse_routing_settings(config_data):
+    """
+    Parses the optional 'llm.routing' section of the YAML data.
+
+    :param config_data: The YAML data to parse.
+    :return: A dictionary with the "tiers" (a list of "model" and "max_score" dictionaries,
+             from the fastest to the strongest model) and "escalate" settings, or None if
+             routing is not configured
+    """
+    routing_config = config_data['llm'].get('routing')
+    if not routing_config or not routing_config.get('tiers'):
+        return None
+
+    tiers = []
+    for tier_config in routing_config['tiers']:
+        max_score = tier_config.get('max_score')
+        tiers.append({"model":     str(tier_config['model']).strip(),
+                      "max_score": int(max_score) if max_score is not None else None})
+
+    return {
+        "tiers":    tiers,
+        "escalate": bool(routing_config.get('escalate', True)),
+    }
+
+
+
+#  ---------------------------------------------------------------------------
+# This function will parse the optional 'llm.rate_limits' section of the YAML data
+#  ---------------------------------------------------------------------------
+@log_entry_exit
+def parse_rate_limit_settings(config_data):
+    """
+    Parses the optional 'llm.rate_limits' section of the YAML data.
+
+    :param config_data: The YAML data to parse.
+    :return: A dictionary with the rate limit settings, or None if rate limiting is not configured
+    """
+    rate_limit_config = config_data['llm'].get('rate_limits')
+    if not rate_limit_config:
+        return None
+
+    return {
+        "requests_per_minute": int(rate_limit_config.get('requests_per_minute', rate_limiter.DEFAULT_REQUESTS_PER_MINUTE)),
+        "tokens_per_minute":   int(rate_limit_config.get('tokens_per_minute', rate_limiter.DEFAULT_TOKENS_PER_MINUTE)),
+        "max_concurrency":     int(rate_limit_config.get('max_concurrency', rate_limiter.DEFAULT_MAX_CONCURRENCY)),
+        "max_retries":         int(rate_limit_config.get('max_retries', rate_limiter.DEFAULT_MAX_RETRIES)),
+    }
+
+
+
+#  ---------------------------------------------------------------------------
+# This function returns the LLM for a model, creating it on first use, 
+# so all tables of a batch share a single client per model
+#  ---------------------------------------------------------------------------
+def get_shared_llm(resources, llm_model, rate_limits=None, client_settings=None):
+    """
+    Returns the LLM instance for a model from the shared batch resources.
+
+    :param resources: The resources shared by all tables of the run.
+    :param llm_model: The name of the LLM model.
+    :param rate_limits: The rate limit settings, see parse_rate_limit_settings.
+    :param client_settings: The client settings, see parse_llm_client_settings.
+    :return: The LLM instance, wrapped in a RateLimitedLLM if rate limits are configured,
+             and in a CassetteLLM when recording or replaying a cassette. When ingesting 
+             a batch job, a BatchResultsLLM serving the results of the job
+    """
+    if llm_model not in resources["llms"]:
+        cassette_settings = resources.get("cassette")
+
+        # Ingesting a batch job serves the responses of the job, the model is not called
+        if resources.get("batch_results") is not None:
+            resources["llms"][llm_model] = BatchResultsLLM(resources["batch_results"], llm_model)
+            return resources["llms"][llm_model]
 
-    # Parse the YAML data
-    (
-        app_name, app_version, input_schema_location, output_schema_location,
-        sql_output_location, project_id, dataset_id, table_id,
-        full_table_name, location, mode, llm_model
-    ) = parse_yaml_data(config_data)
+        # Replaying a cassette does not need (or pace) the real model
+        if cassette_settings and cassette_settings["mode"] == REPLAY_MODE:
+            resources["llms"][llm_model] = CassetteLLM(None, llm_model, get_cassette(cassette_settings["path"]),
+                                                       REPLAY_MODE, cassette_settings["latency"])
+            return resources["llms"][llm_model]
 
-    # Log the parsed arguments for debugging
-    indentation = ' ' * 25
-    logger.info(f"Parsed YAML Arguments: \n"
-            f"{indentation}input_schema_location..................: '{input_schema_location}',\n"
-            f"{indentation}output_schema_location.................: '{output_schema_location}',\n"
-            f"{indentation}sql_output_location....................: '{sql_output_location}',\n"
-            f"{indentation}project_id.............................: '{project_id}',\n"
-            f"{indentation}dateset_id.............................: '{dataset_id}',\n"
-            f"{indentation}table_id...............................: '{table_id}',\n"
-            f"{indentation}full_table_name........................: '{full_table_name}',\n"
-            f"{indentation}location...............................: '{location}',\n"
-            f"{indentation}mode...................................: '{mode}',\n"
-            f"{indentation}LLM Model..............................: '{llm_model}'")
+        llm = get_llm(llm_model, **(client_settings or {}))
+        if cassette_settings:
+            llm = CassetteLLM(llm, llm_model, get_cassette(cassette_settings["path"]), RECORD_MODE)
+        if rate_limits:
+            llm = RateLimitedLLM(llm, llm_model, functools.partial(count_tokens, model=llm_model), **rate_limits)
+        resources["llms"][llm_model] = llm
+        resources.setdefault("llm_settings", {})[llm_model] = (rate_limits, client_settings)
 
+    # The client of a model is shared, so the settings of the first table using it apply
+    elif resources.get("llm_settings", {}).get(llm_model, (rate_limits, client_settings)) != (rate_limits, client_settings):
+        logger.warning(f"Ignoring the rate limits and client settings of model '{llm_model}' for this table, "
+                       f"the model is already in use with the settings of an earlier table: "
+                       f"{resources['llm_settings'][llm_model]}")
 
-    # Initialize the Language Model (LLM)
-    llm = get_llm(llm_model)
+    return resources["llms"][llm_model]
 
-    # Load the input schema, representing the complete schema for the table
-    schema = load_schema(input_schema_location)
 
-    # Determine the corresponding FHIR resource name from the table name
-    fhir_mgr = FHIRResourceManager(llm, full_table_name)
-    logger.info(f"FHIR Resource Name Identified: {fhir_mgr.fhir_resource_name}")
 
-    # Generate a table-level description for the FHIR table
-    table_description = fhir_mgr.generate_table_description()
-    logger.info(f"Table Description Generated...")
+#  ---------------------------------------------------------------------------
+# This function runs the complete pipeline for a single table: 
+# enrichment, saving the enriched schema, and generating the SQL
+#  ---------------------------------------------------------------------------
+@log_entry_exit
+async def run_table_pipeline(config_data, yaml_source_path, resources):
+    """
+    Runs the enrichment and SQL generation pipeline for a single table.
+
+    :param config_data: The YAML configuration of the table.
+    :param yaml_source_path: The location of the YAML file, reported in the summary.
+    :param resources: The resources shared by all tables of the run (LLMs, caches).
+    :return: A summary dictionary with the status, duration, tokens and output paths
+    """
+    start_time = time.perf_counter()
+    summary = {"yaml": str(yaml_source_path), "status": "failed"}
+
+    # The wall time of every stage of the pipeline, reported in the summary
+    stage_seconds = summary["stage_seconds"] = {}
+    stage_start = [start_time]
+
+    def end_stage(stage):
+        now = time.perf_counter()
+        stage_seconds[stage] = round(now - stage_start[0], 3)
+        stage_start[0] = now
+
+    try:
+        # Parse the YAML data
+        (
+            app_name, app_version, input_schema_location, output_schema_location,
+            sql_output_location, project_id, dataset_id, table_id,
+            full_table_name, location, mode, llm_model, max_concurrency, token_limits
+        ) = parse_yaml_data(config_data)
+
+        summary.update({"table": full_table_name, 
+                        "output_schema": output_schema_location, 
+                        "sql_output": sql_output_location})
+
+        # Log the parsed arguments for debugging
+        indentation = ' ' * 25
+        logger.info(f"Parsed YAML Arguments: \n"
+                f"{indentation}input_schema_location..................: '{input_schema_location}',\n"
+                f"{indentation}output_schema_location.................: '{output_schema_location}',\n"
+                f"{indentation}sql_output_location....................: '{sql_output_location}',\n"
+                f"{indentation}project_id.............................: '{project_id}',\n"
+                f"{indentation}dateset_id.............................: '{dataset_id}',\n"
+                f"{indentation}table_id...............................: '{table_id}',\n"
+                f"{indentation}full_table_name........................: '{full_table_name}',\n"
+                f"{indentation}location...............................: '{location}',\n"
+                f"{indentation}mode...................................: '{mode}',\n"
+                f"{indentation}LLM Model..............................: '{llm_model}',\n"
+                f"{indentation}max_concurrency........................: '{max_concurrency}',\n"
+                f"{indentation}token_limits...........................: '{token_limits}'")
+
+        # Get the (shared) Language Model (LLM)
+        rate_limits = parse_rate_limit_settings(config_data)
+        client_settings = parse_llm_client_settings(config_data)
+        llm = get_shared_llm(resources, llm_model, rate_limits, client_settings)
+
+        # With model routing, every chunk goes to the model tier matching its complexity.
+        # The chunks must fit every tier, so they are sized for the smallest model
+        router = None
+        routing_settings = parse_routing_settings(config_data)
+        if routing_settings:
+            tiers = [ModelTier(tier["model"], get_shared_llm(resources, tier["model"], rate_limits, client_settings),
+                               tier["max_score"])
+                     for tier in routing_settings["tiers"]]
+            router = ModelRouter(tiers, routing_settings["escalate"])
+
+            for tier in tiers:
+                tier_limits = get_model_token_limits(tier.model_name,
+                                                     context_window=config_data['llm'].get('context_window'),
+                                                     max_output_tokens=config_data['llm'].get('max_output_tokens'))
+                token_limits = {key: min(value, tier_limits[key]) for key, value in token_limits.items()}
+            logger.info(f"Routing chunks over models {[tier.model_name for tier in tiers]}, token limits: {token_limits}")
+
+        # Load the input schema, representing the complete schema for the table
+        schema = load_schema(input_schema_location)
+        end_stage("load_schema")
+
+        # In incremental mode, we reuse the descriptions of the previous run for unchanged fields
+        enrichment_settings = parse_enrichment_settings(config_data)
+        fingerprints_location = get_fingerprints_path(output_schema_location)
+        previous_schema, previous_fingerprints = None, None
+        if enrichment_settings["incremental"] and os.path.isfile(output_schema_location):
+            logger.info(f"Incremental mode, loading the previous output schema from: '{output_schema_location}'")
+            previous_schema = load_schema(output_schema_location)
+            previous_fingerprints = load_fingerprints(fingerprints_location)
+
+        # In "alter" mode, only the columns whose description differs from the baseline 
+        # are altered. The baseline is loaded before the output schema is overwritten
+        bigquery_settings = parse_bigquery_client_settings(config_data)
+        baseline_schema = None
+        if mode == "alter":
+            baseline_schema = load_alter_baseline(parse_alter_baseline_setting(config_data), 
+                                                  project_id, dataset_id, table_id, output_schema_location,
+                                                  bigquery_settings["local_client_dir"])
 
+        # Columns shared by many tables are only described once, if enabled
+        shared_fields = resources["shared_fields"] if enrichment_settings["share_columns"] else None
 
-    # logger.info("Generating enriched schema with descriptions, using semantic chunking")
-    # enriched_schema = fhir_mgr.generate_enriched_schema_with_semantic_chunking(schema)
-    # logger.info("Enriched schema generation completed.")
+        # Every completed field is journaled, so an interrupted run can resume
+        journal = None
+        if enrichment_settings["checkpoint"]:
+            journal = EnrichmentJournal(get_journal_path(output_schema_location))
+
+        # Determine the corresponding FHIR resource name from the table name
+        fhir_mgr = FHIRResourceManager(llm, full_table_name, max_concurrency, token_limits, 
+                                       model_name=llm_model, cache=resources["cache"], 
+                                       shared_fields=shared_fields, journal=journal,
+                                       streaming=enrichment_settings["streaming"],
+                                       compact_prompts=enrichment_settings["compact_prompts"],
+                                       delta_responses=enrichment_settings["delta_responses"],
+                                       router=router,
+                                       alter_limits=parse_alter_batch_settings(config_data))
+        logger.info(f"FHIR Resource Name Identified: {fhir_mgr.fhir_resource_name}")
+
+        # Generate a table-level description for the FHIR table
+        end_stage("setup")
+        table_description = await fhir_mgr.agenerate_table_description()
+        logger.info(f"Table Description Generated...")
+        end_stage("table_description")
+
+        # Create an enriched schema with additional descriptions for each field
+        logger.info("Generating enriched schema with descriptions...")
+        enriched_schema = await fhir_mgr.agenerate_enriched_schema(schema, previous_schema, previous_fingerprints)
+        if enriched_schema is None:
+            raise ValueError(f"No enriched schema was generated for table '{full_table_name}'.")
+        logger.info("Enriched schema generation completed.")
+        end_stage("enrichment")
+
+        # Save the enriched schema to the output location
+        save_enriched_schema(enriched_schema, output_schema_location)
+        logger.info(f"Enriched schema successfully saved to: '{output_schema_location}'")
+
+        # Save the fingerprints of the input schema, so the next incremental run can detect changes
+        save_fingerprints(compute_fingerprints(schema), fingerprints_location)
+
+        # The enriched schema is saved, so we no longer need the journal to resume
+        if journal is not None:
+            journal.remove()
+        end_stage("save_schema")
+
+        if mode == "patch":
+            # Patch mode: set all descriptions, the nested ones included, on the live 
+            # schema of the table with a single metadata update, keeping its data
+            logger.info("Starting the schema patch generation process...")
+            bq_manager = get_bigquery_manager(project_id, dataset_id, bigquery_settings["local_client_dir"])
+            live_schema = json.loads(bq_manager.get_table_schema(table_id, format="JSON"))
+            schema_patch, summary["patched_descriptions"] = build_schema_patch(
+                                                                live_schema, enriched_schema, table_description)
+            patch_output_location = summary["patch_output"] = get_patch_output_path(config_data, output_schema_location)
+            save_schema_patch(schema_patch, patch_output_location)
+            logger.info(f"Schema patch saved to: '{patch_output_location}'")
+
+            if bigquery_settings["apply_patch"]:
+                bq_manager.patch_table(table_id, schema_patch)
+                logger.info(f"Schema patch applied to table: '{full_table_name}'")
+            end_stage("sql_generation")
+
+        else:
+            # Generate SQL statements (ALTER 
+            # TABLE / CREATE TABLE) based on the mode, and stream them to
+            # the SQL file while the schema is walked
+            logger.info("Starting the SQL generation process...")
+            generated_sql = fhir_mgr.iter_sql(enriched_schema, table_description, mode, baseline_schema)
+            save_final_sql(generated_sql, sql_output_location)
+            logger.info(f"Generated SQL saved to: '{sql_output_location}'")
+            end_stage("sql_generation")
+
+        summary.update(fhir_mgr.token_usage)
+        if mode == "alter":
+            summary["alter_batches"] = fhir_mgr.alter_batches
+            summary["alter_skipped"] = fhir_mgr.alter_skipped
+        summary["status"] = "succeeded"
+
+    except Exception as e:
+        logger.error(f"Pipeline failed for '{yaml_source_path}': {e}")
+        summary["error"] = str(e)
+
+    summary["duration_seconds"] = round(time.perf_counter() - start_time, 3)
+    return summary
+
+
+
+#  ---------------------------------------------------------------------------
+# This function resolves the YAML configurations of all tables of a run,
+# from a single YAML file, a manifest, a glob, or a BigQuery dataset
+#  ---------------------------------------------------------------------------
+@log_entry_exit
+def resolve_table_configs(args):
+    """
+    Resolves the YAML configurations of all tables to process.
+
+    - --yaml only:     a single table.
+    - --manifest:      a YAML file with a 'tables' list of YAML configuration files.
+    - --yaml-glob:     all YAML configuration files matching a glob pattern.
+    - --dataset:       every table of a BigQuery dataset ("project.dataset"), using the 
+                       --yaml file as the template for the configuration of every table.
+
+    :param args: The parsed command line arguments.
+    :return: A list of (yaml_source_path, config_data) tuples
+    """
+    if args.manifest:
+        manifest = read_yaml_file(args.manifest)
+        yaml_paths = [Path(path) for path in manifest.get('tables') or []]
+
+    elif args.yaml_glob:
+        yaml_paths = sorted(Path(path) for path in glob.glob(args.yaml_glob))
+
+    elif args.dataset:
+        return resolve_dataset_configs(args.dataset, read_yaml_file(args.yaml), args.output_dir)
+
+    else:
+        yaml_paths = [Path(args.yaml)]
+
+    configs = []
+    for yaml_path in yaml_paths:
+        logger.info(f"YAML Source Path: {yaml_path}")
+        config_data = read_yaml_file(yaml_path)
+        if not config_data:
+            logger.error(f"Failed to load YAML configuration: '{yaml_path}'")
+            continue
+        configs.append((yaml_path, config_data))
+
+    return configs
+
+
+
+@log_entry_exit
+def resolve_dataset_configs(dataset, template_config, output_dir):
+    """
+    Builds a configuration for every table of a BigQuery dataset. The schema of 
+    every table is fetched from BigQuery and saved as the input schema.
+
+    :param dataset: The BigQuery dataset, in the format "project.dataset".
+    :param template_config: The YAML configuration used as the template for every table.
+    :param output_dir: The directory receiving the input, output and SQL files.
+    :return: A list of (label, config_data) tuples
+    """
+    project_id, dataset_id = dataset.split(".", 1)
+    bq_manager = get_bigquery_manager(project_id, dataset_id, 
+                                      parse_bigquery_client_settings(template_config)["local_client_dir"])
+    os.makedirs(output_dir, exist_ok=True)
+
+    configs = []
+    for table_id in bq_manager.list_tables():
+        input_schema_location = os.path.join(output_dir, f"{table_id}.json")
+        with open(input_schema_location, 'w', encoding='utf-8') as f:
+            f.write(bq_manager.get_table_schema(table_id, format="JSON"))
+
+        config_data = copy.deepcopy(template_config)
+        config_data['bigquery'].update({'project_id': project_id, 'dataset_id': dataset_id, 'table_id': table_id})
+        config_data['files'] = {
+            'input_schema':  input_schema_location,
+            'output_schema': os.path.join(output_dir, f"{table_id}_enriched.json"),
+            'sql_output':    os.path.join(output_dir, f"{table_id}.sql"),
+        }
+        configs.append((f"{dataset}.{table_id}", config_data))
+
+    logger.info(f"Resolved {len(configs)} tables in dataset '{dataset}'.")
+    return configs
+
+
+
+#  ---------------------------------------------------------------------------
+# These functions run the pipelines of all tables concurrently, in one process
+#  ---------------------------------------------------------------------------
+def get_shared_column_settings(enrichment_settings):
+    """
+    Returns the enrichment settings of the shared column registry, which is shared 
+    by all tables of a run.
+
+    :param enrichment_settings: The enrichment settings of a table (see parse_enrichment_settings).
+    :return: A dictionary with the "share_columns", "shared_fields" and "shared_field_min_tables" settings
+    """
+    return {key: enrichment_settings[key] for key in ("share_columns", "shared_fields", "shared_field_min_tables")}
+
+
+
+@log_entry_exit
+async def run_batch(configs, table_concurrency, cassette_settings=None, batch_results=None):
+    """
+    Runs the pipelines of all tables concurrently. The LLM clients, the description 
+    cache and the shared column registry are shared by all tables.
 
+    :param configs: A list of (yaml_source_path, config_data) tuples.
+    :param table_concurrency: The maximum number of tables processed at the same time.
+    :param cassette_settings: Optional dictionary with the "path", "mode" and "latency" of 
+                              the cassette to record the LLM calls to, or replay them from.
+    :param batch_results: Optional dictionary with the responses of a provider batch job, 
+                          keyed by request ID, served in place of the LLM (see read_batch_results).
+    :return: The list of per-table summaries, in the order of the configs
+    """
+    # Load and validate all prompt templates once, before any LLM call is made
+    get_prompt_registry().load_all()
+
+    # The cassette is shared by the process, every run replays it from the start
+    if cassette_settings and cassette_settings["mode"] == REPLAY_MODE:
+        get_cassette(cassette_settings["path"]).rewind()
+
+    # The cache and shared column settings are shared by the whole run, so all tables must agree on them
+    cache_settings = parse_cache_settings(configs[0][1])
+    enrichment_settings = parse_enrichment_settings(configs[0][1])
+    shared_settings = (cache_settings, get_shared_column_settings(enrichment_settings))
+
+    for yaml_source_path, config_data in configs[1:]:
+        if (parse_cache_settings(config_data), 
+                get_shared_column_settings(parse_enrichment_settings(config_data))) != shared_settings:
+            raise ValueError(f"The 'cache' and shared column settings of '{yaml_source_path}' differ from those "
+                             f"of '{configs[0][0]}'. These settings apply to the whole run, all tables must agree on them.")
+
+    resources = {
+        "llms": {},
+        "cache": None,
+        "shared_fields": SharedFieldRegistry(enrichment_settings["shared_fields"], 
+                                             enrichment_settings["shared_field_min_tables"]),
+        "cassette": cassette_settings,
+        "batch_results": batch_results,
+    }
+
+    # Open the persistent description cache, if enabled
+    if cache_settings["enabled"]:
+        resources["cache"] = DescriptionCache(cache_settings["path"], cache_settings["max_size_mb"])
+
+    # Let the registry see all schemas, so it can recognize the columns common to many tables
+    if enrichment_settings["share_columns"] and len(configs) > 1:
+        for _, config_data in configs:
+            input_schema_location = config_data['files']['input_schema'].strip()
+            if os.path.isfile(input_schema_location):
+                resources["shared_fields"].observe(load_schema(input_schema_location))
+
+    semaphore = asyncio.Semaphore(max(1, table_concurrency))
+
+    async def run_one(yaml_source_path, config_data):
+        async with semaphore:
+            return await run_table_pipeline(config_data, yaml_source_path, resources)
+
+    summaries = await asyncio.gather(*(run_one(path, config) for path, config in configs))
+
+    resources["shared_fields"].log_stats()
+
+    # Report how effective the description cache was
+    if resources["cache"] is not None:
+        resources["cache"].log_stats()
+        resources["cache"].close()
+
+    return summaries
+
+
+
+#  ---------------------------------------------------------------------------
+# These functions implement the offline batch job mode: the prompts of all 
+# tables are written to a provider batch request file, and the results of 
+# the job are ingested later
+#  ---------------------------------------------------------------------------
+def prepare_batch_job_config(config_data):
+    """
+    Returns a copy of the configuration of a table for a batch job. Both phases of the 
+    job must build the same prompts from the same input, so everything that depends 
+    on the state of a run (the description cache, incremental mode, the journal, the 
+    shared column registry) is disabled, as is model routing.
+
+    :param config_data: The YAML configuration of the table.
+    :return: The batch job configuration of the table
+    """
+    config_data = copy.deepcopy(config_data)
+    config_data['cache'] = dict(config_data.get('cache') or {}, enabled=False)
+    config_data['enrichment'] = dict(config_data.get('enrichment') or {}, incremental=False, 
+                                     checkpoint=False, share_columns=False)
+    config_data['llm'] = dict(config_data['llm'])
+    config_data['llm'].pop('routing', None)
+    return config_data
+
+
+
+@log_entry_exit
+def prepare_batch_requests(configs, requests_path):
+    """
+    The first phase of a batch job: writes the prompts of all tables to a JSONL batch 
+    request file, in the format of the provider of every table's model. Submit the file
+    to the provider's batch API, and ingest the downloaded results with --batch-job ingest.
+
+    :param configs: A list of (yaml_source_path, config_data) tuples.
+    :param requests_path: The location of the JSONL batch request file.
+    :return: The number of requests written
+    """
+    requests = []
+    for yaml_source_path, config_data in configs:
+        (
+            _, _, input_schema_location, _, _, _, _, _,
+            full_table_name, _, _, llm_model, max_concurrency, token_limits
+        ) = parse_yaml_data(config_data)
+        enrichment_settings = parse_enrichment_settings(config_data)
+
+        fhir_mgr = FHIRResourceManager(None, full_table_name, max_concurrency, token_limits, 
+                                       model_name=llm_model,
+                                       compact_prompts=enrichment_settings["compact_prompts"],
+                                       delta_responses=enrichment_settings["delta_responses"])
+        prompts = fhir_mgr.batch_prompts(load_schema(input_schema_location))
+        requests.extend(build_request(llm_model, prompt) for prompt in prompts)
+        logger.info(f"{yaml_source_path}: {len(prompts)} batch requests")
+
+    return write_batch_requests(requests, requests_path)
+
+
+
+@log_entry_exit
+def answer_batch_requests_locally(configs, requests_path, results_path):
+    """
+    Answers a batch request file with the configured models, in place of the provider's
+    batch API. Used with the fake backend to test a batch job offline.
+
+    :param configs: A list of (yaml_source_path, config_data) tuples.
+    :param requests_path: The location of the JSONL batch request file.
+    :param results_path: The location of the JSONL batch result file to write.
+    :return: The number of requests answered
+    """
+    client_settings = parse_llm_client_settings(configs[0][1])
+    return answer_batch_requests(requests_path, results_path, 
+                                 lambda model_name: get_llm(model_name, **client_settings),
+                                 default_model=configs[0][1]['llm']['model'])
+
+
+
+@log_entry_exit
+def save_batch_summary(summaries, output_path):
+    """
+    Logs the per-table summaries of a run, and saves them as a JSON file.
+
+    :param summaries: The list of per-table summaries.
+    :param output_path: The location of the JSON summary file.
+    """
+    for summary in summaries:
+        logger.info(f"{summary.get('table', summary['yaml'])}: {summary['status']} in {summary['duration_seconds']}s, "
+                    f"{summary.get('llm_calls', 0)} LLM calls, {summary.get('input_tokens', 0)} input tokens, "
+                    f"{summary.get('output_tokens', 0)} output tokens, "
+                    f"{summary.get('input_tokens_saved', 0)} input tokens saved by compact prompts")
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(summaries, f, indent=2)
+
+
+
+# Main function to orchestrate the process
+def main():
+    """
+    Parses arguments, reads YAML configuration, and orchestrates the process of
+    generating enriched descriptions for FHIR schema fields and generating SQL statements
+    to either create a new table, or update an existing table with ALTER statements.
+
+    A single table is processed with --yaml. In batch mode (--manifest, --yaml-glob or
+    --dataset), all tables are processed concurrently in this process, and a summary 
+    of every table is written to the --summary file.
+
+    With --batch-job, the LLM calls go through the provider's batch API instead: the 
+    prepare phase writes the prompts of all tables to the --batch-requests file, and 
+    the ingest phase runs the pipeline on the responses in the --batch-results file.
+    """
+
+    # Argument parser for YAML file location
+    parser = argparse.ArgumentParser(description="Generate rich descriptions for FHIR schema fields.")
+    parser.add_argument('--yaml', type=str, help='The location of the YAML file, the template in --dataset mode')
+    batch_group = parser.add_mutually_exclusive_group()
+    batch_group.add_argument('--manifest', type=str, help='A YAML manifest with a "tables" list of YAML files')
+    batch_group.add_argument('--yaml-glob', type=str, help='A glob pattern matching the YAML files to process')
+    batch_group.add_argument('--dataset', type=str, help='Process every table of a BigQuery dataset ("project.dataset")')
+    parser.add_argument('--output-dir', type=str, default='batch', help='The output directory in --dataset mode')
+    parser.add_argument('--table-concurrency', type=int, default=4, help='The number of tables processed at the same time')
+    parser.add_argument('--summary', type=str, default='batch_summary.json', help='The location of the batch summary')
+    parser.add_argument('--cassette', type=str, help='Record the LLM calls to, or replay them from, this cassette file')
+    parser.add_argument('--cassette-mode', choices=[RECORD_MODE, REPLAY_MODE], default=REPLAY_MODE,
+                        help='Record the calls of the real model, or replay the recorded responses')
+    parser.add_argument('--replay-latency', choices=[RECORDED_LATENCY, NO_LATENCY], default=RECORDED_LATENCY,
+                        help='Replay the responses with the recorded latency, or immediately')
+    parser.add_argument('--batch-job', choices=['prepare', 'respond', 'ingest'],
+                        help='Write the batch request file (prepare), answer it locally (respond), '
+                             'or enrich the tables with the batch results (ingest)')
+    parser.add_argument('--batch-requests', type=str, default='batch_requests.jsonl',
+                        help='The location of the batch request file')
+    parser.add_argument('--batch-results', type=str, default='batch_results.jsonl',
+                        help='The location of the batch result file')
+
+    # Parse arguments
+    args = parser.parse_args()
+    batch_mode = bool(args.manifest or args.yaml_glob or args.dataset)
+    if not args.yaml and (not batch_mode or args.dataset):
+        parser.error("--yaml is required, unless --manifest or --yaml-glob is used")
+
+    # Read the YAML configuration file(s)
+    configs = resolve_table_configs(args)
+    if not configs:
+        logger.error("Failed to load YAML configuration.")
+        return
 
-    # Create an enriched schema with additional descriptions for each field
-    logger.info("Generating enriched schema with descriptions...")
-    enriched_schema = fhir_mgr.generate_enriched_schema(schema)
-    logger.info("Enriched schema generation completed.")
+    # In batch job mode, the prompts are sent through the provider's batch API
+    batch_results = None
+    if args.batch_job:
+        configs = [(path, prepare_batch_job_config(config_data)) for path, config_data in configs]
+        if args.batch_job == 'prepare':
+            prepare_batch_requests(configs, args.batch_requests)
+            logger.info(f"Submit '{args.batch_requests}' to the batch API, then run again with --batch-job ingest.")
+            return
+        if args.batch_job == 'respond':
+            answer_batch_requests_locally(configs, args.batch_requests, args.batch_results)
+            return
+        batch_results = read_batch_results(args.batch_results)
 
-    # Save the enriched schema to the output location
-    save_enriched_schema(enriched_schema, output_schema_location)
-    logger.info(f"Enriched schema successfully saved to: '{output_schema_location}'")
+    # Run the pipeline for every table
+    cassette_settings = None
+    if args.cassette:
+        cassette_settings = {"path": args.cassette, "mode": args.cassette_mode, "latency": args.replay_latency}
 
-    # Generate SQL statements (ALTER 
-    # TABLE / CREATE TABLE) based on the mode
-    logger.info("Starting the SQL generation process...")
-    generated_sql = fhir_mgr.generate_sql(enriched_schema, table_description, mode)
-    logger.info("SQL generation completed.")
+    summaries = asyncio.run(run_batch(configs, args.table_concurrency, cassette_settings, batch_results))
 
-    # Save the generated SQL file
-    save_final_sql(generated_sql, sql_output_location)
-    logger.info(f"Generated SQL saved to: '{sql_output_location}'")
+    if batch_mode:
+        save_batch_summary(summaries, args.summary)
+        logger.info(f"Batch summary saved to: '{args.summary}'")
 
-    logger.info("Process completed successfully.")
+    if all(summary["status"] == "succeeded" for summary in summaries):
+        logger.info("Process completed successfully.")
+    else:
+        logger.error("Process completed with errors.")
 
 # Execute the script
 if __name__ == "__main__":
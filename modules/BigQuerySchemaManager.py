@@ -1,11 +1,18 @@
 import json
 from google.cloud import bigquery
+from modules.schema_ir import SchemaIR
 
 class BigQuerySchemaManager:
-    def __init__(self, project_id, dataset_id):
-        self.client = bigquery.Client(project=project_id)
+    def __init__(self, project_id, dataset_id, client=None):
+        """ Uses the given client, e.g. a LocalBigQueryClient, or creates a BigQuery client. """
+        self.client = client if client is not None else bigquery.Client(project=project_id)
         self.dataset_id = dataset_id
 
+    def list_tables(self):
+        """ Returns the names of all tables in the dataset, sorted by name. """
+        tables = self.client.list_tables(f"{self.client.project}.{self.dataset_id}")
+        return sorted(table.table_id for table in tables)
+
     def get_table_schema(self, table_name, format="DDL"):
         table_ref = f"{self.client.project}.{self.dataset_id}.{table_name}"
         table = self.client.get_table(table_ref)
@@ -19,6 +26,23 @@ class BigQuerySchemaManager:
         else:
             raise ValueError("Invalid format. Choose 'DDL' or 'JSON'.")
 
+    def patch_table(self, table_name, patch):
+        """ 
+        Applies a tables.patch-style payload ({"schema": {"fields": [...]}, "description": ...}) 
+        with a single metadata update call, see schema_patch.build_schema_patch. Unlike 
+        CREATE OR REPLACE TABLE, this keeps the data, partitioning and clustering of the table.
+        """
+        table_ref = f"{self.client.project}.{self.dataset_id}.{table_name}"
+        table = self.client.get_table(table_ref)
+
+        table.schema = [bigquery.SchemaField.from_api_repr(field) for field in patch["schema"]["fields"]]
+        updated_fields = ["schema"]
+        if "description" in patch:
+            table.description = patch["description"]
+            updated_fields.append("description")
+
+        return self.client.update_table(table, updated_fields)
+
     def _generate_create_table_ddl(self, table):
         """ Recursively generates the CREATE TABLE DDL for deeply nested schemas, including arrays. """
         ddl = f"CREATE TABLE `{table.project}.{table.dataset_id}.{table.table_id}` (\n"
@@ -27,30 +51,36 @@ class BigQuerySchemaManager:
         return ddl
 
     def _process_schema_fields(self, fields, indent=2):
-        """ Recursively processes fields, including nested STRUCT and ARRAY types. """
-        sql_lines = []
+        """ Processes fields, including deeply nested STRUCT and ARRAY types, walking the compiled schema. """
+        schema_ir = SchemaIR.from_bigquery(fields)
+        sql_parts = []
 
-        for field in fields:
-            field_name = field.name
-            field_type = field.field_type.upper()
-            is_repeated = field.mode == "REPEATED"
-            
-            # Handle nested STRUCT (RECORD) fields
-            if field_type == "RECORD" and field.fields:
-                nested_fields = self._process_schema_fields(field.fields, indent + 2)
-                struct_definition = f"STRUCT<\n{nested_fields}\n{' ' * indent}>"
-                
-                # If the field is REPEATED, wrap it inside an ARRAY<>
+        for node, entering in schema_ir.events():
+            padding = ' ' * (indent + 2 * node.depth)
+            is_repeated = node.mode == "REPEATED"
+
+            # Handle nested STRUCT (RECORD) fields, closed after their nested fields
+            is_struct = node.is_record and node.has_fields
+            if not entering:
+                if is_struct:
+                    # If the field is REPEATED, the STRUCT is wrapped inside an ARRAY<>
+                    sql_parts.append(f"\n{padding}>>" if is_repeated else f"\n{padding}>")
+                continue
+
+            if node.sibling_index:
+                sql_parts.append(",\n")
+
+            if is_struct:
                 if is_repeated:
-                    sql_lines.append(f"{' ' * indent}{field_name} ARRAY<{struct_definition}>")
+                    sql_parts.append(f"{padding}{node.name} ARRAY<STRUCT<\n")
                 else:
-                    sql_lines.append(f"{' ' * indent}{field_name} {struct_definition}")
+                    sql_parts.append(f"{padding}{node.name} STRUCT<\n")
             
             else:
                 # Handle primitive types
                 if is_repeated:
-                    sql_lines.append(f"{' ' * indent}{field_name} ARRAY<{field_type}>")
+                    sql_parts.append(f"{padding}{node.name} ARRAY<{node.type}>")
                 else:
-                    sql_lines.append(f"{' ' * indent}{field_name} {field_type}")
+                    sql_parts.append(f"{padding}{node.name} {node.type}")
 
-        return ",\n".join(sql_lines)
+        return "".join(sql_parts)
@@ -1,21 +1,45 @@
 import json
-import tiktoken  
+import asyncio
 from typing import List, Dict
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from langchain.schema import HumanMessage
-from langchain_core.prompts import PromptTemplate
-from langchain_core.output_parsers import JsonOutputParser
 
-from prompts.read_prompt_template import read_prompt_template
+from prompts.prompt_registry import get_prompt_registry
 from prompts import prompt_names
 from logger_setup import logger, log_entry_exit
+from modules.llm_utils import DEFAULT_TOKEN_LIMITS
+from modules.tokenizer import count_tokens, count_tokens_many
+from modules.schema_chunker import SchemaChunker, merge_split_records, serialize_field
+from modules.description_cache import DescriptionCache
+from modules.schema_paths import (join_path, index_by_path, extract_enrichments, merge_enrichments,
+                                  compact_fields, delta_enrichments, complete_fields, strip_enrichments,
+                                  is_enriched)
+from modules.schema_fingerprints import compute_fingerprints, subtree_ranges
+from modules.shared_field_registry import SharedFieldRegistry
+from modules.json_array_parser import salvage_json_array, parse_json_response, IncrementalJsonArrayParser
+from modules.enrichment_journal import EnrichmentJournal
+from modules.model_router import ModelRouter
+from modules.schema_ir import SchemaIR, as_schema_ir
 
 # This is the max length of the description that can be stored in BigQuery
 # for either a column or a table, we did not make this a YAML parameter
 # since it is a constant value
 CHARACTER_LIMIT = 1024
 
-CHUNK_SIZE = 15
+# The default number of chunks we allow to be in flight against the LLM at the
+# same time. This can be overridden with the 'llm.max_concurrency' YAML setting
+DEFAULT_MAX_CONCURRENCY = 4
+
+# Shared columns are described once for all tables, so the prompt must not
+# refer to the resource of the table that happened to request them first
+SHARED_FHIR_RESOURCE = "any FHIR resource (this column is shared by all FHIR resource tables)"
+
+# The number of times the fields the LLM dropped from its responses are requested again
+MAX_REREQUEST_ROUNDS = 2
+
+# BigQuery limits the length of a query (1 MB), so in ALTER mode the column clauses
+# are split into statements of at most this many bytes and clauses. This can be
+# overridden with the 'bigquery.alter_batching' YAML settings
+DEFAULT_ALTER_LIMITS = {"max_statement_bytes": 900000, "max_clauses": 500}
 
 class FHIRResourceManager:
     """
@@ -23,7 +47,10 @@ class FHIRResourceManager:
     """
 
     @log_entry_exit
-    def __init__(self, llm, full_table_name):
+    def __init__(self, llm, full_table_name, max_concurrency=DEFAULT_MAX_CONCURRENCY, token_limits=None,
+                 model_name=None, cache: DescriptionCache = None, shared_fields: SharedFieldRegistry = None,
+                 journal: EnrichmentJournal = None, streaming: bool = False, compact_prompts: bool = False,
+                 delta_responses: bool = False, router: ModelRouter = None, alter_limits=None):
         """
         Initializes the FHIRResourceManager instance.
 
@@ -31,9 +58,45 @@ class FHIRResourceManager:
         - llm: The language model instance. Used for LLM processing in the class.
         - full_table_name (str): The fully qualified BigQuery table name in the format 
           "project.dataset.table_name".
+        - max_concurrency (int): The maximum number of chunks sent to the LLM at the same time.
+        - token_limits (dict, optional): The "context_window" and "max_output_tokens" of the 
+          model, see `llm_utils.get_model_token_limits`.
+        - model_name (str, optional): The name of the LLM model, part of the cache key.
+        - cache (DescriptionCache, optional): The persistent description cache. When provided,
+          cached descriptions are reused and only the missing fields are sent to the LLM.
+        - shared_fields (SharedFieldRegistry, optional): The registry of columns shared by many 
+          tables. When provided, shared columns are enriched once and reused across tables.
+        - journal (EnrichmentJournal, optional): The journal receiving every enriched field as
+          soon as it completes. When provided, an interrupted run resumes from the journal.
+        - streaming (bool): Use the streaming API of the LLM, and journal every field as soon
+          as it has been streamed, instead of when the complete chunk has been received.
+        - compact_prompts (bool): Send the schema in a minimal compact JSON form (name, type 
+          and mode only), after a prefix of static instructions shared by all chunks.
+        - delta_responses (bool): Ask the LLM for the enrichment attributes keyed by field path
+          only, instead of echoing the complete schema, and merge them into the schema locally.
+        - router (ModelRouter, optional): Routes every chunk to a model tier by its complexity.
+          When not provided, all chunks are sent to `llm`.
+        - alter_limits (dict, optional): The "max_statement_bytes" and "max_clauses" of every
+          ALTER TABLE statement, see `DEFAULT_ALTER_LIMITS`.
 
         Attributes:
         - self.llm_model: Stores the provided language model instance.
+        - self.max_concurrency: Stores the upper bound of concurrent LLM requests.
+        - self.token_limits: Stores the token limits used to size the chunks.
+        - self.model_name: Stores the name of the LLM model.
+        - self.cache: Stores the description cache, or None if caching is disabled.
+        - self.shared_fields: Stores the shared column registry, or None if disabled.
+        - self.journal: Stores the enrichment journal, or None if checkpointing is disabled.
+        - self.streaming: Stores whether the streaming API of the LLM is used.
+        - self.compact_prompts: Stores whether the compact prompt format is used.
+        - self.delta_responses: Stores whether the delta response format is used.
+        - self.router: Stores the model router, or None if all chunks go to `llm`.
+        - self.alter_limits: Stores the size limits of the ALTER TABLE statements.
+        - self.alter_batches: The number of clauses and bytes of every ALTER TABLE statement
+                              of the last generated SQL, reported in the batch summary.
+        - self.alter_skipped: The number of columns of the last generated SQL whose description
+                              did not differ from the baseline schema, reported in the batch summary.
+        - self.token_usage: Keeps track of the LLM calls and tokens used for this table.
         - self._fhir_resource_name: Extracts and stores the FHIR resource name derived 
                                     from the provided BigQuery table name.
         - self._full_table_name: Stores the provided full table name.
@@ -42,6 +105,44 @@ class FHIRResourceManager:
         # Store the provided language model instance
         self.llm_model = llm  
 
+        # Store the concurrency limit, we always allow at least one request
+        self.max_concurrency = max(1, int(max_concurrency))
+
+        # Store the token limits of the model, used by the chunker
+        self.token_limits = dict(token_limits or DEFAULT_TOKEN_LIMITS)
+
+        # Store the model name and the (optional) description cache
+        self.model_name = model_name
+        self.cache = cache
+
+        # Store the (optional) registry of shared columns
+        self.shared_fields = shared_fields
+
+        # Store the (optional) journal, and whether we stream the responses
+        self.journal = journal
+        self.streaming = streaming
+
+        # Store whether we use the compact prompt format
+        self.compact_prompts = compact_prompts
+
+        # Store whether the LLM only returns the enrichment attributes, keyed by path
+        self.delta_responses = delta_responses
+
+        # Store the (optional) router, sending chunks to a model by their complexity
+        self.router = router
+
+        # Store the size limits of the ALTER TABLE statements
+        self.alter_limits = dict(DEFAULT_ALTER_LIMITS, **(alter_limits or {}))
+        self.alter_batches = []
+        self.alter_skipped = 0
+
+        # The fingerprints of the input schema, used to validate the journal entries
+        self._fingerprints = {}
+
+        # The LLM usage of this table, reported in the batch summary
+        self.token_usage = {"llm_calls": 0, "input_tokens": 0, "output_tokens": 0, "input_tokens_saved": 0,
+                            "llm_calls_by_model": {}}
+
         # Store the provided full table name
         self._full_table_name = full_table_name
 
@@ -124,8 +225,10 @@ class FHIRResourceManager:
 
 
     @log_entry_exit  # Decorator for logging function entry and exit
-    def generate_table_description(self):
+    async def agenerate_table_description(self):
         """ 
+        Asynchronous version of `generate_table_description`.
+
         Generates a description for a FHIR resource name using an LLM. 
         This description is at the resource (or table) level, so it
         describes the resource as a whole.
@@ -135,8 +238,8 @@ class FHIRResourceManager:
 
         Steps:
         1. Ensure the LLM model is initialized; otherwise, return a fallback message.
-        2. Retrieve the appropriate prompt template from the database using its name.
-        3. Set up a `PromptTemplate` to format the retrieved prompt.
+        2. Retrieve the compiled prompt template from the prompt registry using its name.
+        3. Use the compiled `PromptTemplate` to format the retrieved prompt.
         4. Inject the `fhir_resource_name` into the prompt and construct a message array.
         5. Invoke the LLM model to generate a description.
         6. Log the successful generation and return the description.
@@ -153,30 +256,36 @@ class FHIRResourceManager:
             return "No description available."  # Fallback
 
         try:
-            # Retrieve the prompt template from the database
-            prompt_name = prompt_names.GET_TABLE_DESCRIPTION
-            prompt_template_str = read_prompt_template(prompt_name)
-
-            # Set up the prompt template with the expected input variable
-            prompt_template = PromptTemplate(
-                input_variables=["table_name", "description_length"],
-                template=prompt_template_str
-            )
+            # Retrieve the compiled prompt template from the registry
+            prompt_template = get_prompt_registry().get(prompt_names.GET_TABLE_DESCRIPTION)
+
+            # Serve the description from the cache if we generated it before
+            cache_key = None
+            if self.cache is not None:
+                cache_key = DescriptionCache.make_key(
+                                self.fhir_resource_name, "", "TABLE", "", 
+                                self.model_name, prompt_template.text_hash)
+                cached_description = self.cache.get(cache_key)
+                if cached_description is not None:
+                    logger.info(f"Description for FHIR resource '{self._fhir_resource_name}' served from the cache.")
+                    return cached_description
 
             # Format the prompt by injecting the FHIR resource name
-            prompt = prompt_template.format(
-                            table_name=self.fhir_resource_name, 
-                            description_length=CHARACTER_LIMIT) 
+            prompt = self._build_table_description_prompt()
 
             # Create a message array containing the formatted prompt
             messages = [HumanMessage(content=prompt)]
 
             # Invoke the LLM model to generate a description
-            description = self.llm_model.invoke(input=messages).content
+            description = (await self.llm_model.ainvoke(input=messages)).content
+            self._record_usage(prompt, description)
 
             # Log successful retrieval of the description
             logger.info(f"Generated description for FHIR resource '{self._fhir_resource_name}' successfully retrieved.")
 
+            if cache_key is not None:
+                self.cache.put(cache_key, description)
+
             return description
 
         except Exception as e:
@@ -184,131 +293,513 @@ class FHIRResourceManager:
             logger.error(f"Error generating description for FHIR resource '{self._fhir_resource_name}': {e}")
             return None
 
+
+
+    def _build_table_description_prompt(self) -> str:
+        """
+        Formats the table description prompt for the FHIR resource of this table.
+        """
+        prompt_template = get_prompt_registry().get(prompt_names.GET_TABLE_DESCRIPTION)
+        return prompt_template.format(
+                        table_name=self.fhir_resource_name, 
+                        description_length=CHARACTER_LIMIT)
+
+
+
+    def generate_table_description(self):
+        """ 
+        Generates a description for a FHIR resource name using an LLM, 
+        see `agenerate_table_description`.
+
+        Returns:
+        - str: The generated description for the FHIR resource.
+        """
+        return asyncio.run(self.agenerate_table_description())
+
+
+
+    def _record_usage(self, prompt: str, response: str, model_name: str = None):
+        """
+        Adds a single LLM call to the token usage of this table.
+        """
+        model_name = model_name or self.model_name
+        calls_by_model = self.token_usage["llm_calls_by_model"]
+        calls_by_model[model_name] = calls_by_model.get(model_name, 0) + 1
+        self.token_usage["llm_calls"] += 1
+        self.token_usage["input_tokens"] += self.count_tokens(prompt)
+        self.token_usage["output_tokens"] += self.count_tokens(response)
+
     #============================================================================================================
 
 
-    def count_tokens(self, text: str, model="gpt-4") -> int:
+    def count_tokens(self, text: str, model=None) -> int:
         """
         Counts the number of tokens in the given text.
 
         Parameters:
             text (str): The input text.
-            model (str): The LLM model being used.
+            model (str): The LLM model being used, defaults to the model of this table.
 
         Returns:
             int: Token count of the input text.
         """
-        tokenizer = tiktoken.encoding_for_model(model)
-        return len(tokenizer.encode(text))
+        return count_tokens(text, model or self.model_name)
 
 
 
+    def count_tokens_many(self, texts: List[str], model=None) -> List[int]:
+        """
+        Counts the number of tokens of several texts in one batch.
+        """
+        return count_tokens_many(texts, model or self.model_name)
 
-    # def semantic_chunking(self, data: List[Dict], chunk_size: int = CHUNK_SIZE) -> List[List[Dict]]:
-    #     """
-    #     Chunks the JSON data into smaller batches of related records.
-    #     """
-    #     return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
-    
 
-    def semantic_chunking(self, data, chunk_size=10):
-        """
-        Chunking that ensures fields, especially nested RECORD types, are not split across chunks.
+
+
+    def semantic_chunking(self, data: List[Dict]) -> List[List[Dict]]:
         """
-        chunks = []
-        current_chunk = []
-        current_size = 0
+        Splits the schema into chunks that fit the token limits of the model.
 
-        for record in data:
-            # Check if adding this record would exceed chunk size
-            if current_size + 1 > chunk_size:
-                chunks.append(current_chunk)
-                current_chunk = []
-                current_size = 0
+        The input budget of a chunk is the context window, minus the tokens reserved
+        for the output and the tokens of the prompt template itself. The output budget
+        caps the number of fields per chunk, so the response is never truncated.
+        Oversized RECORD fields are split at subtree boundaries, see `SchemaChunker`.
 
-            # Add the entire RECORD field if it's nested, to prevent cutting off
-            if record.get('type', '').lower() == 'record':
-                current_chunk.append(record)
-            else:
-                current_chunk.append(record)
-            
-            current_size += 1
+        Parameters:
+        - data (list): The list of top-level schema fields.
 
-        if current_chunk:  # Append any remaining records
-            chunks.append(current_chunk)
+        Returns:
+        - list: The list of chunks.
+        """
+        context_window = self.token_limits["context_window"]
+        max_output_tokens = self.token_limits["max_output_tokens"]
 
-        return chunks
+        # The fixed part of the prompt is sent with every chunk
+        prompt_overhead = self.count_tokens(self._build_chunk_prompt([]))
+        input_budget = context_window - max_output_tokens - prompt_overhead
+        logger.info(f"Context window: {context_window} tokens, output limit: {max_output_tokens} tokens, "
+                    f"prompt overhead: {prompt_overhead} tokens.")
 
+        # In compact mode, the chunks are sized by their compact serialization
+        serialize = serialize_field
+        if self.compact_prompts:
+            serialize = lambda field: json.dumps(compact_fields([field])[0], separators=(",", ":"))
 
+        chunker = SchemaChunker(self.count_tokens, input_budget, max_output_tokens, CHARACTER_LIMIT,
+                                count_tokens_many=self.count_tokens_many, serialize=serialize,
+                                echo_input=not self.delta_responses)
+        return chunker.chunk(data)
 
-    
 
 
+    def _chunk_prompt_name(self, compact: bool = None) -> str:
+        """
+        Returns the name of the enrichment prompt template, delta, compact or full.
+        The delta template works with both the compact and the full schema format.
+        """
+        if compact is None:
+            compact = self.compact_prompts
+        if self.delta_responses:
+            return prompt_names.GENERATE_RESOURCE_SCHEMA_DESCRIPTIONS_DELTA
+        if compact:
+            return prompt_names.GENERATE_RESOURCE_SCHEMA_DESCRIPTIONS_COMPACT
+        return prompt_names.GENERATE_RESOURCE_SCHEMA_DESCRIPTIONS
 
-    # Function to process a chunk (you can replace this with LLM processing)
-    @log_entry_exit
-    def process_chunk(self, chunk: List[Dict]):
+
+
+    def _build_chunk_prompt(self, chunk: List[Dict], fhir_resource: str = None, compact: bool = None) -> str:
         """
-        Processes each chunk of data. Here, it's a placeholder for LLM integration.
+        Formats the enrichment prompt for a single chunk of schema fields.
+
+        Parameters:
+        - chunk (list): The schema fields to include in the prompt.
+        - fhir_resource (str, optional): The resource named in the prompt, defaults 
+          to the FHIR resource of this table.
+        - compact (bool, optional): Use the compact prompt format, defaults to the
+          format configured for this table.
+
+        Returns:
+        - str: The fully formatted prompt.
         """
-        # We use the JSON Output Parser to extract the JSON array from the response
-        # Using this parser, we get very predictable results, and we do not have
-        # to worry about the structure of the response and extra "bits" emitted
-        # by the LLM model
-        parser = JsonOutputParser()
-        instructions = parser.get_format_instructions()
+        if compact is None:
+            compact = self.compact_prompts
 
-        # Retrieve the appropriate prompt template from our prompt database
-        prompt_name = prompt_names.GENERATE_RESOURCE_SCHEMA_DESCRIPTIONS
-        prompt_template_str = read_prompt_template(prompt_name, "prompts")
+        # Retrieve the compiled prompt template from the registry, it is only
+        # read from disk again when the file changed
+        prompt_template = get_prompt_registry().get(self._chunk_prompt_name(compact))
 
-        # Set up the prompt template with the expected input variables                  
-        prompt_template = PromptTemplate(
-            input_variables=["input_json_schema", "fhir_resource", "character_length"],
-            template=prompt_template_str)
+        # The compact format only keeps the name, type and mode, without any whitespace
+        if compact:
+            input_json_schema = json.dumps(compact_fields(chunk), separators=(",", ":"))
+        else:
+            input_json_schema = json.dumps(chunk, indent=2)
 
         # Format the prompt with the chunk
-        prompt = prompt_template.format(
-                        fhir_resource=self.fhir_resource_name, 
+        return prompt_template.format(
+                        fhir_resource=fhir_resource or self.fhir_resource_name, 
                         character_length = CHARACTER_LIMIT,
-                        input_json_schema=json.dumps(chunk, indent=2))
+                        input_json_schema=input_json_schema)
+
+
+
+    def _tier_llm(self, tier: int = None):
+        """
+        Returns the LLM instance and model name of a routing tier, or the LLM of 
+        this table when no router is used.
+        """
+        if self.router is None or tier is None:
+            return self.llm_model, self.model_name
+        return self.router.tiers[tier].llm, self.router.tiers[tier].model_name
+
+
+
+    async def _arequest_chunk(self, chunk: List[Dict], fhir_resource: str = None, tier: int = None):
+        """
+        Sends a single chunk of schema fields to the LLM, using the asynchronous 
+        `ainvoke` API, and parses the response.
+
+        Parameters:
+        - chunk (list): The schema fields to enrich.
+        - fhir_resource (str, optional): The resource named in the prompt.
+        - tier (int, optional): The routing tier of the model to use.
+
+        Returns:
+        - tuple: The enriched fields (None if the response could not be parsed), and 
+          the complete fields that could be salvaged from an unparseable response.
+        """
+        prompt = self._build_chunk_prompt(chunk, fhir_resource)
         logger.info(f"Prepared the prompt...")
 
         # Measure prompt size in tokens
         token_count = self.count_tokens(prompt)
         logger.info(f"Prompt size: {token_count} tokens before sending to LLM.")
 
+        # Report how much the compact format saves compared with the full format
+        if self.compact_prompts:
+            saved_tokens = self.count_tokens(self._build_chunk_prompt(chunk, fhir_resource, compact=False)) - token_count
+            self.token_usage["input_tokens_saved"] += saved_tokens
+            logger.info(f"Compact prompt saved {saved_tokens} input tokens for this chunk.")
+
         # Create a message array containing the formatted prompt
         messages = [HumanMessage(content=prompt)]
         
         # Send request to LLM
-        logger.info(f"Invoking the LLM model...")
-        if self.llm_model is None:
-            logger.error(f"LLM model not found.")
-            return None
-        response = self.llm_model.invoke(input=messages).content
+        llm, model_name = self._tier_llm(tier)
+        if self.streaming:
+            logger.info(f"Streaming the LLM model response...")
+            response = await self._astream_response(messages, llm)
+        else:
+            logger.info(f"Invoking the LLM model...")
+            response = (await llm.ainvoke(input=messages)).content
         logger.info(f"LLM invocation completed successfully...")
+        self._record_usage(prompt, response, model_name)
 
-
-        enriched_chunk = ""
-        # Parse response and extend enriched schema
+        # Parse response strictly: a truncated response must fail, so its complete fields
+        # are salvaged and the rest is requested again, instead of being repaired
         try:
-            # Use the JSsonOutputParser to extract the JSON array from the response,
-            # and add it to the enriched schema
-            logger.info("Invoking JsonOutputParser to parse the response...")
-            enriched_chunk = parser.parse(response)
+            logger.info("Parsing the JSON response...")
+            enriched_chunk = parse_json_response(response)
+
+            # Delta responses only hold the attributes, merge them into the fields of the chunk.
+            # The input attributes are dropped first, so a field the LLM left out stays
+            # undescribed and is requested again
+            if self.delta_responses and isinstance(enriched_chunk, (list, dict)):
+                enrichments = delta_enrichments(enriched_chunk)
+                if not self.streaming:
+                    self._journal_enrichments(enrichments)
+                return merge_enrichments(strip_enrichments(chunk), enrichments), []
+
+            if isinstance(enriched_chunk, list) and all(isinstance(field, dict) for field in enriched_chunk):
+                # In streaming mode, the fields were journaled while they arrived
+                if not self.streaming:
+                    self._journal_fields(enriched_chunk)
+                return enriched_chunk, []
+            logger.error(f"Expected a JSON array of fields for chunk, got: {type(enriched_chunk).__name__}")
 
         except json.JSONDecodeError as e:
             logger.error(f"Error parsing JSON for chunk, error:{e}")
 
-        bennie_chunk = {
-            "bennie": enriched_chunk
-        }
+        salvaged = salvage_json_array(response)
+
+        # Only the fields with a complete subtree of delta entries count as salvaged
+        if self.delta_responses:
+            enrichments = delta_enrichments(salvaged)
+            if not self.streaming:
+                self._journal_enrichments(enrichments)
+            return None, complete_fields(strip_enrichments(chunk), enrichments)
+
+        if not self.streaming:
+            self._journal_fields(salvaged)
+        return None, salvaged
+
+
 
-        retval =  json.dumps(bennie_chunk, indent=2)
+    async def _astream_response(self, messages, llm=None) -> str:
+        """
+        Streams the LLM response, and journals every top-level field of the JSON
+        array as soon as it is complete.
+
+        Parameters:
+        - messages (list): The messages to send to the LLM.
+        - llm (optional): The LLM instance to use, defaults to the LLM of this table.
+
+        Returns:
+        - str: The complete response text.
+        """
+        array_parser = IncrementalJsonArrayParser()
+        pieces = []
 
-        return retval
+        async for message_chunk in (llm or self.llm_model).astream(messages):
+            piece = message_chunk.content if isinstance(message_chunk.content, str) else str(message_chunk.content)
+            pieces.append(piece)
+            self._journal_fields(array_parser.feed(piece))
+
+        return "".join(pieces)
+
+
+
+    def _journal_fields(self, fields: List[Dict]):
+        """
+        Appends the enrichment attributes of completed fields (or delta entries) to the journal, if any.
+        """
+        if fields:
+            self._journal_enrichments(delta_enrichments(fields) if self.delta_responses else extract_enrichments(fields))
+
+
+
+    def _journal_enrichments(self, enrichments: Dict[str, Dict]):
+        """
+        Appends enrichment attributes, keyed by field path, to the journal, if any. Only
+        complete attributes are journaled (see `schema_paths.is_enriched`), so a resumed run
+        requests the incomplete fields again.
+        """
+        if self.journal is not None and enrichments:
+            enrichments = {path: attributes for path, attributes in enrichments.items() if is_enriched(attributes)}
+            if enrichments:
+                self.journal.append(enrichments, self._fingerprints)
+
+
+
+    def _bisect_chunk(self, chunk: List[Dict]) -> List[List[Dict]]:
+        """
+        Splits a chunk in two halves. A chunk with a single RECORD field is split
+        into two copies of the RECORD, each with half of the (nested) subfields.
+        Returns an empty list if the chunk is a single field that cannot be split.
+        """
+        if len(chunk) > 1:
+            middle = len(chunk) // 2
+            return [chunk[:middle], chunk[middle:]]
 
+        field = chunk[0]
+        halves = self._bisect_chunk(field["fields"]) if field.get("fields") else []
+        return [[dict(field, fields=half)] for half in halves]
+
+
+
+    @log_entry_exit
+    async def aprocess_chunk(self, chunk: List[Dict], fhir_resource: str = None, retries: int = 1,
+                             tier: int = None) -> List[Dict]:
+        """
+        Enriches a single chunk of schema fields, recovering from unparseable responses.
+
+        When the response cannot be parsed, the fields which were complete in the response
+        are kept, and the remaining fields are requested again. A chunk is retried once as
+        a whole, after that it is split in half, and every half is processed the same way,
+        down to single fields. One bad response therefore costs a few small calls, instead
+        of losing all fields of the chunk.
+
+        With a model router, the chunk is sent to the model tier matching its complexity,
+        and the retries of an invalid response escalate to the next tier.
+
+        Parameters:
+        - chunk (list): The schema fields to enrich.
+        - fhir_resource (str, optional): The resource named in the prompt.
+        - retries (int): The number of times the whole chunk is retried before bisecting.
+        - tier (int, optional): The routing tier of the model to use, by default the 
+          router picks the tier from the complexity of the chunk.
+
+        Returns:
+        - list: The enriched fields, in the order of the chunk. Fields for which no valid
+          response could be obtained are missing.
+        """
+        if self.llm_model is None:
+            logger.error(f"LLM model not found.")
+            return []
+
+        if self.router is not None and tier is None:
+            tier = self.router.route(chunk)
+
+        enriched_chunk, salvaged = await self._arequest_chunk(chunk, fhir_resource, tier)
+        if enriched_chunk is not None:
+            return enriched_chunk
+
+        # The response failed validation, retry on the next (stronger) model tier
+        if self.router is not None:
+            tier = self.router.escalated(tier)
+
+        # Keep the fields which were complete in the broken response
+        position = {field.get("name"): idx for idx, field in enumerate(chunk)}
+        salvaged = [field for field in salvaged if field.get("name") in position]
+        salvaged_names = {field.get("name") for field in salvaged}
+        remaining = [field for field in chunk if field.get("name") not in salvaged_names]
+        logger.info(f"Salvaged {len(salvaged)} fields from the response, {len(remaining)} fields remaining.")
+
+        if not remaining:
+            return salvaged
+
+        if retries > 0:
+            logger.info(f"Retrying {len(remaining)} fields...")
+            recovered = await self.aprocess_chunk(remaining, fhir_resource, retries - 1, tier)
+        else:
+            halves = self._bisect_chunk(remaining)
+            if not halves:
+                logger.error(f"Giving up on field '{remaining[0].get('name')}', no valid response from the LLM.")
+                return salvaged
+
+            logger.info(f"Bisecting {len(remaining)} fields into chunks of {len(halves[0])} and {len(halves[1])}...")
+            recovered = []
+            for half_result in await asyncio.gather(*(self.aprocess_chunk(half, fhir_resource, 0, tier) for half in halves)):
+                recovered.extend(half_result)
+
+        # Restore the order of the chunk, pieces of a split RECORD are merged later
+        return sorted(salvaged + recovered, key=lambda field: position.get(field.get("name"), len(position)))
+
+
+
+    def process_chunk(self, chunk: List[Dict]) -> List[Dict]:
+        """
+        Synchronous convenience wrapper around `aprocess_chunk`.
+        """
+        return asyncio.run(self.aprocess_chunk(chunk))
+
+
+
+    def _chunk_weight(self, fields: List[Dict]) -> int:
+        """
+        Returns the total number of fields in a chunk, including all nested subfields.
+        This is used as a cheap estimate of how long the LLM will take to process it.
+        """
+        weight = 0
+        for field in fields:
+            weight += 1 + self._chunk_weight(field.get("fields") or [])
+        return weight
+
+
+
+    @log_entry_exit
+    async def aenrich_chunks(self, chunks: List[List[Dict]], fhir_resource: str = None) -> List[Dict]:
+        """
+        Enriches all chunks concurrently, with at most `self.max_concurrency`
+        LLM requests in flight at any point in time.
+
+        The largest chunks are started first, since they take the longest to complete.
+        Starting them last would leave us waiting on a single long request at the 
+        end of the run. The results are always returned in the original field order,
+        independent of the order in which the chunks complete.
+
+        Parameters:
+        - chunks (list): The list of chunks, each chunk being a list of schema fields.
+        - fhir_resource (str, optional): The resource named in the prompt.
+
+        Returns:
+        - list: The enriched fields of all chunks, in the original order.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        # One result slot per chunk, so we can restore the original order
+        results = [[] for _ in chunks]
+
+        async def run_chunk(idx, chunk):
+            async with semaphore:
+                logger.info(f"Processing chunk {idx + 1}/{len(chunks)} ({len(chunk)} fields)...")
+                try:
+                    results[idx] = await self.aprocess_chunk(chunk, fhir_resource)
+                except Exception as e:
+                    logger.error(f"Exception occurred while processing chunk {idx + 1}: {e}")
+
+        # Order the chunks by weight, largest first. Tasks acquire the semaphore 
+        # in creation order, so this is also the order in which they are sent
+        schedule = sorted(range(len(chunks)), key=lambda i: self._chunk_weight(chunks[i]), reverse=True)
+        logger.info(f"Enriching {len(chunks)} chunks with a maximum concurrency of {self.max_concurrency}...")
+
+        await asyncio.gather(*(run_chunk(idx, chunks[idx]) for idx in schedule))
+
+        # Flatten the per-chunk results in the original chunk order
+        enriched_schema = []
+        for chunk_result in results:
+            enriched_schema.extend(chunk_result)
+
+        # Combine the pieces of RECORDs which were split over several chunks
+        return merge_split_records(enriched_schema)
+
+
+
+    def _missing_fields(self, fields: List[Dict], enrichments: Dict[str, Dict]) -> List[Dict]:
+        """
+        Returns the schema reduced to the fields without complete enrichment attributes 
+        (a description, PHI/PII and HIPAA) in `enrichments`, with their parent RECORDs 
+        as context, see `_prune_known_fields`.
+        """
+        def lookup(path, field):
+            attributes = enrichments.get(path)
+            return attributes if attributes and is_enriched(attributes) else None
+
+        return self._prune_known_fields(fields, lookup, {})
+
+
+
+    @log_entry_exit
+    async def aenrich_schema(self, fields: List[Dict], fhir_resource: str = None, known: Dict = None) -> Dict[str, Dict]:
+        """
+        Enriches a schema with the LLM, and checks that every field came back.
+
+        The responses are reassembled by full field path: every returned field is looked up
+        in the path index of the requested schema, so the order in which chunks complete, or
+        fields appear in a response, does not matter. Paths that were not requested are 
+        dropped. Fields that are missing from the responses are requested again, on their 
+        own, up to MAX_REREQUEST_ROUNDS times.
+
+        Parameters:
+        - fields (list): The schema fields to enrich, RECORDs may be partial.
+        - fhir_resource (str, optional): The resource named in the prompt.
+        - known (dict, optional): The enrichment attributes that are already known, keyed by 
+          path, e.g. of RECORDs which are only sent along as context.
+
+        Returns:
+        - dict: The new enrichment attributes, keyed by full field path.
+        """
+        requested = index_by_path(fields)
+        known = known or {}
+        enrichments = {}
+
+        pending_schema = fields
+        for round_number in range(MAX_REREQUEST_ROUNDS + 1):
+            # Because of the potentially large size of the schemas, we use chunking here.
+            # The chunks are sized to fit the input and output token limits of the model.
+            schema_chunks = self.semantic_chunking(pending_schema)
+            logger.info(f"Split schema into {len(schema_chunks)} chunks...")
+
+            # Process the chunks concurrently, and place every returned field by its path
+            for path, attributes in extract_enrichments(await self.aenrich_chunks(schema_chunks, fhir_resource)).items():
+                if path not in requested:
+                    logger.warning(f"Ignoring field '{path}' returned by the LLM, it was not requested.")
+                    continue
+                enrichments[path] = attributes
+
+            # Completeness check: every requested field must have all enrichment attributes
+            available = {**known, **enrichments}
+            pending_schema = self._missing_fields(fields, available)
+            if not pending_schema:
+                break
+
+            missing_paths = [path for path in index_by_path(pending_schema)
+                             if not is_enriched(available.get(path) or {})]
+            if round_number == MAX_REREQUEST_ROUNDS:
+                logger.error(f"{len(missing_paths)} fields are still missing from the LLM responses: {missing_paths}")
+            else:
+                logger.warning(f"{len(missing_paths)} fields missing from the LLM responses, requesting them again: {missing_paths}")
+
+        return enrichments
 
 
 
@@ -316,37 +807,15 @@ class FHIRResourceManager:
     def generate_enriched_schema_with_semantic_chunking(self, json_schema):
         logger.info(f"Generating enriched schema for FHIR resource: {self._fhir_resource_name}")
 
-        combined_results = []
-
         try:
-            # Since we cannot retrieve the context window sie from the LLM model, we will use a 
-            # fixed size here
-            context_window_size = 8192
-            logger.info(f"Assuming a context window size of {context_window_size} tokens...")
-
             # Count the number of tokens in the document
             document_length_in_tokens = self.count_tokens(json.dumps(json_schema))
             logger.info(f"Document length in tokens: {document_length_in_tokens}")
-            
-            # Split the data into semantic chunks
-            chunks = self.semantic_chunking(json_schema, chunk_size=CHUNK_SIZE)
-            logger.info(f"Splitting schema into a total of {len(chunks)} chunks...")
-
-            # Process chunks in parallel and handle exceptions per future
-            with ThreadPoolExecutor(max_workers=4) as executor:
-                future_to_chunk = {executor.submit(self.process_chunk, chunk): chunk for chunk in chunks}
-
-                for future in as_completed(future_to_chunk):
-                    try:
-                        result = future.result()
-                        if result:
-                            logger.info(f"Chunk processed successfully.")
-                            parsed_result = json.loads(result)
-                            combined_results.extend(parsed_result.get("bennie", []))  # Combine 'bennie' arrays
-                        else:
-                            logger.warning(f"Empty result returned for chunk.")
-                    except Exception as e:
-                        logger.error(f"Exception occurred while processing chunk: {e}")
+
+            # Enrich the chunks concurrently, and reassemble the results by path
+            # in the order and nesting of the input schema
+            enrichments = asyncio.run(self.aenrich_schema(json_schema))
+            combined_results = merge_enrichments(json_schema, enrichments) if enrichments else None
 
             if combined_results:
                 return combined_results
@@ -360,80 +829,261 @@ class FHIRResourceManager:
 
     #============================================================================================================
 
-    @log_entry_exit  
-    def generate_enriched_schema(self, json_schema):
+    def _field_cache_key(self, path: str, field: Dict, template_hash: str) -> str:
         """
-        This methoid generates an enriched schema by adding column-level 
-        descriptionss for a given FHIR resource.
+        Returns the description cache key of a schema field.
+        """
+        return DescriptionCache.make_key(self.fhir_resource_name, path, field.get("type"),
+                                         field.get("mode"), self.model_name, template_hash)
+
+
+
+    def _cached_enrichments(self, path: str, field: Dict, template_hash: str) -> Dict:
+        """
+        Returns the cached enrichment attributes of a schema field, or None if they are 
+        missing or incomplete (see `schema_paths.is_enriched`).
+        """
+        attributes = self.cache.get(self._field_cache_key(path, field, template_hash))
+        return attributes if attributes and is_enriched(attributes) else None
+
+
+
+    def _prune_known_fields(self, fields: List[Dict], lookup, known: Dict, parent_path: str = "") -> List[Dict]:
+        """
+        Looks up every field with the `lookup` function (the description cache, or the
+        journal), and returns the schema reduced to the fields that still need to be 
+        enriched by the LLM.
+
+        A RECORD is kept when its own description is missing, or when any of its subfields
+        are missing. In the latter case the RECORD is sent along so the LLM has the context.
+
+        Parameters:
+        - fields (list): The list of schema fields.
+        - lookup: Function returning the known enrichment attributes of a (path, field), or None.
+        - known (dict): Receives the known enrichment attributes, keyed by field path.
+        - parent_path (str): The path of the parent field, empty for the top level.
+
+        Returns:
+        - list: The fields that were (partially) not known.
+        """
+        pruned = []
+        for field in fields:
+            path = join_path(parent_path, field.get("name", ""))
+
+            value = lookup(path, field)
+            if value is not None:
+                known[path] = value
+
+            missing_subfields = []
+            if field.get("fields"):
+                missing_subfields = self._prune_known_fields(field["fields"], lookup, known, path)
+
+            if value is None or missing_subfields:
+                pruned_field = {key: val for key, val in field.items() if key != "fields"}
+                if "fields" in field:
+                    pruned_field["fields"] = missing_subfields
+                pruned.append(pruned_field)
+
+        return pruned
+
+
+
+    def _prune_unchanged_fields(self, fields: List[Dict], previous_fingerprints: Dict, fingerprints: Dict,
+                                previous_enrichments: Dict, reused: Dict, parent_path: str = "",
+                                subtrees=None) -> List[Dict]:
+        """
+        Compares the fingerprints of the schema with those of the previous run, and returns
+        the schema reduced to the new or changed fields.
+
+        When the fingerprint of a RECORD is unchanged, its complete subtree is unchanged, 
+        and all descriptions of the subtree are carried forward without descending into it.
+        A field is only carried forward when the previous run produced all of its enrichment
+        attributes (the description, PHI/PII and HIPAA).
+
+        Parameters:
+        - fields (list): The list of schema fields.
+        - previous_fingerprints (dict): The fingerprints of the previous run, keyed by field path.
+        - fingerprints (dict): The fingerprints of the current schema, keyed by field path.
+        - previous_enrichments (dict): The enrichment attributes of the previous output schema.
+        - reused (dict): Receives the carried forward enrichment attributes, keyed by field path.
+        - parent_path (str): The path of the parent field, empty for the top level.
+        - subtrees (tuple, optional): The subtree ranges of the fingerprints, see `subtree_ranges`,
+          computed once by the top-level call.
+
+        Returns:
+        - list: The new or changed fields.
+        """
+        if subtrees is None:
+            subtrees = subtree_ranges(fingerprints)
+        paths, ranges = subtrees
+
+        pruned = []
+        for field in fields:
+            path = join_path(parent_path, field.get("name", ""))
+
+            # Unchanged subtree: carry forward all descriptions, if they are complete
+            if previous_fingerprints.get(path) == fingerprints[path]:
+                start, end = ranges[path]
+                subtree_paths = paths[start:end]
+                if all(is_enriched(previous_enrichments.get(sub_path, {})) for sub_path in subtree_paths):
+                    for sub_path in subtree_paths:
+                        reused[sub_path] = previous_enrichments[sub_path]
+                    continue
+
+            # Changed subtree: send the RECORD along, with only its changed subfields
+            pruned_field = {key: val for key, val in field.items() if key != "fields"}
+            if "fields" in field:
+                pruned_field["fields"] = self._prune_unchanged_fields(
+                    field["fields"], previous_fingerprints, fingerprints, previous_enrichments, reused, path,
+                    subtrees)
+            pruned.append(pruned_field)
+
+        return pruned
+
+
+
+    async def _aenrich_shared_fields(self, fields: List[Dict]) -> Dict[str, Dict]:
+        """
+        Enriches shared columns on behalf of all tables, see `SharedFieldRegistry`.
+        The prompt describes the columns generically, not for this table's resource.
+        """
+        return await self.aenrich_schema(fields, SHARED_FHIR_RESOURCE)
+
+
+
+    @log_entry_exit
+    async def agenerate_enriched_schema(self, json_schema, previous_schema=None, previous_fingerprints=None):
+        """
+        Asynchronous version of `generate_enriched_schema`, use this method when 
+        an event loop is already running.
 
         Args:
         - json_schema (dict): The JSON schema for the FHIR resource.
+        - previous_schema (list, optional): The enriched output schema of a previous run.
+        - previous_fingerprints (dict, optional): The fingerprints of the previous run's input schema.
 
         Returns:
         - list: The enriched schema with the column descriptions.
-        """
-
-        # We use the JSON Output Parser to extract the JSON array from the response
-        # Using this parser, we get very predictable results, and we do not have
-        # to worry about the structure of the response and extra "bits" emitted
-        # by the LLM model
-        parser = JsonOutputParser()
-        instructions = parser.get_format_instructions()
 
+        Raises:
+        - Exception: Any error of the enrichment, after logging it.
+        """
         logger.info(f"Generating enriched schema for fhir resource: {self._fhir_resource_name}")
 
         try:
-            # Define chunk size (e.g., process 10 fields at a time)
-            # Because of the potentially large size of the models, we decided to 
-            # use chunking here. This is a common practice when working with large
-            # models and large amounts of data. We can adjust the chunk size as needed, 
-            # but 10 is a good starting point.
-            chunk_size = 10
-            logger.info(f"Splitting schema into chunks of {chunk_size} fields...")
-            schema_chunks = [json_schema[i:i + chunk_size] for i in range(0, len(json_schema), chunk_size)]
-    
-
-            # Retrieve the appropriate prompt template from our prompt database
-            prompt_name = prompt_names.GENERATE_RESOURCE_SCHEMA_DESCRIPTIONS
-            prompt_template_str = read_prompt_template(prompt_name, "prompts")
-
-            # Set up the prompt template with the expected input variables                  
-            prompt_template = PromptTemplate(
-                input_variables=["input_json_schema", "fhir_resource", "character_length"],
-                template=prompt_template_str)
-
-            # Process each chunk
-            enriched_schema = []
-            for idx, chunk in enumerate(schema_chunks):
-                logger.info(f"Processing chunk {idx + 1}/{len(schema_chunks)}...")
-
-                # Format the prompt with the chunk
-                prompt = prompt_template.format(
-                                fhir_resource=self.fhir_resource_name, 
-                                character_length = CHARACTER_LIMIT,
-                                input_json_schema=json.dumps(chunk, indent=2))
-
-                # Create a message array containing the formatted prompt
-                messages = [HumanMessage(content=prompt)]
-                
-                # Send request to LLM
-                response = self.llm_model.invoke(input=messages).content
-
-                # Parse response and extend enriched schema
-                try:
-                    # Use the JSsonOutputParser to extract the JSON array from the response,
-                    # and add it to the enriched schema
-                    enriched_chunk = parser.parse(response)
-                    enriched_schema.extend(enriched_chunk)
-
-                except json.JSONDecodeError as e:
-                    logger.error(f"Error parsing JSON for chunk {idx + 1}. error:{e}")
+            # The enrichment attributes we do not need to ask the LLM for, keyed by path
+            reused = {}
+            pending_schema = json_schema
+            total_fields = len(index_by_path(json_schema))
+
+            # The fingerprints identify the input fields, for incremental mode and the journal
+            self._fingerprints = compute_fingerprints(json_schema)
+
+            # Incremental mode: carry forward the descriptions of unchanged subtrees
+            if previous_schema is not None and previous_fingerprints:
+                pending_schema = self._prune_unchanged_fields(
+                                    pending_schema, previous_fingerprints, self._fingerprints,
+                                    extract_enrichments(previous_schema), reused)
+                logger.info(f"Incremental mode: {len(reused)} of {total_fields} fields unchanged since the previous run.")
+
+            # Resume an interrupted run: the fields in the journal are already enriched
+            if self.journal is not None:
+                journaled = self.journal.load(self._fingerprints)
+                reused_before = len(reused)
+                pending_schema = self._prune_known_fields(
+                                    pending_schema, 
+                                    lambda path, field: journaled.get(path) if is_enriched(journaled.get(path) or {}) else None,
+                                    reused)
+                logger.info(f"{len(reused) - reused_before} fields resumed from the journal.")
+
+            # When caching is enabled, only the fields missing from the cache go to the LLM
+            if self.cache is not None:
+                template_hash = get_prompt_registry().get(self._chunk_prompt_name()).text_hash
+                reused_before = len(reused)
+                pending_schema = self._prune_known_fields(
+                                    pending_schema,
+                                    lambda path, field: self._cached_enrichments(path, field, template_hash),
+                                    reused)
+                logger.info(f"{len(reused) - reused_before} fields served from the description cache.")
+
+            # Shared columns are enriched once for all tables, and reused
+            fresh = {}
+            if self.shared_fields is not None:
+                shared = [field for field in pending_schema if self.shared_fields.is_shared(field)]
+                if shared:
+                    fresh.update(await self.shared_fields.aenrich(shared, self.model_name, self._aenrich_shared_fields))
+                    pending_schema = [field for field in pending_schema if field.get("name") not in fresh]
+                    logger.info(f"{len(fresh)} of {len(shared)} shared columns served by the shared column registry.")
+
+            if pending_schema:
+                logger.info(f"{len(index_by_path(pending_schema))} fields (including RECORD context) sent to the LLM.")
+
+                # Enrich the remaining fields, and request any fields the LLM dropped again
+                fresh.update(await self.aenrich_schema(pending_schema, known={**reused, **fresh}))
+
+            # Store the new, complete descriptions, for the paths that exist in the input schema
+            if self.cache is not None:
+                schema_index = index_by_path(json_schema)
+                self.cache.put_many({
+                    self._field_cache_key(path, schema_index[path], template_hash): attributes
+                    for path, attributes in fresh.items() if path in schema_index and is_enriched(attributes)
+                })
+
+            # Apply all descriptions to the input schema, which determines the order and nesting
+            enriched_schema = merge_enrichments(json_schema, {**reused, **fresh})
 
             logger.info("Creation of enriched schema completed successfully...")
             return enriched_schema
             
         except Exception as e:
             logger.error(f"Error generating schema with description for fhir resource: {self._fhir_resource_name}': {e}")
+            # Let the caller fail the table, so the output schema, the fingerprints and 
+            # the journal of a failed run are left untouched
+            raise
+
+
+
+    @log_entry_exit  
+    def generate_enriched_schema(self, json_schema, previous_schema=None, previous_fingerprints=None):
+        """
+        This methoid generates an enriched schema by adding column-level 
+        descriptionss for a given FHIR resource. The chunks are sent to the 
+        LLM concurrently, see `aenrich_chunks`.
+
+        When the output schema and fingerprints of a previous run are provided, only 
+        the new or changed fields are sent to the LLM (incremental mode).
+
+        Args:
+        - json_schema (dict): The JSON schema for the FHIR resource.
+        - previous_schema (list, optional): The enriched output schema of a previous run.
+        - previous_fingerprints (dict, optional): The fingerprints of the previous run's input schema.
+
+        Returns:
+        - list: The enriched schema with the column descriptions.
+        """
+        return asyncio.run(self.agenerate_enriched_schema(json_schema, previous_schema, previous_fingerprints))
+
+
+
+    def batch_prompts(self, json_schema) -> List[str]:
+        """
+        Returns every prompt a full run of the pipeline sends for this table: the table
+        description prompt, followed by the enrichment prompt of every chunk.
+
+        The prompts are built exactly as `agenerate_table_description` and `process_chunk` 
+        build them, so the responses of a provider batch job can be served back to the 
+        pipeline by prompt, see `batch_job.BatchResultsLLM`.
+
+        Parameters:
+        - json_schema (list): The JSON schema for the FHIR resource.
+
+        Returns:
+        - list: The list of prompts.
+        """
+        prompts = [self._build_table_description_prompt()]
+        prompts.extend(self._build_chunk_prompt(chunk) for chunk in self.semantic_chunking(json_schema))
+        logger.info(f"Prepared {len(prompts)} batch prompts for FHIR resource: {self._fhir_resource_name}")
+        return prompts
 
 
 
@@ -465,24 +1115,24 @@ class FHIRResourceManager:
         Returns:
             str: Comma-separated string of field definitions
         """
-        # Process each subfield recursively
-        subfield_sql_parts = []
-        for subfield in fields:
-            # Generate SQL for each subfield, including field name
-            subfield_sql = self.get_field_sql(subfield, include_name=True)
-            subfield_sql_parts.append(subfield_sql)
-        
-        # Join all parts with commas
-        return ", ".join(subfield_sql_parts)
+        return "".join(self.iter_struct_fields(fields))
+
+
+
+    def iter_struct_fields(self, fields: list):
+        """
+        Yields the fragments of the inner content of a STRUCT definition, see `build_struct_fields`.
+        """
+        yield from self._iter_nodes_sql(SchemaIR.from_fields(fields), ", ")
 
 
 
     def get_field_sql(self, field: dict, include_name: bool) -> str:
         """
-        Recursively generates BigQuery column/subfield definition.
+        Generates BigQuery column/subfield definition.
         
         Handles:
-        - Nested STRUCT fields via recursion
+        - Nested STRUCT fields
         - REPEATED mode (ARRAY<...>)
         - Description attachment via OPTIONS
         
@@ -493,41 +1143,68 @@ class FHIRResourceManager:
         Returns:
         A valid BigQuery DDL snippet for the field
         """
-        # Extract field metadata with defaults
-        name = field.get("name", "")
-        field_type = field.get("type", "").upper()
-        mode = field.get("mode", "NULLABLE").upper()
-        description = field.get("description", "")
-
-        # 1) Build base type: STRUCT<...> or scalar type
-        if field_type in ("RECORD", "STRUCT"):
-            # Handle nested fields 
-            nested_fields = field.get("fields", [])
-            struct_inner = self.build_struct_fields(nested_fields)
-            base_type = f"STRUCT<{struct_inner}>"
-        else:
-            # Default to STRING if type is missing
-            base_type = field_type if field_type else "STRING"
+        return "".join(self.iter_field_sql(field, include_name))
+
 
-        # 2) Wrap in ARRAY if mode is REPEATED
-        if mode == "REPEATED":
-            base_type = f"ARRAY<{base_type}>"
 
-        # 3) Conditionally add field name
-        definition = f"{name} {base_type}" if include_name else base_type
+    def iter_field_sql(self, field: dict, include_name: bool):
+        """
+        Yields the fragments of the BigQuery column/subfield definition, see `get_field_sql`.
+        """
+        yield from self._iter_nodes_sql(SchemaIR.from_fields([field]), "", include_name)
 
-        # 4) Add description if available
-        if description:
-            escaped_desc = self.escape_description(description)
-            definition += f" OPTIONS(description='{escaped_desc}')"
 
-        return definition
+
+    def _iter_nodes_sql(self, schema_ir: SchemaIR, separator: str, include_name: bool = True):
+        """
+        Yields the fragments of the column definitions of a compiled schema. The nested
+        fields are yielded as the schema is walked, so a wide STRUCT is never built as 
+        a single string, and deeply nested schemas need no recursion.
+
+        Parameters:
+        - schema_ir (SchemaIR): The compiled schema.
+        - separator (str): The separator of the top-level column definitions.
+        - include_name (bool): Whether to prepend the name of the top-level fields, the
+          nested fields of a STRUCT are always named.
+        """
+        for node, entering in schema_ir.events():
+            if entering:
+                # Separate the field from its previous sibling
+                if node.sibling_index:
+                    yield separator if node.parent < 0 else ", "
+
+                # 1) Conditionally add field name
+                if include_name or node.parent >= 0:
+                    yield f"{node.name} "
+
+                # 2) Wrap in ARRAY if mode is REPEATED
+                if node.mode == "REPEATED":
+                    yield "ARRAY<"
+
+                # 3) Build base type: STRUCT<...> (closed after the nested fields) or 
+                # scalar type, defaulting to STRING if the type is missing
+                if node.is_record:
+                    yield "STRUCT<"
+                    continue
+                yield node.type or "STRING"
+
+            else:
+                # The nested fields of the STRUCT are complete
+                yield ">"
+
+            if node.mode == "REPEATED":
+                yield ">"
+
+            # 4) Add description if available
+            if node.description:
+                escaped_desc = self.escape_description(node.description)
+                yield f" OPTIONS(description='{escaped_desc}')"
+
 
 
-        
     def filter_empty_structs(self, schema: list) -> list:
         """
-        Recursively remove any RECORD fields that have no subfields.
+        Remove any RECORD fields that have no subfields, at any depth.
         This is necessary because BigQuery does not allow empty STRUCTs.
         
         Args:
@@ -536,31 +1213,17 @@ class FHIRResourceManager:
         Returns:
             list: The filtered schema with empty structs removed.
         """
-        filtered = []
-        for field in schema:
-            field_type = field.get("type", "").upper()
-            
-            # Check if the field is a nested structure (RECORD or STRUCT)
-            if field_type in ("RECORD", "STRUCT"):
-                # Get the subfields, defaulting to an empty list
-                subfields = field.get("fields", [])
-                
-                # Recursively filter the subfields first
-                # This handles nested structs with potentially empty subfields
-                subfields = self.filter_empty_structs(subfields)
-                
-                # If there are subfields after filtering, keep the field
-                if subfields:
-                    field["fields"] = subfields
-                    filtered.append(field)
-                else:
-                    # If no subfields remain, skip this struct
-                    print(f"Skipping empty struct field: {field['name']}")
-            else:
-                # For non-struct fields, keep them as-is
-                filtered.append(field)
-        
-        return filtered
+        schema_ir = SchemaIR.from_fields(schema)
+        removed = schema_ir.prune_empty_records()
+        for node in removed:
+            print(f"Skipping empty struct field: {node.name}")
+
+        # Keep the remaining subfields of every RECORD
+        for node in schema_ir:
+            if node.is_record:
+                node.field["fields"] = [child.field for child in schema_ir.children(node)]
+
+        return [node.field for node in schema_ir.children()]
 
 
 
@@ -575,7 +1238,7 @@ class FHIRResourceManager:
         full_table_name : str
             The fully-qualified table name, e.g. "project.dataset.table"
         schema : list
-            A list of field dictionaries (the JSON schema).
+            A list of field dictionaries (the JSON schema), or the compiled `SchemaIR`.
         table_description : str
             Description for the table itself.
 
@@ -584,27 +1247,32 @@ class FHIRResourceManager:
         str
             The complete CREATE OR REPLACE TABLE statement.
         """
-        # Build a comma-separated list of column definitions
-        fields_sql = ",\n  ".join(self.get_field_sql(field, include_name=True) for field in schema)
+        return "".join(self.iter_create_table_sql(schema, table_description))
+
+
 
-        # Generate CREATE TABLE statement
-        create_stmt = f"CREATE OR REPLACE TABLE `{self.full_table_name}` (\n  {fields_sql}\n)"
+    def iter_create_table_sql(self, schema: list, table_description: str = ""):
+        """
+        Yields the fragments of the CREATE OR REPLACE TABLE statement, see `generate_create_table_sql`.
+        """
+        # Generate CREATE TABLE statement, with a comma-separated list of column definitions
+        yield f"CREATE OR REPLACE TABLE `{self.full_table_name}` (\n  "
+        yield from self._iter_nodes_sql(as_schema_ir(schema), ",\n  ")
+        yield "\n)"
 
         # Optionally add the table-level description
         if table_description:
             escaped_table_desc = self.escape_description(table_description)
-            create_stmt += f"\nOPTIONS(description=\"{escaped_table_desc}\");"
+            yield f"\nOPTIONS(description=\"{escaped_table_desc}\");"
         else:
-            create_stmt += ";"
-
-        return create_stmt
+            yield ";"
 
 
 
     @log_entry_exit
-    def generate_alter_table_sql(self, schema, table_description=""):
+    def generate_alter_table_sql(self, schema, table_description="", baseline_schema=None):
         """
-        Generates up to TWO BigQuery ALTER TABLE statements:
+        Generates the BigQuery ALTER TABLE statements:
 
         1) Table-level description (if provided):
                 ALTER TABLE `project.dataset.table`
@@ -612,22 +1280,69 @@ class FHIRResourceManager:
             
             Ends with a semicolon (no trailing comma).
 
-        2) A single statement for any top-level columns that need new descriptions:
+        2) One or more statements for any top-level columns that need new descriptions:
                 ALTER TABLE `project.dataset.table`
                 ALTER COLUMN col1 SET OPTIONS(description="..."),
                 ALTER COLUMN col2 SET OPTIONS(description="...");
             
             Each column update ends with a comma except the last one, 
-            and then the statement ends with a semicolon.
+            and then the statement ends with a semicolon. A new statement is started
+            whenever the "max_statement_bytes" or "max_clauses" limit would be exceeded,
+            see `alter_limits`.
 
         BigQuery does not allow altering nested (RECORD/STRUCT) fields, so we skip them.
+
+        When a baseline schema is provided (the live table schema, or the output schema 
+        of a previous run), only the columns whose description differs from the baseline 
+        are altered.
         
         Returns:
             str
-                One or two ALTER TABLE statements, each ending with a semicolon, 
-                separated by a newline if both exist.
+                The ALTER TABLE statements, each ending with a semicolon, separated by 
+                a newline. Every statement can be applied on its own, in any order.
+        """
+        return "\n".join(self.iter_alter_table_statements(schema, table_description, baseline_schema))
+
+
+
+    def generate_alter_table_statements(self, schema, table_description="", baseline_schema=None) -> List[str]:
         """
-        statements = []
+        Returns the ALTER TABLE statements as a list, see `generate_alter_table_sql`. 
+        The statements are independent, so they can be applied one by one or in parallel.
+        """
+        return list(self.iter_alter_table_statements(schema, table_description, baseline_schema))
+
+
+
+    def iter_alter_table_sql(self, schema, table_description="", baseline_schema=None):
+        """
+        Yields the fragments of the ALTER TABLE statements, see `generate_alter_table_sql`.
+        """
+        statements = self.iter_alter_table_statements(schema, table_description, baseline_schema)
+        for index, statement in enumerate(statements):
+            if index:
+                yield "\n"
+            yield statement
+
+
+
+    def iter_alter_table_statements(self, schema, table_description="", baseline_schema=None):
+        """
+        Yields the ALTER TABLE statements one by one, see `generate_alter_table_sql`.
+        The number of clauses and bytes of every statement are logged, and stored in
+        `alter_batches`. The number of columns skipped because their description equals
+        the baseline is stored in `alter_skipped`.
+        """
+        self.alter_batches = []
+        self.alter_skipped = 0
+
+        # The current descriptions of the top-level columns, if we know them
+        baseline_descriptions = None
+        if baseline_schema is not None:
+            baseline_descriptions = {field.get("name"): field.get("description") or ""
+                                     for field in baseline_schema if field.get("name")}
+        max_statement_bytes = int(self.alter_limits["max_statement_bytes"])
+        max_clauses = max(1, int(self.alter_limits["max_clauses"]))
 
         # ----- 1) Table-level description as its own statement -----
         if table_description:
@@ -637,24 +1352,42 @@ class FHIRResourceManager:
                 .replace("\"", "\\\"")
             )
             # Single statement, ends with semicolon, no trailing commas
-            stmt_table_desc = (
+            yield (
                 f'ALTER TABLE `{self.full_table_name}`\n'
                 f'  SET OPTIONS(description="{escaped_table_desc}");'
             )
-            statements.append(stmt_table_desc)
 
-        # ----- 2) Gather column-level statements in a single ALTER TABLE -----
+        # ----- 2) Gather column-level clauses in size-bounded ALTER TABLE statements -----
+        header = f'ALTER TABLE `{self.full_table_name}`\n  '
+        separator = ",\n  "
+        header_bytes = len(header.encode("utf-8")) + len(";")
+        separator_bytes = len(separator.encode("utf-8"))
+
         column_ops = []
-        for field in schema:
-            name = field.get("name", "")
+        statement_bytes = header_bytes
+
+        def flush():
+            statement = header + separator.join(column_ops) + ";"
+            self.alter_batches.append({"clauses": len(column_ops), "bytes": statement_bytes})
+            logger.info(f"ALTER TABLE statement {len(self.alter_batches)} for '{self.full_table_name}': "
+                        f"{len(column_ops)} column clauses, {statement_bytes} bytes.")
+            return statement
+
+        # Only the top-level columns are altered, the nested fields are not compiled
+        for node in as_schema_ir(schema, max_depth=0).children():
+            name = node.name
             if not name:
                 continue
 
-            field_type = (field.get("type") or "").upper()
-            description = field.get("description", "")
+            description = node.description
 
             # Skip nested fields (RECORD/STRUCT)
-            if field_type in ("RECORD", "STRUCT"):
+            if node.is_record:
+                continue
+
+            # Only alter the columns whose description differs from the baseline
+            if description and baseline_descriptions is not None and baseline_descriptions.get(name) == description:
+                self.alter_skipped += 1
                 continue
 
             # If there's a description for a top-level column, prepare a sub-clause
@@ -664,37 +1397,35 @@ class FHIRResourceManager:
                     .replace("\\", "\\\\")
                     .replace("\"", "\\\"")
                 )
-                column_ops.append(
-                    f'ALTER COLUMN {name} SET OPTIONS (description="{escaped_desc}")'
-                )
+                clause = f'ALTER COLUMN {name} SET OPTIONS (description="{escaped_desc}")'
+                clause_bytes = len(clause.encode("utf-8")) + (separator_bytes if column_ops else 0)
 
-        # Only generate the second statement if we have any column_ops
-        if column_ops:
-            # Join column_ops with commas, and the final entry ends the line (no trailing comma)
-            if len(column_ops) == 1:
-                # Just one column => no comma needed
-                clauses_str = column_ops[0]
-            else:
-                # Multiple columns => separate sub-clauses with commas
-                # Each clause is on its own line
-                clauses_str = ",\n  ".join(column_ops)
+                # Start a new statement when this clause would exceed the limits
+                if column_ops and (statement_bytes + clause_bytes > max_statement_bytes 
+                                   or len(column_ops) >= max_clauses):
+                    yield flush()
+                    column_ops = []
+                    statement_bytes = header_bytes
+                    clause_bytes -= separator_bytes
 
-            stmt_column_desc = (
-                f'ALTER TABLE `{self.full_table_name}`\n'
-                f'  {clauses_str};'
-            )
-            statements.append(stmt_column_desc)
-
-        # Join both statements (if present) with a newline
-        return "\n".join(statements)
+                if header_bytes + clause_bytes > max_statement_bytes:
+                    logger.warning(f"The ALTER COLUMN clause of '{name}' alone exceeds {max_statement_bytes} bytes.")
 
+                column_ops.append(clause)
+                statement_bytes += clause_bytes
 
+        # Only generate the last statement if we have any column_ops left
+        if column_ops:
+            yield flush()
 
+        if baseline_descriptions is not None:
+            logger.info(f"Skipped {self.alter_skipped} columns of '{self.full_table_name}' whose description "
+                        f"equals the baseline schema.")
 
 
 
     @log_entry_exit
-    def generate_sql(self, json_schema, table_description, mode):
+    def generate_sql(self, json_schema, table_description, mode, baseline_schema=None):
         """
         Generates a CREATE TABLE or ALTER TABLE SQL statement based on the 
         provided schema and the passed-in mode
@@ -703,25 +1434,49 @@ class FHIRResourceManager:
             - json_schema (dict): The JSON schema for the FHIR resource.
             - table_description (str): The description for the table.
             - mode (str): The mode to use, either "create" or "alter".
+            - baseline_schema (list, optional): The current schema of the table, either
+              fetched with `BigQuerySchemaManager.get_table_schema(format="JSON")` or the 
+              output schema of a previous run. In "alter" mode, only the columns whose 
+              description differs from the baseline are altered.
 
         returns:
             - str: The generated SQL statement. 
         """
 
-        # First, we clean the schema by removing any empty structs, 
-        # which are not allowed in BigQuery
-        cleaned_schema = self.filter_empty_structs(json_schema)
+        return "".join(self.iter_sql(json_schema, table_description, mode, baseline_schema))
 
-        # Check the mode, and generate the appropriate SQL
-        if mode == "alter":
-            return self.generate_alter_table_sql(cleaned_schema, table_description)
-        
 
-        elif mode == "create":
-            return self.generate_create_table_sql(cleaned_schema, table_description)
 
-        else:
+    def iter_sql(self, json_schema, table_description, mode, baseline_schema=None):
+        """
+        Yields the fragments of the CREATE TABLE or ALTER TABLE SQL statement, see
+        `generate_sql`. Pass the fragments to `sql_writer.write_sql` to stream the 
+        statement to a file, without building it in memory.
+
+        Raises:
+            - ValueError: If the mode is neither "create" nor "alter".
+        """
+        # Check the mode before the caller starts consuming the fragments
+        if mode not in ("alter", "create"):
             raise ValueError(f"Invalid mode specified: {mode}")
+
+        return self._iter_sql(json_schema, table_description, mode, baseline_schema)
+
+
+
+    def _iter_sql(self, json_schema, table_description, mode, baseline_schema=None):
+        # First, we compile the schema once, and clean it by removing any 
+        # empty structs, which are not allowed in BigQuery
+        cleaned_schema = as_schema_ir(json_schema)
+        removed = cleaned_schema.prune_empty_records()
+        for node in removed:
+            logger.info(f"Skipping empty struct field: {node.path}")
+
+        # Check the mode, and generate the appropriate SQL
+        if mode == "alter":
+            yield from self.iter_alter_table_sql(cleaned_schema, table_description, baseline_schema)
+        else:
+            yield from self.iter_create_table_sql(cleaned_schema, table_description)
         
     
     
\ No newline at end of file
@@ -0,0 +1,258 @@
+import os
+import json
+import asyncio
+from typing import Dict, List
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+
+from logger_setup import logger, log_entry_exit
+from modules.llm_cassette import prompt_hash
+
+# The request formats of the provider batch APIs
+OPENAI_FORMAT = "openai"
+GEMINI_FORMAT = "gemini"
+
+# The endpoint of the OpenAI batch requests
+OPENAI_BATCH_URL = "/v1/chat/completions"
+
+# The length of the request IDs, a prefix of the SHA-256 of the model name and prompt
+REQUEST_ID_LENGTH = 32
+
+
+def request_format(model_name: str) -> str:
+    """
+    Returns the batch request format of a model, Gemini for the Gemini models and
+    OpenAI for all other models (including the fake backend).
+    """
+    return GEMINI_FORMAT if "gemini" in (model_name or "").lower() else OPENAI_FORMAT
+
+
+
+def request_id(model_name: str, prompt) -> str:
+    """
+    Returns the stable ID of a batch request. The ID only depends on the model and the
+    prompt, so the same prompt gets the same ID in the prepare and the ingest phase.
+    """
+    return prompt_hash(model_name, prompt)[:REQUEST_ID_LENGTH]
+
+
+
+def build_request(model_name: str, prompt: str) -> Dict:
+    """
+    Builds a single line of a batch request file, in the format of the model's provider.
+
+    Parameters:
+    - model_name (str): The name of the LLM model.
+    - prompt (str): The prompt, sent as a single user message.
+
+    Returns:
+    - dict: The batch request.
+    """
+    custom_id = request_id(model_name, prompt)
+    if request_format(model_name) == GEMINI_FORMAT:
+        # The model of a Gemini batch job is set on the job, not on every request
+        return {"key": custom_id,
+                "request": {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}}
+
+    return {"custom_id": custom_id, "method": "POST", "url": OPENAI_BATCH_URL,
+            "body": {"model": model_name, "messages": [{"role": "user", "content": prompt}]}}
+
+
+
+def _request_prompt(request: Dict) -> str:
+    """
+    Returns the prompt of a batch request, in either format.
+    """
+    if "request" in request:
+        return "".join(part.get("text", "") for content in request["request"]["contents"]
+                       for part in content.get("parts", []))
+    return "".join(message["content"] for message in request["body"]["messages"])
+
+
+
+@log_entry_exit
+def write_batch_requests(requests: List[Dict], output_path: str) -> int:
+    """
+    Writes the batch requests to a JSONL file, one request per line. A prompt shared by
+    several tables (e.g. the same FHIR resource in two datasets) is only written once.
+
+    Parameters:
+    - requests (list): The batch requests, see `build_request`.
+    - output_path (str): The location of the JSONL batch request file.
+
+    Returns:
+    - int: The number of requests written.
+    """
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    written = set()
+    with open(output_path, "w", encoding="utf-8") as f:
+        for request in requests:
+            custom_id = request.get("custom_id") or request.get("key")
+            if custom_id in written:
+                continue
+            written.add(custom_id)
+            f.write(json.dumps(request) + "\n")
+
+    logger.info(f"Wrote {len(written)} batch requests to: '{output_path}'")
+    return len(written)
+
+
+
+def _result_text(result: Dict):
+    """
+    Returns the response text of a single line of a batch result file, or None
+    if the request failed. Both the OpenAI and the Gemini format are supported.
+    """
+    if result.get("error"):
+        return None
+
+    response = result.get("response") or {}
+
+    # OpenAI: {"custom_id", "response": {"status_code", "body": {"choices": [...]}}}
+    if "body" in response:
+        if response.get("status_code", 200) != 200:
+            return None
+        choices = response["body"].get("choices") or []
+        return choices[0]["message"]["content"] if choices else None
+
+    # Gemini: {"key", "response": {"candidates": [{"content": {"parts": [...]}}]}}
+    candidates = response.get("candidates") or []
+    if candidates:
+        return "".join(part.get("text", "") for part in candidates[0].get("content", {}).get("parts", []))
+    return None
+
+
+
+@log_entry_exit
+def read_batch_results(results_path: str) -> Dict[str, str]:
+    """
+    Reads a JSONL batch result file, as downloaded from the provider.
+
+    Parameters:
+    - results_path (str): The location of the JSONL batch result file.
+
+    Returns:
+    - dict: The response text of every successful request, keyed by request ID.
+    """
+    results, failed = {}, 0
+    with open(results_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            text = _result_text(result)
+            if text is None:
+                failed += 1
+                continue
+            results[result.get("custom_id") or result.get("key")] = text
+
+    logger.info(f"Read {len(results)} batch results from '{results_path}', {failed} requests failed.")
+    return results
+
+
+
+def _build_result(request: Dict, text: str = None, error: str = None) -> Dict:
+    """
+    Builds a single line of a batch result file, in the format of the request.
+    """
+    if "key" in request:
+        response = {"candidates": [{"content": {"parts": [{"text": text}]}}]}
+        return {"key": request["key"], "response": None if error else response,
+                "error": {"message": error} if error else None}
+
+    response = {"status_code": 200, "body": {"choices": [{"message": {"content": text}}]}}
+    return {"custom_id": request["custom_id"], "response": None if error else response,
+            "error": {"message": error} if error else None}
+
+
+
+@log_entry_exit
+def answer_batch_requests(requests_path: str, results_path: str, get_model, default_model: str = None) -> int:
+    """
+    Answers a batch request file locally, one request after the other, and writes the
+    result file in the format the provider would return. Together with the fake backend
+    (a "fake://" model) this allows testing both phases of a batch job offline.
+
+    Parameters:
+    - requests_path (str): The location of the JSONL batch request file.
+    - results_path (str): The location of the JSONL batch result file to write.
+    - get_model (callable): Returns the LLM instance for a model name.
+    - default_model (str, optional): The model of the requests without a model, the
+      Gemini requests leave the model to the batch job.
+
+    Returns:
+    - int: The number of requests answered.
+    """
+    with open(requests_path, "r", encoding="utf-8") as f:
+        requests = [json.loads(line) for line in f if line.strip()]
+
+    failed = 0
+    with open(results_path, "w", encoding="utf-8") as f:
+        for request in requests:
+            model_name = request.get("body", {}).get("model") or default_model
+            try:
+                message = get_model(model_name).invoke([HumanMessage(content=_request_prompt(request))])
+                result = _build_result(request, text=str(message.content))
+            except Exception as e:
+                failed += 1
+                result = _build_result(request, error=str(e) or type(e).__name__)
+            f.write(json.dumps(result) + "\n")
+
+    logger.info(f"Answered {len(requests)} batch requests ({failed} failed), results written to: '{results_path}'")
+    return len(requests)
+
+
+
+class BatchResultMissingError(LookupError):
+    """
+    Raised in the ingest phase when the batch results have no response for a prompt.
+    """
+
+
+
+class BatchResultsLLM:
+    """
+    Serves the responses of a completed provider batch job to the pipeline, in place of
+    a LangChain chat model. Every prompt is looked up by its request ID, so the pipeline
+    runs exactly as it does online: the same parsing, merging and SQL generation.
+
+    A prompt that was not part of the batch job (e.g. the retry of a chunk whose response
+    could not be parsed) raises a BatchResultMissingError, which the pipeline handles as
+    a failed LLM call.
+    """
+
+    def __init__(self, results: Dict[str, str], model_name: str):
+        """
+        Initializes the BatchResultsLLM instance.
+
+        Parameters:
+        - results (dict): The response texts keyed by request ID, see `read_batch_results`.
+        - model_name (str): The name of the model, part of the request ID.
+        """
+        self.results = results
+        self.model_name = model_name
+
+
+
+    def _result(self, input) -> str:
+        key = request_id(self.model_name, input)
+        if key not in self.results:
+            raise BatchResultMissingError(f"No batch result for request {key}.")
+        return self.results[key]
+
+
+
+    async def ainvoke(self, input, *args, **kwargs):
+        return AIMessage(content=self._result(input))
+
+
+
+    async def astream(self, input, *args, **kwargs):
+        yield AIMessageChunk(content=self._result(input))
+
+
+
+    def invoke(self, input, *args, **kwargs):
+        return asyncio.run(self.ainvoke(input, *args, **kwargs))
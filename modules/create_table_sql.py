@@ -1,4 +1,5 @@
 import json
+from modules.schema_ir import as_schema_ir, load_schema_ir
 
 # Function to map BigQuery types to SQL-compatible types
 def map_bq_type(bq_type):
@@ -29,31 +30,38 @@ def escape_description(description):
 
 
 
-# Recursive function to process schema fields
+# Function to process schema fields, walking the compiled schema without recursion
 def process_fields(fields, indent=2):
-    sql_lines = []
-    
-    for field in fields:
-        field_name = field["name"]
-        field_type = map_bq_type(field["type"])
-        field_mode = field.get("mode", "NULLABLE")
-        field_description = escape_description(field.get("description", ""))
+    schema_ir = as_schema_ir(fields)
+    sql_parts = []
+
+    for node, entering in schema_ir.events():
+        padding = ' ' * (indent + 2 * node.depth)
+
+        # Handle nested RECORD types, the STRUCT is closed after its nested fields
+        is_struct = node.is_record and node.has_fields
+        if not entering:
+            if is_struct:
+                sql_parts.append(f"\n{padding}>")
+            continue
+
+        if node.sibling_index:
+            sql_parts.append(",\n")
 
-        # Handle nested RECORD types
-        if field_type == "RECORD" and "fields" in field:
-            nested_fields = process_fields(field["fields"], indent + 2)
-            sql_lines.append(f"{' ' * indent}{field_name} STRUCT<\n{nested_fields}\n{' ' * indent}>")
+        if is_struct:
+            sql_parts.append(f"{padding}{node.name} STRUCT<\n")
         else:
-            nullable = "NOT NULL" if field_mode == "REQUIRED" else ""
+            field_type = map_bq_type(node.type)
+            field_description = escape_description(node.description)
+            nullable = "NOT NULL" if node.mode == "REQUIRED" else ""
             options_clause = f" OPTIONS(description=\"{field_description}\")" if field_description else ""
-            sql_lines.append(f"{' ' * indent}{field_name} {field_type} {nullable}{options_clause}")
+            sql_parts.append(f"{padding}{node.name} {field_type} {nullable}{options_clause}")
     
-    return ",\n".join(sql_lines)
+    return "".join(sql_parts)
 
 # Function to generate CREATE TABLE SQL statement
 def generate_create_table_sql(schema_path, table_name):
-    with open(schema_path, "r") as file:
-        schema = json.load(file)
+    schema = load_schema_ir(schema_path)
 
     sql_fields = process_fields(schema)
     create_table_sql = f"""
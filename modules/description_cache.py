@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from logger_setup import logger
+
+# The defaults used when the YAML 'cache' section does not specify them
+DEFAULT_CACHE_PATH = ".cache/descriptions.sqlite"
+DEFAULT_CACHE_MAX_SIZE_MB = 256
+
+
+def hash_text(text: str) -> str:
+    """
+    Returns the SHA-256 hex digest of a string, used to fingerprint prompt templates.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+
+class DescriptionCache:
+    """
+    A persistent, content-addressed cache of LLM generated descriptions, stored in SQLite.
+
+    The key of an entry is derived from everything that influences the generated
+    description: the FHIR resource, the full field path, the field type and mode, the
+    model name and a hash of the prompt template. Changing any of these results in a
+    cache miss, so stale descriptions are never served.
+
+    When the total size of the stored values exceeds the configured maximum, the least
+    recently used entries are evicted. The cache can be shared between threads and
+    asyncio tasks.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_size_mb=DEFAULT_CACHE_MAX_SIZE_MB):
+        """
+        Initializes the DescriptionCache instance, and creates the database if needed.
+
+        Parameters:
+        - path (str): The location of the SQLite database file.
+        - max_size_mb (float): The maximum size of the cached values, in megabytes.
+        """
+        self.path = path
+        self.max_size_bytes = int(float(max_size_mb) * 1024 * 1024)
+
+        # The hit and miss counters, reported at the end of the run
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # A single connection, guarded by a lock, is shared by all threads
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS descriptions ("
+            "  key TEXT PRIMARY KEY,"
+            "  value TEXT NOT NULL,"
+            "  size INTEGER NOT NULL,"
+            "  last_access REAL NOT NULL)")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS descriptions_last_access ON descriptions (last_access)")
+        self._connection.commit()
+
+        logger.info(f"Description cache opened at '{path}' (max {max_size_mb} MB).")
+
+
+
+    @staticmethod
+    def make_key(fhir_resource, field_path, field_type, mode, model_name, template_hash) -> str:
+        """
+        Builds the content-addressed key of a cache entry.
+
+        Parameters:
+        - fhir_resource (str): The FHIR resource name, e.g. "encounters".
+        - field_path (str): The full path of the field, empty for the table description.
+        - field_type (str): The BigQuery type of the field.
+        - mode (str): The BigQuery mode of the field.
+        - model_name (str): The name of the LLM model generating the description.
+        - template_hash (str): The hash of the prompt template, see `hash_text`.
+
+        Returns:
+        - str: The key of the cache entry.
+        """
+        key_parts = [fhir_resource, field_path, (field_type or "").upper(),
+                     (mode or "NULLABLE").upper(), model_name or "", template_hash]
+        return hash_text(json.dumps(key_parts))
+
+
+
+    def get(self, key):
+        """
+        Returns the cached value for a key, or None if the key is not in the cache.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM descriptions WHERE key = ?", (key,)).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._connection.execute(
+                "UPDATE descriptions SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+
+        return json.loads(row[0])
+
+
+
+    def put(self, key, value):
+        """
+        Stores a JSON serializable value in the cache, evicting old entries if needed.
+        """
+        self.put_many({key: value})
+
+
+
+    def put_many(self, items: dict):
+        """
+        Stores several JSON serializable values in a single transaction.
+        """
+        if not items:
+            return
+
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            serialized = json.dumps(value)
+            rows.append((key, serialized, len(serialized.encode("utf-8")), now))
+
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO descriptions (key, value, size, last_access) VALUES (?, ?, ?, ?)", rows)
+            self._evict()
+            self._connection.commit()
+
+
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the cache fits its maximum size.
+        Must be called with the lock held.
+        """
+        total_size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM descriptions").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+
+        evicted = 0
+        cursor = self._connection.execute("SELECT key, size FROM descriptions ORDER BY last_access")
+        keys_to_evict = []
+        for key, size in cursor:
+            if total_size <= self.max_size_bytes:
+                break
+            keys_to_evict.append((key,))
+            total_size -= size
+            evicted += 1
+
+        self._connection.executemany("DELETE FROM descriptions WHERE key = ?", keys_to_evict)
+        logger.info(f"Evicted {evicted} entries from the description cache.")
+
+
+
+    def log_stats(self):
+        """
+        Logs the number of hits and misses, and the hit rate.
+        """
+        lookups = self.hits + self.misses
+        hit_rate = (100.0 * self.hits / lookups) if lookups else 0.0
+        logger.info(f"Description cache: {self.hits} hits, {self.misses} misses, "
+                    f"hit rate {hit_rate:.1f}%, miss rate {100.0 - hit_rate if lookups else 0.0:.1f}%.")
+
+
+
+    def close(self):
+        """
+        Closes the underlying database connection.
+        """
+        with self._lock:
+            self._connection.close()
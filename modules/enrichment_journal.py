@@ -0,0 +1,101 @@
+import os
+import json
+import threading
+from typing import Dict
+
+from logger_setup import logger, log_entry_exit
+
+
+def get_journal_path(output_schema_path: str) -> str:
+    """
+    Returns the location of the journal stored alongside an output schema,
+    e.g. "fhir/hde_encounters_enriched.journal.jsonl".
+    """
+    root, _ = os.path.splitext(output_schema_path)
+    return f"{root}.journal.jsonl"
+
+
+
+class EnrichmentJournal:
+    """
+    An append-only JSONL journal of the fields enriched during a run.
+
+    Every line holds the enrichment attributes of a single field path, together with
+    the fingerprint of the input field they were generated for. The journal is written
+    as soon as fields complete, so a run that dies halfway can be restarted, and resumes
+    from the journal instead of sending every field to the LLM again. Entries whose
+    fingerprint no longer matches the input schema are ignored on resume.
+    """
+
+    def __init__(self, path: str):
+        """
+        Initializes the EnrichmentJournal instance.
+
+        Parameters:
+        - path (str): The location of the JSONL journal file.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+
+
+    @log_entry_exit
+    def load(self, fingerprints: Dict[str, str]) -> Dict[str, Dict]:
+        """
+        Loads the entries of a previous, interrupted run.
+
+        Parameters:
+        - fingerprints (dict): The fingerprints of the current input schema, keyed by path.
+
+        Returns:
+        - dict: The journaled enrichment attributes that are still valid, keyed by path.
+        """
+        if not os.path.isfile(self.path):
+            return {}
+
+        enrichments = {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be incomplete if the run was killed while writing it
+                    continue
+
+                if fingerprints.get(entry.get("path")) == entry.get("fingerprint"):
+                    enrichments[entry["path"]] = entry["attributes"]
+
+        logger.info(f"Resuming from journal '{self.path}': {len(enrichments)} fields already enriched.")
+        return enrichments
+
+
+
+    def append(self, enrichments: Dict[str, Dict], fingerprints: Dict[str, str]):
+        """
+        Appends enrichment attributes to the journal, and flushes them to disk.
+
+        Parameters:
+        - enrichments (dict): The enrichment attributes, keyed by field path.
+        - fingerprints (dict): The fingerprints of the current input schema, keyed by path.
+          Paths which do not exist in the input schema are not journaled.
+        """
+        lines = [json.dumps({"path": path, "fingerprint": fingerprints[path], "attributes": attributes}) + "\n"
+                 for path, attributes in enrichments.items() if path in fingerprints]
+        if not lines:
+            return
+
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(lines)
+                f.flush()
+
+
+
+    @log_entry_exit
+    def remove(self):
+        """
+        Removes the journal, called once the enriched schema has been saved.
+        """
+        with self._lock:
+            if os.path.isfile(self.path):
+                os.remove(self.path)
@@ -0,0 +1,237 @@
+import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from urllib.parse import urlparse, parse_qs
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+from logger_setup import logger
+
+# The prefix of the model names handled by the fake backend, e.g.
+# "fake://load-test?latency_ms=800&jitter_ms=300&throttle_rate=0.05"
+FAKE_MODEL_PREFIX = "fake://"
+
+# The settings of the fake backend, set through the query string of the model name
+DEFAULT_FAKE_SETTINGS = {
+    "latency_ms":        200.0,      # The mean latency of a call
+    "jitter_ms":         50.0,       # The spread of the latency (standard deviation, or half width)
+    "distribution":      "normal",   # fixed, uniform, normal or lognormal
+    "tokens_per_second": 0.0,        # The simulated generation speed, 0 disables it
+    "error_rate":        0.0,        # The fraction of calls failing with a server error
+    "throttle_rate":     0.0,        # The fraction of calls failing with a 429 quota error
+    "truncate_rate":     0.0,        # The fraction of responses cut off halfway
+    "seed":              0,
+}
+
+# Rough number of characters per token, used to simulate the generation speed
+CHARS_PER_TOKEN = 4
+
+# The size of the pieces a streamed response is split into
+STREAM_PIECE_CHARACTERS = 64
+
+# Field names which the fake backend flags as PHI/PII and HIPAA relevant
+SENSITIVE_NAME_PARTS = ("patient", "name", "birth", "address", "phone", "email", "ssn", "mrn", "identifier")
+
+_decoder = json.JSONDecoder()
+
+
+def is_fake_model(model_name: str) -> bool:
+    return (model_name or "").startswith(FAKE_MODEL_PREFIX)
+
+
+
+def parse_fake_model(model_name: str) -> dict:
+    """
+    Returns the settings of the fake backend encoded in a "fake://" model name.
+    """
+    settings = dict(DEFAULT_FAKE_SETTINGS)
+    for key, values in parse_qs(urlparse(model_name).query).items():
+        if key not in settings:
+            raise ValueError(f"Unknown setting '{key}' in fake model '{model_name}'.")
+        settings[key] = type(DEFAULT_FAKE_SETTINGS[key])(values[-1])
+    return settings
+
+
+
+class FakeServerError(Exception):
+    """
+    The error raised for injected server errors.
+    """
+    status_code = 500
+
+
+
+class FakeRateLimitError(Exception):
+    """
+    The error raised for injected quota errors, recognized by `rate_limiter.is_throttle_error`.
+    """
+    status_code = 429
+
+
+
+def _walk(fields, parent_path=""):
+    for field in fields:
+        path = f"{parent_path}.{field.get('name', '')}" if parent_path else field.get("name", "")
+        yield path, field
+        yield from _walk(field.get("fields") or [], path)
+
+
+
+def _describe(path: str, character_limit: int) -> dict:
+    """
+    Returns deterministic enrichment attributes for a field path.
+    """
+    sensitive = any(part in path.lower() for part in SENSITIVE_NAME_PARTS)
+    description = (f"The '{path}' field of the FHIR resource. Generated offline by the fake LLM backend, "
+                   f"this description only depends on the field path.")
+    return {"description": description[:character_limit], "PHI/PII": sensitive, "HIPAA": sensitive}
+
+
+
+class FakeChatModel:
+    """
+    A deterministic, offline stand-in for a LangChain chat model, used to load test the
+    pipeline without network access or API quota.
+
+    Enrichment prompts (any prompt with a "**FHIR Schema:**" section) are answered with
+    a schema-valid response, echoing the schema or returning delta entries, depending on
+    the prompt. Any other prompt gets a short table description. Latency, server errors,
+    429 quota errors and truncated responses are injected according to the settings.
+
+    The injected behaviour only depends on the seed, the prompt, and how often the same
+    prompt was sent before, so runs are reproducible independent of the concurrency.
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.settings = parse_fake_model(model_name)
+        self._attempts = {}
+        self._lock = threading.Lock()
+        logger.info(f"Using the fake LLM backend with settings {self.settings}")
+
+
+
+    def _rng(self, prompt: str) -> random.Random:
+        """
+        Returns the random generator of this call, seeded by the prompt and its attempt number.
+        """
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        with self._lock:
+            attempt = self._attempts.get(digest, 0)
+            self._attempts[digest] = attempt + 1
+        return random.Random(f"{self.settings['seed']}:{digest}:{attempt}")
+
+
+
+    def _latency(self, rng: random.Random, response: str) -> float:
+        """
+        Returns the simulated latency of a call, in seconds.
+        """
+        mean = self.settings["latency_ms"] / 1000.0
+        jitter = self.settings["jitter_ms"] / 1000.0
+        distribution = self.settings["distribution"]
+
+        if distribution == "uniform":
+            latency = rng.uniform(mean - jitter, mean + jitter)
+        elif distribution == "normal":
+            latency = rng.gauss(mean, jitter)
+        elif distribution == "lognormal":
+            # The median is the mean latency, the jitter widens the long tail
+            latency = mean * rng.lognormvariate(0.0, jitter / mean if mean else 0.0)
+        else:
+            latency = mean
+
+        if self.settings["tokens_per_second"] > 0:
+            latency += len(response) / CHARS_PER_TOKEN / self.settings["tokens_per_second"]
+
+        return max(0.0, latency)
+
+
+
+    def _respond(self, prompt: str) -> str:
+        """
+        Builds the response to a prompt.
+        """
+        marker = prompt.find("**FHIR Schema:**")
+        if marker < 0:
+            return "A FHIR resource table, described offline by the fake LLM backend."
+
+        schema_start = prompt.find("[", marker)
+        fields, _ = _decoder.raw_decode(prompt, schema_start)
+
+        # The character limit is the first number after "Limit the description to"
+        character_limit = 1024
+        limit_marker = prompt.find("Limit the description to ")
+        if limit_marker >= 0:
+            digits = prompt[limit_marker + len("Limit the description to "):].split(" ", 1)[0]
+            character_limit = int(digits) if digits.isdigit() else character_limit
+
+        # Delta prompts ask for {path, description, phi_pii, hipaa} entries
+        if '"phi_pii"' in prompt:
+            entries = []
+            for path, _ in _walk(fields):
+                attributes = _describe(path, character_limit)
+                entries.append({"path": path, "description": attributes["description"],
+                                "phi_pii": attributes["PHI/PII"], "hipaa": attributes["HIPAA"]})
+            return json.dumps(entries, indent=2)
+
+        for path, field in _walk(fields):
+            field.update(_describe(path, character_limit))
+        return json.dumps(fields, indent=2)
+
+
+
+    def _prepare(self, input):
+        """
+        Returns the response and latency of a call, or raises the injected error.
+        """
+        prompt = input if isinstance(input, str) else "".join(str(getattr(message, "content", message))
+                                                              for message in input)
+        rng = self._rng(prompt)
+        response = self._respond(prompt)
+        latency = self._latency(rng, response)
+
+        draw = rng.random()
+        if draw < self.settings["throttle_rate"]:
+            return None, latency / 10, FakeRateLimitError("429 RESOURCE_EXHAUSTED: fake quota exceeded")
+        draw -= self.settings["throttle_rate"]
+        if draw < self.settings["error_rate"]:
+            return None, latency, FakeServerError("500 fake server error")
+
+        if rng.random() < self.settings["truncate_rate"]:
+            response = response[:len(response) // 2]
+
+        return response, latency, None
+
+
+
+    async def ainvoke(self, input, *args, **kwargs):
+        response, latency, error = self._prepare(input)
+        await asyncio.sleep(latency)
+        if error is not None:
+            raise error
+        return AIMessage(content=response)
+
+
+
+    async def astream(self, input, *args, **kwargs):
+        response, latency, error = self._prepare(input)
+        if error is not None:
+            await asyncio.sleep(latency)
+            raise error
+
+        pieces = [response[i:i + STREAM_PIECE_CHARACTERS] for i in range(0, len(response), STREAM_PIECE_CHARACTERS)]
+        for piece in pieces:
+            await asyncio.sleep(latency / max(1, len(pieces)))
+            yield AIMessageChunk(content=piece)
+
+
+
+    def invoke(self, input, *args, **kwargs):
+        response, latency, error = self._prepare(input)
+        time.sleep(latency)
+        if error is not None:
+            raise error
+        return AIMessage(content=response)
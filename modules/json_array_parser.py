@@ -0,0 +1,157 @@
+import json
+from typing import Dict, List
+
+_decoder = json.JSONDecoder()
+
+
+def strip_code_fences(text: str) -> str:
+    """
+    Removes the markdown code fences (e.g. ```json ... ```) the LLM may wrap its response in.
+    """
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        if text.rstrip().endswith("```"):
+            text = text.rstrip()[:-3]
+    return text.strip()
+
+
+
+def parse_json_response(text: str):
+    """
+    Parses a complete JSON response strictly. Unlike a lenient parser, a truncated or
+    malformed response is rejected instead of repaired, so its incomplete last field
+    is never mistaken for an answer.
+
+    Parameters:
+    - text (str): The raw LLM response, possibly wrapped in markdown code fences.
+
+    Returns:
+    - The parsed JSON value.
+
+    Raises:
+    - json.JSONDecodeError: If the response is not a single complete JSON value.
+    """
+    return json.loads(strip_code_fences(text))
+
+
+
+def salvage_json_array(text: str) -> List[Dict]:
+    """
+    Extracts the complete elements of a (possibly truncated or malformed) JSON array.
+
+    The LLM response is scanned from the first '[', and every element that decodes
+    as a complete JSON value is kept. Scanning stops at the first element that cannot
+    be decoded, e.g. because the response was cut off in the middle of it.
+
+    Parameters:
+    - text (str): The raw LLM response, possibly wrapped in markdown code fences.
+
+    Returns:
+    - list: The complete dictionary elements found before the first broken element.
+    """
+    start = text.find("[")
+    if start < 0:
+        return []
+
+    elements = []
+    position = start + 1
+    while True:
+        # Skip whitespace and the separators between the elements
+        while position < len(text) and text[position] in " \t\r\n,":
+            position += 1
+
+        if position >= len(text) or text[position] == "]":
+            break
+
+        try:
+            element, position = _decoder.raw_decode(text, position)
+        except json.JSONDecodeError:
+            break
+
+        if isinstance(element, dict):
+            elements.append(element)
+
+    return elements
+
+
+
+class IncrementalJsonArrayParser:
+    """
+    Parses a JSON array while it is being streamed, emitting every element as soon as
+    it is complete.
+
+    Text before the opening '[' (e.g. a markdown code fence) is ignored. The parser only
+    tracks the nesting depth and string state of the top-level elements, every complete
+    element is decoded exactly once, so the total work is linear in the response size.
+    """
+
+    def __init__(self):
+        self._buffer = []
+        self._in_array = False
+        self._done = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+
+
+    def feed(self, text: str) -> List[Dict]:
+        """
+        Feeds the next piece of the streamed response to the parser.
+
+        Parameters:
+        - text (str): The next piece of the response.
+
+        Returns:
+        - list: The dictionary elements completed by this piece, in order.
+        """
+        completed = []
+
+        for char in text:
+            if self._done:
+                break
+
+            if not self._in_array:
+                self._in_array = char == "["
+                continue
+
+            if self._depth == 0:
+                # Between two elements, only the start of a new element matters
+                if char in "{[":
+                    self._depth = 1
+                    self._buffer = [char]
+                elif char == "]":
+                    self._done = True
+                continue
+
+            self._buffer.append(char)
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    element = self._decode("".join(self._buffer))
+                    if isinstance(element, dict):
+                        completed.append(element)
+
+        return completed
+
+
+
+    @staticmethod
+    def _decode(text: str):
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            return None
@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from typing import Dict, List
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+from logger_setup import logger, log_entry_exit
+
+# The cassette modes: record the responses of the real model, or replay them
+RECORD_MODE = "record"
+REPLAY_MODE = "replay"
+
+# The replay latency: the latency measured while recording, or none at all
+RECORDED_LATENCY = "recorded"
+NO_LATENCY = "none"
+
+# The size of the pieces a replayed response is streamed in
+STREAM_PIECE_CHARACTERS = 64
+
+
+def _prompt_text(input) -> str:
+    """
+    Returns the text content of a prompt, either a string or a list of messages.
+    """
+    if isinstance(input, str):
+        return input
+    return "".join(str(getattr(message, "content", message)) for message in input)
+
+
+
+def prompt_hash(model_name: str, input) -> str:
+    """
+    Returns the key of a call in the cassette, the SHA-256 of the model name and prompt.
+    """
+    return hashlib.sha256(f"{model_name}\n{_prompt_text(input)}".encode("utf-8")).hexdigest()
+
+
+
+class CassetteMissError(LookupError):
+    """
+    Raised in replay mode when the cassette has no response for a prompt.
+    """
+
+
+
+class Cassette:
+    """
+    A JSONL file of recorded LLM calls, one line per call with the prompt hash,
+    the model, the response and the measured latency.
+
+    A prompt may have been recorded several times (e.g. a retry of the same chunk),
+    its responses are replayed in the recorded order, repeating the last one.
+    """
+
+    def __init__(self, path: str):
+        """
+        Initializes the Cassette instance, and loads the recorded calls if the file exists.
+
+        Parameters:
+        - path (str): The location of the JSONL cassette file.
+        """
+        self.path = path
+        self._calls: Dict[str, List[Dict]] = {}
+        self._replayed: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        call = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line may be incomplete if a recording was killed
+                        continue
+                    self._calls.setdefault(call["prompt_hash"], []).append(call)
+            logger.info(f"Loaded {sum(len(calls) for calls in self._calls.values())} recorded calls from cassette '{path}'.")
+
+
+
+    def record(self, key: str, model_name: str, response: str, latency_seconds: float):
+        """
+        Appends a call to the cassette file.
+        """
+        call = {"prompt_hash": key, "model": model_name, "response": response,
+                "latency_seconds": round(latency_seconds, 4)}
+        with self._lock:
+            self._calls.setdefault(key, []).append(call)
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(call) + "\n")
+
+
+
+    def replay(self, key: str) -> Dict:
+        """
+        Returns the next recorded call for a prompt hash.
+
+        Raises:
+        - CassetteMissError: If the prompt was never recorded.
+        """
+        with self._lock:
+            calls = self._calls.get(key)
+            if not calls:
+                raise CassetteMissError(f"No recorded response for prompt {key[:12]} in cassette '{self.path}'.")
+            index = self._replayed.get(key, 0)
+            self._replayed[key] = index + 1
+            return calls[min(index, len(calls) - 1)]
+
+
+
+    def rewind(self):
+        """
+        Restarts the replay of every prompt at its first recorded response, so a run
+        repeated in the same process replays the same sequence of responses.
+        """
+        with self._lock:
+            self._replayed.clear()
+
+
+
+# The cassettes are loaded once per process, and shared by all models and tables
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+@log_entry_exit
+def get_cassette(path: str) -> Cassette:
+    """
+    Returns the process-wide cassette stored at `path`, loading it on first use.
+    """
+    with _cassettes_lock:
+        if path not in _cassettes:
+            _cassettes[path] = Cassette(path)
+        return _cassettes[path]
+
+
+
+class CassetteLLM:
+    """
+    Wraps a LangChain chat model, and records its calls to a cassette, or replays them.
+
+    In record mode every call is sent to the wrapped model, and the response and the
+    measured latency are appended to the cassette. In replay mode the wrapped model is
+    not needed at all, the responses are served from the cassette with the recorded
+    latency, or immediately. This allows benchmarking the rest of the pipeline against
+    the same real model outputs, without calling the model again.
+    """
+
+    def __init__(self, llm, model_name: str, cassette: Cassette, mode: str = REPLAY_MODE,
+                 replay_latency: str = RECORDED_LATENCY):
+        """
+        Initializes the CassetteLLM instance.
+
+        Parameters:
+        - llm: The LangChain chat model to wrap, may be None in replay mode.
+        - model_name (str): The name of the model, part of the prompt hash.
+        - cassette (Cassette): The cassette to record to, or replay from.
+        - mode (str): Either "record" or "replay".
+        - replay_latency (str): Either "recorded" or "none".
+        """
+        if mode not in (RECORD_MODE, REPLAY_MODE):
+            raise ValueError(f"Unknown cassette mode '{mode}', expected '{RECORD_MODE}' or '{REPLAY_MODE}'.")
+        if replay_latency not in (RECORDED_LATENCY, NO_LATENCY):
+            raise ValueError(f"Unknown replay latency '{replay_latency}', expected '{RECORDED_LATENCY}' or '{NO_LATENCY}'.")
+        if mode == RECORD_MODE and llm is None:
+            raise ValueError("A model is required to record a cassette.")
+
+        self.llm = llm
+        self.model_name = model_name
+        self.cassette = cassette
+        self.mode = mode
+        self.replay_latency = replay_latency
+
+
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the wrapper itself
+        if self.llm is None:
+            raise AttributeError(name)
+        return getattr(self.llm, name)
+
+
+
+    def _replay(self, input):
+        call = self.cassette.replay(prompt_hash(self.model_name, input))
+        latency = call["latency_seconds"] if self.replay_latency == RECORDED_LATENCY else 0.0
+        return call["response"], latency
+
+
+
+    async def ainvoke(self, input, *args, **kwargs):
+        if self.mode == REPLAY_MODE:
+            response, latency = self._replay(input)
+            await asyncio.sleep(latency)
+            return AIMessage(content=response)
+
+        start_time = time.perf_counter()
+        message = await self.llm.ainvoke(input, *args, **kwargs)
+        self.cassette.record(prompt_hash(self.model_name, input), self.model_name,
+                             str(message.content), time.perf_counter() - start_time)
+        return message
+
+
+
+    async def astream(self, input, *args, **kwargs):
+        if self.mode == REPLAY_MODE:
+            response, latency = self._replay(input)
+            pieces = [response[i:i + STREAM_PIECE_CHARACTERS] for i in range(0, len(response), STREAM_PIECE_CHARACTERS)]
+            for piece in pieces:
+                await asyncio.sleep(latency / max(1, len(pieces)))
+                yield AIMessageChunk(content=piece)
+            return
+
+        start_time = time.perf_counter()
+        pieces = []
+        async for message_chunk in self.llm.astream(input, *args, **kwargs):
+            pieces.append(str(message_chunk.content))
+            yield message_chunk
+        self.cassette.record(prompt_hash(self.model_name, input), self.model_name,
+                             "".join(pieces), time.perf_counter() - start_time)
+
+
+
+    def invoke(self, input, *args, **kwargs):
+        return asyncio.run(self.ainvoke(input, *args, **kwargs))
@@ -1,3 +1,6 @@
+import hashlib
+import itertools
+import threading
 from langchain.prompts import PromptTemplate
 from langchain_openai.chat_models import ChatOpenAI
 from langchain_google_genai import ChatGoogleGenerativeAI
@@ -5,43 +8,208 @@ from langchain.output_parsers import PydanticOutputParser
 
 # from modules.ColumnInfo import ColumnInfo
 from logger_setup import logger, log_entry_exit
+from modules import tokenizer
+from modules.fake_llm import FakeChatModel, is_fake_model
+
+
+# The context window and maximum number of output tokens of the models we use.
+# The lookup is done on the prefix of the model name, the longest prefix wins,
+# so "gemini-2.0-flash-001" matches "gemini-2.0-flash".
+MODEL_TOKEN_LIMITS = {
+    "gpt-4o":           {"context_window": 128000,  "max_output_tokens": 16384},
+    "gpt-4-turbo":      {"context_window": 128000,  "max_output_tokens": 4096},
+    "gpt-4":            {"context_window": 8192,    "max_output_tokens": 4096},
+    "gpt-3.5-turbo":    {"context_window": 16385,   "max_output_tokens": 4096},
+    "gemini-2.0-flash": {"context_window": 1048576, "max_output_tokens": 8192},
+    "gemini-1.5-pro":   {"context_window": 2097152, "max_output_tokens": 8192},
+    "gemini-1.5-flash": {"context_window": 1048576, "max_output_tokens": 8192},
+}
+
+# Used for models we do not know about
+DEFAULT_TOKEN_LIMITS = {"context_window": 8192, "max_output_tokens": 4096}
+
+
+def get_model_token_limits(model_name, context_window=None, max_output_tokens=None):
+    """
+    Returns the context window and maximum number of output tokens for a model.
+
+    Parameters:
+    - model_name (str): The name of the LLM model.
+    - context_window (int, optional): Overrides the context window of the model.
+    - max_output_tokens (int, optional): Overrides the maximum output tokens of the model.
+
+    Returns:
+    - dict: A dictionary with the "context_window" and "max_output_tokens" keys.
+    """
+    limits = DEFAULT_TOKEN_LIMITS
+
+    # Find the longest known prefix of the model name
+    model_name = (model_name or "").lower()
+    matches = [prefix for prefix in MODEL_TOKEN_LIMITS if model_name.startswith(prefix)]
+    if matches:
+        limits = MODEL_TOKEN_LIMITS[max(matches, key=len)]
+    else:
+        logger.warning(f"No token limits known for model '{model_name}', using the defaults: {limits}")
+
+    limits = dict(limits)
+    if context_window:
+        limits["context_window"] = int(context_window)
+    if max_output_tokens:
+        limits["max_output_tokens"] = int(max_output_tokens)
+
+    return limits
+
+
+
+def count_tokens(text: str, model="gpt-4") -> int:
+    """
+    Counts the number of tokens in the given text, see `tokenizer.count_tokens`.
+
+    Parameters:
+        text (str): The input text.
+        model (str): The LLM model being used.
+
+    Returns:
+        int: Token count of the input text.
+    """
+    return tokenizer.count_tokens(text, model)
+
+
+
+# The default timeout of a single LLM request, and the number of retries the client
+# performs on connection errors. Both can be overridden in the YAML 'llm' section
+DEFAULT_REQUEST_TIMEOUT_SECONDS = 120
+DEFAULT_CLIENT_MAX_RETRIES = 2
+
+
+class RoundRobinLLM:
+    """
+    Spreads the calls to a model over several clients, one per API key, in round-robin
+    order. This raises the aggregate throughput when every key has its own quota.
+
+    All other attributes are delegated to the first client.
+    """
+
+    def __init__(self, clients):
+        self.clients = list(clients)
+        self._next = itertools.cycle(self.clients)
+        self._lock = threading.Lock()
+
+
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the wrapper itself
+        return getattr(self.clients[0], name)
+
+
+
+    def _next_client(self):
+        with self._lock:
+            return next(self._next)
+
+
+
+    async def ainvoke(self, input, *args, **kwargs):
+        return await self._next_client().ainvoke(input, *args, **kwargs)
+
+
+
+    async def astream(self, input, *args, **kwargs):
+        async for message_chunk in self._next_client().astream(input, *args, **kwargs):
+            yield message_chunk
+
+
+
+    def invoke(self, input, *args, **kwargs):
+        return self._next_client().invoke(input, *args, **kwargs)
+
+
+
+# The LLM clients are created once per (provider, model, key, settings), and shared by
+# all tables, chunks and threads of the process. Every client keeps its own HTTP (OpenAI)
+# or gRPC (Gemini) connection pool alive, so reusing it reuses the warm connections.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _create_client(model_name, api_key, timeout, max_retries):
+    """
+    Creates a single LangChain chat model client.
+    """
+    if is_fake_model(model_name):
+        return FakeChatModel(model_name)
+
+    if "gemini" in model_name.lower():
+        logger.info(f"Using Google Generative AI model: {model_name}")
+        kwargs = {"google_api_key": api_key} if api_key else {}
+        return ChatGoogleGenerativeAI(model=model_name, temperature=0.0, timeout=timeout, 
+                                      max_retries=max_retries, **kwargs)
+
+    logger.info(f"Using OpenAI Chat model: {model_name}")
+    kwargs = {"api_key": api_key} if api_key else {}
+    return ChatOpenAI(model=model_name, temperature=0.0, timeout=timeout, max_retries=max_retries, **kwargs)
+
+
+
+def get_client(model_name, api_key=None, timeout=DEFAULT_REQUEST_TIMEOUT_SECONDS,
+               max_retries=DEFAULT_CLIENT_MAX_RETRIES):
+    """
+    Returns the process-wide client of a model and API key, creating it on first use.
+
+    Parameters:
+    - model_name (str): The name of the LLM model.
+    - api_key (str, optional): The API key, defaults to the key in the environment.
+    - timeout (float): The timeout of a single request, in seconds.
+    - max_retries (int): The number of retries the client performs on connection errors.
+
+    Returns:
+    - An instance of either ChatGoogleGenerativeAI or ChatOpenAI.
+    """
+    provider = "fake" if is_fake_model(model_name) else "google" if "gemini" in model_name.lower() else "openai"
+
+    # Never keep the API key itself in the registry key
+    key_id = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12] if api_key else None
+    client_key = (provider, model_name, key_id, timeout, max_retries)
+
+    with _clients_lock:
+        if client_key not in _clients:
+            _clients[client_key] = _create_client(model_name, api_key, timeout, max_retries)
+        return _clients[client_key]
+
 
 
 # Function to initialize the LangChain LLM (Language Learning Model)
 @log_entry_exit  # Decorator for logging function entry and exit
-def get_llm(model_name):
+def get_llm(model_name, api_keys=None, timeout=DEFAULT_REQUEST_TIMEOUT_SECONDS,
+            max_retries=DEFAULT_CLIENT_MAX_RETRIES):
     """
-    Initializes and returns an appropriate LangChain LLM model based on the provided model name.
+    Returns the shared LangChain LLM model for the provided model name.
     
     Parameters:
     - model_name (str): The name of the LLM model to be used.
+    - api_keys (list, optional): The API keys to spread the calls over. Defaults to
+      the key in the environment (OPENAI_API_KEY or GOOGLE_API_KEY).
+    - timeout (float): The timeout of a single request, in seconds.
+    - max_retries (int): The number of retries the client performs on connection errors.
     
     Returns:
-    - An instance of either ChatGoogleGenerativeAI or ChatOpenAI, depending on the model name.
+    - An instance of either ChatGoogleGenerativeAI or ChatOpenAI, depending on the model name,
+      or a RoundRobinLLM over one such instance per API key.
     
     Behavior:
+    - If the model name starts with "fake://", it initializes the offline fake backend, 
+      see `fake_llm.FakeChatModel`.
     - If the model name contains "gemini" (case-insensitive), it initializes a Google Gemini model.
     - Otherwise, it defaults to an OpenAI Chat model.
-    - Both models are initialized with:
-      - `temperature=0.0` (ensuring deterministic output)
-      - `max_tokens=15000` (limiting response length)
+    - Both models are initialized with `temperature=0.0` (ensuring deterministic output).
+    - The clients are created once per process, see `get_client`.
     """
+    api_keys = [api_key for api_key in (api_keys or []) if api_key]
+    if len(api_keys) <= 1:
+        return get_client(model_name, api_keys[0] if api_keys else None, timeout, max_retries)
 
-    # Check if the model name contains "gemini" (case insensitive)
-    if "gemini" in model_name.lower():
-        
-        # Initialize Google Gemini LLM
-        logger.info(f"Using Google Generative AI model: {model_name}")
-        llm = ChatGoogleGenerativeAI(model=model_name, temperature=0.0) 
-
-        if llm is None:
-            raise ValueError(f"Google Generative AI model '{model_name}' not found.")
-        return ChatGoogleGenerativeAI(model=model_name, temperature=0.0)
-    else:
-    
-        # Default to OpenAI Chat model
-        logger.info(f"Using OpenAI Chat model: {model_name}")
-        return ChatOpenAI(model=model_name, temperature=0.0)
+    logger.info(f"Spreading the calls to model '{model_name}' over {len(api_keys)} API keys.")
+    return RoundRobinLLM(get_client(model_name, api_key, timeout, max_retries) for api_key in api_keys)
 
 
 
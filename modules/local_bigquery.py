@@ -0,0 +1,117 @@
+import os
+import json
+import threading
+from typing import Dict, List
+from google.cloud import bigquery
+
+from logger_setup import logger
+
+
+class LocalTable:
+    """
+    The table metadata returned by the LocalBigQueryClient, with the attributes of a
+    `bigquery.Table` the pipeline uses.
+    """
+
+    def __init__(self, project: str, dataset_id: str, table_id: str, schema: List, description: str = None):
+        self.project = project
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+        self.schema = schema
+        self.description = description
+
+
+
+class LocalBigQueryClient:
+    """
+    A local stand-in for `bigquery.Client`, used to test the BigQuery metadata calls 
+    (listing tables, reading and patching their schema) without a GCP project.
+
+    Every table is a JSON file in the directory, named "<project>.<dataset>.<table>.json",
+    holding the "schema" fields (in the API format) and the "description" of the table.
+    The number of metadata update calls is counted in `update_calls`.
+    """
+
+    def __init__(self, directory: str, project: str = None):
+        """
+        Initializes the LocalBigQueryClient instance.
+
+        Parameters:
+        - directory (str): The directory holding the table files.
+        - project (str, optional): The default project, as for `bigquery.Client`.
+        """
+        self.directory = directory
+        self.project = project
+        self.update_calls = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+
+
+    def _path(self, table_ref: str) -> str:
+        return os.path.join(self.directory, f"{table_ref}.json")
+
+
+
+    def put_table(self, table_ref: str, schema_fields: List[Dict], description: str = None):
+        """
+        Creates or replaces a table, used to set up a test.
+
+        Parameters:
+        - table_ref (str): The table, in the format "project.dataset.table".
+        - schema_fields (list): The schema fields, in the API format.
+        - description (str, optional): The description of the table.
+        """
+        with open(self._path(table_ref), "w", encoding="utf-8") as f:
+            json.dump({"schema": schema_fields, "description": description}, f, indent=2)
+
+
+
+    def list_tables(self, dataset: str) -> List[LocalTable]:
+        prefix = f"{dataset}."
+        tables = []
+        for file_name in sorted(os.listdir(self.directory)):
+            if file_name.startswith(prefix) and file_name.endswith(".json"):
+                tables.append(self.get_table(file_name[:-len(".json")]))
+        return tables
+
+
+
+    def get_table(self, table_ref: str) -> LocalTable:
+        """
+        Raises:
+        - LookupError: If the table does not exist.
+        """
+        path = self._path(table_ref)
+        if not os.path.isfile(path):
+            raise LookupError(f"Not found: Table {table_ref}")
+
+        with open(path, "r", encoding="utf-8") as f:
+            resource = json.load(f)
+
+        project, dataset_id, table_id = table_ref.split(".", 2)
+        schema = [bigquery.SchemaField.from_api_repr(field) for field in resource["schema"]]
+        return LocalTable(project, dataset_id, table_id, schema, resource.get("description"))
+
+
+
+    def update_table(self, table: LocalTable, fields: List[str]) -> LocalTable:
+        """
+        Updates the given properties ("schema", "description") of a table in one call.
+        """
+        table_ref = f"{table.project}.{table.dataset_id}.{table.table_id}"
+        with self._lock:
+            self.update_calls += 1
+            with open(self._path(table_ref), "r", encoding="utf-8") as f:
+                resource = json.load(f)
+
+            if "schema" in fields:
+                resource["schema"] = [field.to_api_repr() for field in table.schema]
+            if "description" in fields:
+                resource["description"] = table.description
+
+            with open(self._path(table_ref), "w", encoding="utf-8") as f:
+                json.dump(resource, f, indent=2)
+
+        logger.info(f"Updated {fields} of local table '{table_ref}'.")
+        return self.get_table(table_ref)
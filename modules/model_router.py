@@ -0,0 +1,126 @@
+from typing import Dict, List
+
+from logger_setup import logger
+
+# Field names which say little about their meaning without their context. Chunks
+# with many of them need a stronger model to produce meaningful descriptions
+GENERIC_FIELD_NAMES = {
+    "code", "data", "display", "end", "extension", "id", "period", "reference",
+    "start", "status", "system", "text", "type", "url", "use", "value",
+}
+
+# Names up to this length are usually abbreviations (e.g. "edm", "los")
+ABBREVIATION_MAX_LENGTH = 3
+
+# The weights of the components of the complexity score
+DEPTH_WEIGHT = 2
+AMBIGUITY_WEIGHT = 1
+FIELDS_PER_POINT = 25
+
+
+def _walk(fields: List[Dict], depth: int = 1):
+    """
+    Yields every field of a schema with its nesting depth, top-level fields have depth 1.
+    """
+    for field in fields:
+        yield field, depth
+        yield from _walk(field.get("fields") or [], depth + 1)
+
+
+
+def is_ambiguous_name(name: str) -> bool:
+    """
+    Returns True if the name of a field is generic, or looks like an abbreviation.
+    """
+    name = (name or "").lower()
+    return name in GENERIC_FIELD_NAMES or len(name) <= ABBREVIATION_MAX_LENGTH
+
+
+
+def chunk_complexity(chunk: List[Dict]) -> int:
+    """
+    Scores how hard a chunk of schema fields is to describe.
+
+    Every level of nesting below the top level adds DEPTH_WEIGHT points, every field
+    with an ambiguous name AMBIGUITY_WEIGHT points, and every FIELDS_PER_POINT fields
+    one point. A chunk of plain, descriptive scalar columns scores 0.
+
+    Parameters:
+    - chunk (list): The schema fields of the chunk.
+
+    Returns:
+    - int: The complexity score of the chunk.
+    """
+    max_depth, field_count, ambiguous = 0, 0, 0
+    for field, depth in _walk(chunk):
+        max_depth = max(max_depth, depth)
+        field_count += 1
+        ambiguous += is_ambiguous_name(field.get("name"))
+
+    return DEPTH_WEIGHT * max(0, max_depth - 1) + AMBIGUITY_WEIGHT * ambiguous + field_count // FIELDS_PER_POINT
+
+
+
+class ModelTier:
+    """
+    A model of the routing tier list, used for chunks scoring up to `max_score`.
+    """
+
+    def __init__(self, model_name: str, llm, max_score: int = None):
+        self.model_name = model_name
+        self.llm = llm
+        self.max_score = max_score
+
+
+
+class ModelRouter:
+    """
+    Routes every chunk to the cheapest model tier that can handle its complexity.
+
+    The tiers are ordered from the fastest to the strongest model. A chunk goes to the
+    first tier whose `max_score` is at least the complexity score of the chunk, the last
+    tier takes everything else. When escalation is enabled, a chunk whose response
+    fails validation is retried on the next tier.
+    """
+
+    def __init__(self, tiers: List[ModelTier], escalate: bool = True):
+        """
+        Initializes the ModelRouter instance.
+
+        Parameters:
+        - tiers (list): The model tiers, from the fastest to the strongest model.
+        - escalate (bool): Retry chunks with an invalid response on the next tier.
+        """
+        if not tiers:
+            raise ValueError("The model router needs at least one model tier.")
+        self.tiers = tiers
+        self.escalate = escalate
+
+
+
+    def route(self, chunk: List[Dict]) -> int:
+        """
+        Returns the index of the tier a chunk is sent to.
+        """
+        score = chunk_complexity(chunk)
+        for index, tier in enumerate(self.tiers[:-1]):
+            if tier.max_score is not None and score <= tier.max_score:
+                break
+        else:
+            index = len(self.tiers) - 1
+
+        logger.info(f"Chunk with complexity score {score} routed to model '{self.tiers[index].model_name}'.")
+        return index
+
+
+
+    def escalated(self, index: int) -> int:
+        """
+        Returns the tier a chunk is retried on after an invalid response on tier `index`.
+        """
+        if not self.escalate or index >= len(self.tiers) - 1:
+            return index
+
+        logger.info(f"Escalating chunk from model '{self.tiers[index].model_name}' "
+                    f"to model '{self.tiers[index + 1].model_name}'.")
+        return index + 1
@@ -0,0 +1,299 @@
+import time
+import random
+import asyncio
+import threading
+from typing import Callable
+
+from logger_setup import logger
+
+# Defaults used when the YAML 'llm.rate_limits' section does not specify them
+DEFAULT_REQUESTS_PER_MINUTE = 60
+DEFAULT_TOKENS_PER_MINUTE = 1_000_000
+DEFAULT_MAX_CONCURRENCY = 16
+DEFAULT_MAX_RETRIES = 6
+
+# The backoff after a quota error doubles with every retry, up to the maximum
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+
+# How often a waiting request checks whether it may proceed
+POLL_INTERVAL_SECONDS = 0.05
+
+# Fragments of the error messages the providers use for quota errors
+THROTTLE_MARKERS = ("429", "resource_exhausted", "resource exhausted", "rate limit", "ratelimit", "quota")
+
+
+def is_throttle_error(error: Exception) -> bool:
+    """
+    Returns True if the exception signals that a provider quota was exceeded
+    (HTTP 429 for OpenAI, RESOURCE_EXHAUSTED for Gemini).
+    """
+    if getattr(error, "status_code", None) == 429 or getattr(error, "code", None) == 429:
+        return True
+
+    text = f"{type(error).__name__} {error}".lower()
+    return any(marker in text for marker in THROTTLE_MARKERS)
+
+
+
+class TokenBucket:
+    """
+    A token bucket refilling at a constant rate, used for both the requests per
+    minute and the tokens per minute quota. The bucket may go into debt, when a
+    request turns out to use more tokens than it was charged for up front.
+
+    The bucket only uses a thread lock, and sleeps with `asyncio.sleep`, so it can be
+    shared by several event loops and threads.
+    """
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self._level = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+
+
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.refill_per_second)
+        self._updated = now
+
+
+
+    async def acquire(self, amount: float):
+        """
+        Waits until `amount` units are available, and takes them from the bucket.
+        Requests larger than the capacity are allowed once the bucket is full.
+        """
+        amount = min(float(amount), self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._level >= amount:
+                    self._level -= amount
+                    return
+                wait_seconds = (amount - self._level) / self.refill_per_second
+
+            await asyncio.sleep(max(wait_seconds, POLL_INTERVAL_SECONDS))
+
+
+
+    def charge(self, amount: float):
+        """
+        Takes units from the bucket without waiting, possibly going into debt.
+        """
+        with self._lock:
+            self._refill()
+            self._level -= float(amount)
+
+
+
+class AIMDLimiter:
+    """
+    Limits the number of concurrent requests with additive-increase/multiplicative-decrease.
+
+    Every successful request raises the limit by 1/limit (so roughly +1 per "round" of
+    requests), every quota error halves it. This keeps the concurrency just below the
+    level at which the provider starts rejecting requests.
+    """
+
+    def __init__(self, maximum: int, minimum: int = 1):
+        self.maximum = max(1, int(maximum))
+        self.minimum = max(1, min(int(minimum), self.maximum))
+        self.limit = float(self.maximum)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+
+
+    async def acquire(self):
+        while True:
+            with self._lock:
+                if self._in_flight < int(self.limit):
+                    self._in_flight += 1
+                    return
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+
+
+    def release(self, throttled: bool = False):
+        with self._lock:
+            self._in_flight -= 1
+            if throttled:
+                self.limit = max(float(self.minimum), self.limit / 2)
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+
+
+
+class ModelRateLimiter:
+    """
+    The request bucket, token bucket and concurrency limiter of a single model.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, max_concurrency):
+        self.settings = (requests_per_minute, tokens_per_minute, max_concurrency)
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60.0)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0)
+        self.concurrency = AIMDLimiter(max_concurrency)
+
+
+
+# The rate limiters are shared by every wrapper of the same model in this process
+_model_rate_limiters = {}
+_model_rate_limiters_lock = threading.Lock()
+
+
+def get_model_rate_limiter(model_name, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,
+                           tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """
+    Returns the process-wide rate limiter of a model, creating it on first use.
+
+    The quota belongs to the model, so the limits of the first caller apply to all
+    later callers. A later caller asking for different limits gets a warning.
+    """
+    with _model_rate_limiters_lock:
+        if model_name not in _model_rate_limiters:
+            logger.info(f"Rate limiting model '{model_name}': {requests_per_minute} requests/min, "
+                        f"{tokens_per_minute} tokens/min, at most {max_concurrency} concurrent requests.")
+            _model_rate_limiters[model_name] = ModelRateLimiter(requests_per_minute, tokens_per_minute, max_concurrency)
+
+        limiter = _model_rate_limiters[model_name]
+        if limiter.settings != (requests_per_minute, tokens_per_minute, max_concurrency):
+            logger.warning(f"Ignoring the rate limits {requests_per_minute} requests/min, {tokens_per_minute} tokens/min, "
+                           f"{max_concurrency} concurrent requests for model '{model_name}': the model is already "
+                           f"limited to {limiter.settings[0]} requests/min, {limiter.settings[1]} tokens/min, "
+                           f"{limiter.settings[2]} concurrent requests in this process.")
+        return limiter
+
+
+
+def _messages_text(messages) -> str:
+    """
+    Returns the text content of a prompt, either a string or a list of messages.
+    """
+    if isinstance(messages, str):
+        return messages
+    return "".join(str(getattr(message, "content", message)) for message in messages)
+
+
+
+class RateLimitedLLM:
+    """
+    Wraps a LangChain chat model, and keeps its calls within the provider quota.
+
+    Before a call, one request is taken from the request bucket, and the estimated
+    input tokens from the token bucket. After the call, the bucket is charged for the
+    output tokens as well. Quota errors (429 / RESOURCE_EXHAUSTED) halve the allowed
+    concurrency and are retried with exponential backoff, instead of failing the chunk.
+
+    All other attributes are delegated to the wrapped model.
+    """
+
+    def __init__(self, llm, model_name: str, count_tokens: Callable[[str], int],
+                 requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, max_retries=DEFAULT_MAX_RETRIES):
+        """
+        Initializes the RateLimitedLLM instance.
+
+        Parameters:
+        - llm: The LangChain chat model to wrap.
+        - model_name (str): The name of the model, the quota is tracked per model.
+        - count_tokens: Function returning the number of tokens in a string.
+        - requests_per_minute (int): The requests per minute quota of the model.
+        - tokens_per_minute (int): The tokens per minute quota of the model.
+        - max_concurrency (int): The upper bound of the adaptive concurrency limit.
+        - max_retries (int): The number of retries after a quota error.
+        """
+        self.llm = llm
+        self.model_name = model_name
+        self.count_tokens = count_tokens
+        self.max_retries = int(max_retries)
+        self.limiter = get_model_rate_limiter(model_name, requests_per_minute, tokens_per_minute, max_concurrency)
+
+
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the wrapper itself
+        return getattr(self.llm, name)
+
+
+
+    async def _acquire(self, estimated_tokens: int):
+        await self.limiter.requests.acquire(1)
+        await self.limiter.tokens.acquire(estimated_tokens)
+        await self.limiter.concurrency.acquire()
+
+
+
+    async def ainvoke(self, input, *args, **kwargs):
+        """
+        Rate limited version of the `ainvoke` method of the wrapped model.
+        """
+        estimated_tokens = self.count_tokens(_messages_text(input))
+
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(estimated_tokens)
+            throttled = False
+            try:
+                response = await self.llm.ainvoke(input, *args, **kwargs)
+                self.limiter.tokens.charge(self.count_tokens(str(getattr(response, "content", ""))))
+                return response
+
+            except Exception as e:
+                if not is_throttle_error(e) or attempt == self.max_retries:
+                    raise
+                throttled = True
+                backoff = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt))
+                backoff *= random.uniform(0.5, 1.0)
+                logger.warning(f"Quota exceeded for model '{self.model_name}', retry {attempt + 1}/{self.max_retries} "
+                               f"in {backoff:.1f}s (concurrency limit {self.limiter.concurrency.limit:.1f}): {e}")
+
+            finally:
+                self.limiter.concurrency.release(throttled)
+
+            await asyncio.sleep(backoff)
+
+
+
+    async def astream(self, input, *args, **kwargs):
+        """
+        Rate limited version of the `astream` method of the wrapped model. Quota errors 
+        are only retried when they occur before the first chunk was streamed.
+        """
+        estimated_tokens = self.count_tokens(_messages_text(input))
+
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(estimated_tokens)
+            throttled = False
+            streamed = []
+            try:
+                async for message_chunk in self.llm.astream(input, *args, **kwargs):
+                    streamed.append(str(getattr(message_chunk, "content", "")))
+                    yield message_chunk
+                self.limiter.tokens.charge(self.count_tokens("".join(streamed)))
+                return
+
+            except Exception as e:
+                if streamed or not is_throttle_error(e) or attempt == self.max_retries:
+                    raise
+                throttled = True
+                backoff = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt))
+                backoff *= random.uniform(0.5, 1.0)
+                logger.warning(f"Quota exceeded for model '{self.model_name}', retry {attempt + 1}/{self.max_retries} "
+                               f"in {backoff:.1f}s (concurrency limit {self.limiter.concurrency.limit:.1f}): {e}")
+
+            finally:
+                self.limiter.concurrency.release(throttled)
+
+            await asyncio.sleep(backoff)
+
+
+
+    def invoke(self, input, *args, **kwargs):
+        """
+        Rate limited version of the `invoke` method of the wrapped model.
+        """
+        return asyncio.run(self.ainvoke(input, *args, **kwargs))
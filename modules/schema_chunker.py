@@ -0,0 +1,235 @@
+import copy
+import json
+from typing import Callable, Dict, List
+
+from logger_setup import logger, log_entry_exit
+
+# A rough average of the number of characters per token, used to convert the
+# description character limit into an expected number of output tokens
+CHARS_PER_TOKEN = 4
+
+# We never fill the output budget completely, the LLM is not very precise
+# when it comes to respecting the requested description length
+OUTPUT_SAFETY_MARGIN = 0.8
+
+# The output tokens of a delta response entry besides its description, i.e. the
+# field path, the attribute names and the two booleans
+DELTA_ENTRY_TOKENS = 24
+
+
+def serialize_field(field: Dict) -> str:
+    """
+    Serializes a field the way it appears in the (non-compact) enrichment prompt.
+    """
+    return json.dumps(field, indent=2)
+
+
+class SchemaChunker:
+    """
+    Splits a schema into chunks that fit the input and output token budget of a model.
+
+    Fields are packed into a chunk until either the input tokens of the serialized
+    fields, or the expected output tokens of the enriched fields, would exceed the budget.
+    A RECORD that does not fit in a single chunk is split at subtree boundaries. Every
+    piece of a split RECORD keeps its parent RECORD(s) as a shell, so the LLM always sees
+    the full path of the subfields it is describing. Use `merge_split_records` to combine
+    the enriched pieces again.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], input_budget: int,
+                 output_budget: int, description_length: int,
+                 count_tokens_many: Callable[[List[str]], List[int]] = None,
+                 serialize: Callable[[Dict], str] = serialize_field, echo_input: bool = True):
+        """
+        Initializes the SchemaChunker instance.
+
+        Parameters:
+        - count_tokens: Function returning the number of tokens in a string.
+        - count_tokens_many (optional): Function returning the number of tokens of several 
+          strings, used to count all fields of the schema in a single batch.
+        - serialize (optional): Function returning the text of a field as it appears in the prompt.
+        - echo_input (bool): Whether the response echoes the input fields. When False (delta 
+          responses), the response only holds a short entry with a description for every field.
+        - input_budget (int): The maximum number of schema tokens in a single chunk.
+        - output_budget (int): The maximum number of output tokens the model can generate.
+        - description_length (int): The maximum number of characters in a description.
+        """
+        self.count_tokens = count_tokens
+        self.count_tokens_many = count_tokens_many
+        self.serialize = serialize
+        self.echo_input = echo_input
+
+        # The input tokens of the fields of the schema being chunked, keyed by id(field)
+        self._input_tokens = {}
+        self.input_budget = max(1, int(input_budget))
+        self.output_budget = max(1, int(output_budget * OUTPUT_SAFETY_MARGIN))
+
+        # Every field in the output gets a description of up to this many tokens
+        self.tokens_per_description = description_length // CHARS_PER_TOKEN
+
+
+
+    def _field_count(self, field: Dict) -> int:
+        """
+        Returns the number of fields in the subtree, including the field itself.
+        """
+        return 1 + sum(self._field_count(subfield) for subfield in field.get("fields") or [])
+
+
+
+    def _cost(self, field: Dict):
+        """
+        Returns a tuple with the estimated input and output tokens for a field.
+        The output echoes the input (unless delta responses are used), and adds a 
+        description for every field.
+        """
+        input_tokens = self._input_tokens.get(id(field))
+        if input_tokens is None:
+            input_tokens = self.count_tokens(self.serialize(field))
+        if self.echo_input:
+            output_tokens = input_tokens + self._field_count(field) * self.tokens_per_description
+        else:
+            output_tokens = self._field_count(field) * (self.tokens_per_description + DELTA_ENTRY_TOKENS)
+        return input_tokens, output_tokens
+
+
+
+    def _fits(self, cost, input_budget, output_budget) -> bool:
+        return cost[0] <= input_budget and cost[1] <= output_budget
+
+
+
+    def _split(self, field: Dict, path: str, input_budget: int, output_budget: int) -> List[Dict]:
+        """
+        Splits a field in pieces which fit the given budget.
+
+        Scalars, and RECORDs which fit, are returned as-is. Oversized RECORDs are split
+        into several copies of the RECORD, each containing a subset of the subfields.
+        """
+        cost = self._cost(field)
+        subfields = field.get("fields") or []
+
+        if self._fits(cost, input_budget, output_budget) or not subfields:
+            if not self._fits(cost, input_budget, output_budget):
+                logger.warning(f"Field '{path}' exceeds the token budget on its own, sending it as-is.")
+            return [field]
+
+        # The shell is the RECORD without its subfields, every piece repeats it
+        shell = {key: value for key, value in field.items() if key != "fields"}
+        shell_cost = self._cost(shell)
+        sub_input_budget = input_budget - shell_cost[0]
+        sub_output_budget = output_budget - shell_cost[1]
+
+        # Split the subfields recursively, then pack the pieces into groups
+        groups = self._pack(
+            (piece
+             for subfield in subfields
+             for piece in self._split(subfield, f"{path}.{subfield.get('name', '')}",
+                                      sub_input_budget, sub_output_budget)),
+            sub_input_budget, sub_output_budget)
+
+        logger.info(f"Split RECORD '{path}' with {len(subfields)} subfields into {len(groups)} pieces.")
+        return [dict(shell, fields=group) for group in groups]
+
+
+
+    def _pack(self, pieces, input_budget: int, output_budget: int) -> List[List[Dict]]:
+        """
+        Greedily packs pieces into groups that fit the given budget.
+        """
+        groups = []
+        current, current_input, current_output = [], 0, 0
+
+        for piece in pieces:
+            piece_input, piece_output = self._cost(piece)
+
+            if current and (current_input + piece_input > input_budget or
+                            current_output + piece_output > output_budget):
+                groups.append(current)
+                current, current_input, current_output = [], 0, 0
+
+            current.append(piece)
+            current_input += piece_input
+            current_output += piece_output
+
+        if current:
+            groups.append(current)
+
+        return groups
+
+
+
+    @log_entry_exit
+    def chunk(self, schema: List[Dict]) -> List[List[Dict]]:
+        """
+        Splits the schema into chunks that fit the input and output token budget.
+
+        Parameters:
+        - schema (list): The list of top-level schema fields.
+
+        Returns:
+        - list: The list of chunks, each chunk being a list of (partial) top-level fields.
+        """
+        logger.info(f"Chunking schema with an input budget of {self.input_budget} tokens "
+                    f"and an output budget of {self.output_budget} tokens...")
+
+        # Count the tokens of every field (and subtree) of the schema in a single batch
+        if self.count_tokens_many is not None:
+            fields = []
+            pending = list(schema)
+            while pending:
+                field = pending.pop()
+                fields.append(field)
+                pending.extend(field.get("fields") or [])
+            counts = self.count_tokens_many([self.serialize(field) for field in fields])
+            self._input_tokens = {id(field): count for field, count in zip(fields, counts)}
+
+        chunks = self._pack(
+            (piece
+             for field in schema
+             for piece in self._split(field, field.get("name", ""), self.input_budget, self.output_budget)),
+            self.input_budget, self.output_budget)
+
+        logger.info(f"Schema with {len(schema)} top-level fields split into {len(chunks)} chunks.")
+        self._input_tokens = {}
+        return chunks
+
+
+
+def merge_split_records(fields: List[Dict]) -> List[Dict]:
+    """
+    Combines the pieces of RECORDs that were split by the `SchemaChunker`.
+
+    Pieces of the same RECORD share their name, and are merged into the position of the
+    first piece. The subfields of all pieces are concatenated and merged recursively.
+    Fields that were never split are returned unchanged.
+
+    Parameters:
+    - fields (list): The list of enriched fields, in chunk order.
+
+    Returns:
+    - list: The list of fields with every RECORD appearing exactly once.
+    """
+    merged = []
+    by_name = {}
+
+    for field in fields:
+        name = field.get("name")
+        existing = by_name.get(name)
+
+        if existing is not None and "fields" in existing and "fields" in field:
+            existing["fields"].extend(field["fields"])
+            continue
+
+        field = copy.copy(field)
+        if "fields" in field:
+            field["fields"] = list(field["fields"])
+
+        by_name[name] = field
+        merged.append(field)
+
+    for field in merged:
+        if field.get("fields"):
+            field["fields"] = merge_split_records(field["fields"])
+
+    return merged
@@ -0,0 +1,112 @@
+import os
+import json
+import hashlib
+from typing import Dict, List
+
+from logger_setup import logger, log_entry_exit
+from modules.schema_paths import join_path
+from modules.schema_ir import SchemaIR
+
+# The attributes of a field that determine its fingerprint. Enrichment attributes
+# are deliberately excluded, the fingerprint only reflects the input schema.
+FINGERPRINT_KEYS = ("name", "type", "mode", "description")
+
+
+def compute_fingerprints(fields: List[Dict], parent_path: str = "", fingerprints: Dict = None) -> Dict[str, str]:
+    """
+    Computes a Merkle fingerprint for every field and RECORD subtree of a schema.
+
+    The fingerprint of a scalar field is the hash of its name, type, mode and (input)
+    description. The fingerprint of a RECORD additionally includes the fingerprints
+    of all its subfields, in order. Two RECORDs therefore have the same fingerprint
+    if, and only if, their complete subtrees are identical.
+
+    The fields are added after all fields of their subtree (post-order), the schema is
+    walked without recursion, however deep it is nested.
+
+    Parameters:
+    - fields (list): The list of schema fields.
+    - parent_path (str): The path of the parent field, empty for the top level.
+    - fingerprints (dict, optional): Receives the fingerprints.
+
+    Returns:
+    - dict: The fingerprints of all fields, keyed by full field path.
+    """
+    if fingerprints is None:
+        fingerprints = {}
+
+    # Hash the subfields first (they follow their RECORD), and fold their fingerprints into the RECORD
+    schema_ir = SchemaIR.from_fields(fields)
+    digests = [None] * len(schema_ir)
+    for node in reversed(schema_ir.nodes):
+        digest = hashlib.sha256()
+        digest.update(json.dumps([node.field.get(key) for key in FINGERPRINT_KEYS]).encode("utf-8"))
+        for child in schema_ir.children(node):
+            digest.update(digests[child.index].encode("ascii"))
+        digests[node.index] = digest.hexdigest()
+
+    # A field ends its subtree, the innermost of the fields ending at the same place comes first
+    for node in sorted(schema_ir.nodes, key=lambda node: (node.end, -node.index)):
+        fingerprints[join_path(parent_path, node.path)] = digests[node.index]
+
+    return fingerprints
+
+
+
+def subtree_ranges(fingerprints: Dict[str, str]):
+    """
+    Locates the subtree of every field in the fingerprint index. `compute_fingerprints` 
+    adds every field right after all fields of its subtree, so the subtree of a field 
+    is the run of paths ending at the field.
+
+    Parameters:
+    - fingerprints (dict): The fingerprints, as computed by `compute_fingerprints`.
+
+    Returns:
+    - tuple: The list of paths, and the (start, end) positions of the subtree of every 
+      path in that list, keyed by path.
+    """
+    paths = list(fingerprints)
+    starts = {}
+    for position, path in enumerate(paths):
+        # A RECORD's subtree starts with the subtree of its first subfield
+        start = starts.setdefault(path, position)
+        parent_path = path.rpartition(".")[0]
+        if parent_path:
+            starts.setdefault(parent_path, start)
+
+    return paths, {path: (starts[path], position + 1) for position, path in enumerate(paths)}
+
+
+
+def get_fingerprints_path(output_schema_path: str) -> str:
+    """
+    Returns the location of the fingerprint file stored alongside an output schema,
+    e.g. "fhir/hde_encounters_enriched.fingerprints.json".
+    """
+    root, _ = os.path.splitext(output_schema_path)
+    return f"{root}.fingerprints.json"
+
+
+
+@log_entry_exit
+def load_fingerprints(fingerprints_path: str) -> Dict[str, str]:
+    """
+    Loads the fingerprints of a previous run, returns an empty dictionary if there are none.
+    """
+    if not os.path.isfile(fingerprints_path):
+        logger.info(f"No previous fingerprints found at '{fingerprints_path}'.")
+        return {}
+
+    with open(fingerprints_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+
+@log_entry_exit
+def save_fingerprints(fingerprints: Dict[str, str], fingerprints_path: str):
+    """
+    Saves the fingerprints of the current run, so the next run can detect changes.
+    """
+    with open(fingerprints_path, "w", encoding="utf-8") as f:
+        json.dump(fingerprints, f, indent=2)
@@ -0,0 +1,239 @@
+import json
+from typing import Dict, Iterator, List, Tuple
+
+# The field types holding nested fields
+RECORD_TYPES = ("RECORD", "STRUCT")
+
+
+class SchemaNode:
+    """
+    A single field of a compiled schema, see `SchemaIR`.
+
+    Attributes:
+    - index: The position of the field in the depth-first order of the schema.
+    - name, description: The name and description of the field, "" if missing.
+    - type, mode: The upper case type ("" if missing) and mode ("NULLABLE" if missing).
+    - is_record: Whether the type is RECORD or STRUCT.
+    - has_fields: Whether the field has a list of nested fields, possibly empty.
+    - path: The full path of the field, e.g. "participant.individual.reference".
+    - depth: The nesting depth, 0 for the top-level fields.
+    - parent: The index of the parent RECORD, -1 for the top-level fields.
+    - sibling_index: The position of the field among the fields of its parent.
+    - end: The index following the last field of the subtree of this field.
+    - field: The original field, a dictionary or a `bigquery.SchemaField`.
+    """
+    __slots__ = ("index", "name", "description", "type", "mode", "is_record", "has_fields",
+                 "path", "depth", "parent", "sibling_index", "end", "field")
+
+    @property
+    def subtree_size(self) -> int:
+        """ The number of nested fields at any depth below this field. """
+        return self.end - self.index - 1
+
+
+
+def _dict_attributes(field: Dict):
+    subfields = field.get("fields")
+    return (field.get("name") or "", field.get("type") or "", field.get("mode") or "",
+            field.get("description") or "", subfields if isinstance(subfields, list) else None)
+
+
+
+def _bigquery_attributes(field):
+    subfields = list(field.fields) if field.fields else None
+    return field.name or "", field.field_type or "", field.mode or "", field.description or "", subfields
+
+
+
+class SchemaIR:
+    """
+    A schema compiled once into a flat list of nodes, in depth-first (pre-)order, so
+    every schema walker (SQL generators, the DDL of a BigQuery table, the schema viewer)
+    consumes the same structure instead of walking the nested `fields` lists itself.
+
+    The types and modes are normalised, and the full paths, parents and subtree sizes
+    are precomputed. The subtree of a node is the range of nodes from its index to its
+    `end`, so the schema is traversed without recursion, however deep it is nested.
+    """
+
+    def __init__(self, nodes: List[SchemaNode] = None):
+        self.nodes = nodes or []
+
+
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+
+    def __iter__(self) -> Iterator[SchemaNode]:
+        return iter(self.nodes)
+
+
+
+    @classmethod
+    def _compile(cls, fields, attributes, max_depth: int = None) -> "SchemaIR":
+        """
+        Compiles a list of fields, reading every field with the `attributes` function.
+        The fields nested deeper than `max_depth` (if given) are not compiled.
+        """
+        nodes = []
+        append = nodes.append
+
+        # A stack of the (fields iterator, parent node) of every open RECORD
+        stack = [(iter(fields), None)]
+        while stack:
+            siblings, parent = stack[-1]
+            if parent is None:
+                parent_index, parent_path, depth = -1, "", 0
+            else:
+                parent_index, parent_path, depth = parent.index, parent.path + ".", parent.depth + 1
+
+            # Add the fields of the innermost open RECORD, until one of them has nested fields
+            for field in siblings:
+                name, field_type, mode, description, subfields = attributes(field)
+
+                node = SchemaNode()
+                node.index = len(nodes)
+                node.end = node.index + 1
+                node.name = name
+                node.description = description
+                node.type = field_type = field_type.upper()
+                node.mode = mode.upper() if mode else "NULLABLE"
+                node.is_record = field_type in RECORD_TYPES
+                node.has_fields = subfields is not None
+                node.path = parent_path + name
+                node.depth = depth
+                node.parent = parent_index
+                node.field = field
+                append(node)
+
+                if subfields and (max_depth is None or depth < max_depth):
+                    stack.append((iter(subfields), node))
+                    break
+            else:
+                stack.pop()
+                if parent is not None:
+                    parent.end = len(nodes)
+
+        # The position of every field among the fields of its parent
+        sibling_count = {}
+        for node in nodes:
+            node.sibling_index = sibling_count.get(node.parent, 0)
+            sibling_count[node.parent] = node.sibling_index + 1
+
+        return cls(nodes)
+
+
+
+    @classmethod
+    def from_fields(cls, fields: List[Dict], max_depth: int = None) -> "SchemaIR":
+        """
+        Compiles a JSON schema, a list of field dictionaries (see `main.load_schema`).
+        With `max_depth` only the fields up to that depth are compiled (0 for the
+        top-level fields), such a partial schema must not be pruned.
+        """
+        return cls._compile(fields, _dict_attributes, max_depth)
+
+
+
+    @classmethod
+    def from_bigquery(cls, fields: List) -> "SchemaIR":
+        """
+        Compiles the schema of a BigQuery table, a list of `bigquery.SchemaField`.
+        """
+        return cls._compile(fields, _bigquery_attributes)
+
+
+
+    def children(self, node: SchemaNode = None) -> Iterator[SchemaNode]:
+        """
+        Yields the direct nested fields of a node, or the top-level fields.
+        """
+        index, end = (node.index + 1, node.end) if node is not None else (0, len(self.nodes))
+        while index < end:
+            child = self.nodes[index]
+            yield child
+            index = child.end
+
+
+
+    def events(self) -> Iterator[Tuple[SchemaNode, bool]]:
+        """
+        Yields (node, True) for every node in depth-first order, and (node, False) for
+        every RECORD node after the nodes of its subtree, to close the RECORD.
+        """
+        open_records = []
+        for node in self.nodes:
+            while open_records and open_records[-1].end <= node.index:
+                yield open_records.pop(), False
+            yield node, True
+            if node.is_record:
+                open_records.append(node)
+
+        while open_records:
+            yield open_records.pop(), False
+
+
+
+    def prune_empty_records(self) -> List[SchemaNode]:
+        """
+        Removes the RECORD fields without any (non-empty) nested fields in place,
+        BigQuery does not allow empty STRUCTs.
+
+        Returns:
+        - list: The removed RECORD nodes, innermost first.
+        """
+        keep = [not node.is_record for node in self.nodes]
+        has_kept_field = [False] * len(self.nodes)
+
+        # The nodes of a subtree follow their RECORD, so walking backwards every
+        # RECORD is decided after all of its nested fields
+        for node in reversed(self.nodes):
+            if node.is_record:
+                keep[node.index] = has_kept_field[node.index]
+            if keep[node.index] and node.parent >= 0:
+                has_kept_field[node.parent] = True
+
+        removed = sorted((node for node in self.nodes if not keep[node.index]),
+                         key=lambda node: (node.end, -node.index))
+        if not removed:
+            return removed
+
+        # Renumber the kept nodes, a kept node never has a removed parent
+        new_index = [-1] * len(self.nodes)
+        self.nodes = [node for node in self.nodes if keep[node.index]]
+        sibling_count = {}
+        for index, node in enumerate(self.nodes):
+            new_index[node.index] = index
+            node.index = index
+            node.end = index + 1
+            if node.parent >= 0:
+                node.parent = new_index[node.parent]
+            node.sibling_index = sibling_count.get(node.parent, 0)
+            sibling_count[node.parent] = node.sibling_index + 1
+
+        # The end of a subtree is the index following its last kept node
+        for node in reversed(self.nodes):
+            if node.parent >= 0 and self.nodes[node.parent].end < node.end:
+                self.nodes[node.parent].end = node.end
+
+        return removed
+
+
+
+def as_schema_ir(schema, max_depth: int = None) -> SchemaIR:
+    """
+    Returns the compiled schema, compiling a list of field dictionaries if needed
+    (see `SchemaIR.from_fields`).
+    """
+    return schema if isinstance(schema, SchemaIR) else SchemaIR.from_fields(schema, max_depth)
+
+
+
+def load_schema_ir(schema_path: str) -> SchemaIR:
+    """
+    Loads and compiles a JSON schema file.
+    """
+    with open(schema_path, "r") as f:
+        return SchemaIR.from_fields(json.load(f))
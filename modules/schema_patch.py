@@ -0,0 +1,72 @@
+import copy
+from typing import Dict, List, Tuple
+
+from logger_setup import logger
+from modules.schema_paths import index_by_path
+from modules.schema_ir import SchemaIR
+
+
+def _patch_fields(fields: List[Dict], descriptions: Dict[str, str], stats: Dict) -> List[Dict]:
+    """
+    Returns a copy of the live schema fields with the new descriptions applied. The
+    schema is walked without recursion, however deep it is nested.
+    """
+    patched = []
+
+    # The copies are built in depth-first order, every field is added to the copy of its parent
+    copies = []
+    for node in SchemaIR.from_fields(fields):
+        field = node.field
+        patched_field = {key: copy.deepcopy(value) for key, value in field.items() if key != "fields"}
+        description = descriptions.get(node.path)
+        if description and description != field.get("description"):
+            patched_field["description"] = description
+            stats["changed"] += 1
+        if node.path in descriptions:
+            stats["matched"] += 1
+
+        # Only RECORDs with subfields keep their (patched) list of subfields
+        if node.subtree_size:
+            patched_field["fields"] = []
+
+        copies.append(patched_field)
+        (copies[node.parent]["fields"] if node.parent >= 0 else patched).append(patched_field)
+    return patched
+
+
+
+def build_schema_patch(live_schema: List[Dict], enriched_schema: List[Dict],
+                       table_description: str = None) -> Tuple[Dict, int]:
+    """
+    Builds a `tables.patch` payload which sets all descriptions of the enriched schema,
+    the nested ones included, on the live schema of the table.
+
+    The live schema (see `BigQuerySchemaManager.get_table_schema(format="JSON")`) 
+    determines the names, types, modes, order and nesting of the patched schema, and 
+    keeps every other attribute (e.g. policy tags) of its fields. Only the descriptions 
+    are taken from the enriched schema. Fields of the enriched schema which do not exist
+    in the live table are ignored, a patch never adds columns.
+
+    Parameters:
+    - live_schema (list): The current schema fields of the table, in the API format.
+    - enriched_schema (list): The enriched schema fields.
+    - table_description (str, optional): The description of the table.
+
+    Returns:
+    - tuple: The payload ({"schema": {"fields": [...]}, "description": ...}) and the 
+      number of field descriptions it changes.
+    """
+    descriptions = {path: field["description"] for path, field in index_by_path(enriched_schema).items()
+                    if field.get("description")}
+
+    stats = {"changed": 0, "matched": 0}
+    patch = {"schema": {"fields": _patch_fields(live_schema, descriptions, stats)}}
+    if table_description:
+        patch["description"] = table_description
+
+    if stats["matched"] < len(descriptions):
+        logger.warning(f"{len(descriptions) - stats['matched']} described fields do not exist in the live table, "
+                       f"they are not part of the patch.")
+    logger.info(f"Schema patch changes {stats['changed']} of {len(descriptions)} field descriptions.")
+
+    return patch, stats["changed"]
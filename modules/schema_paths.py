@@ -0,0 +1,216 @@
+import copy
+from typing import Dict, List
+
+from modules.schema_ir import SchemaIR
+
+# The attributes the LLM adds to every field of the schema
+ENRICHMENT_KEYS = ("description", "PHI/PII", "HIPAA")
+
+# The names of the enrichment attributes in a delta response entry
+DELTA_KEYS = {"description": "description", "phi_pii": "PHI/PII", "hipaa": "HIPAA"}
+
+
+def join_path(parent_path: str, name: str) -> str:
+    """
+    Returns the full path of a field, e.g. "participant.individual.reference".
+    """
+    return f"{parent_path}.{name}" if parent_path else name
+
+
+
+def index_by_path(fields: List[Dict], parent_path: str = "") -> Dict[str, Dict]:
+    """
+    Builds a dictionary of all fields in a schema, keyed by their full field path.
+    The dictionary preserves the depth-first order of the schema. The schema is 
+    walked without recursion, however deep it is nested.
+
+    Parameters:
+    - fields (list): The list of schema fields.
+    - parent_path (str): The path of the parent field, empty for the top level.
+
+    Returns:
+    - dict: The fields of the schema, keyed by their full path.
+    """
+    index = {}
+
+    # A stack of the (fields iterator, path) of every RECORD being walked
+    stack = [(iter(fields), parent_path)]
+    while stack:
+        siblings, path_prefix = stack[-1]
+        for field in siblings:
+            path = join_path(path_prefix, field.get("name", ""))
+            index[path] = field
+            if field.get("fields"):
+                stack.append((iter(field["fields"]), path))
+                break
+        else:
+            stack.pop()
+    return index
+
+
+
+def is_enriched(attributes: Dict) -> bool:
+    """
+    Returns whether the enrichment attributes of a field are complete: a description,
+    and the PHI/PII and HIPAA flags.
+    """
+    return bool(attributes.get("description")) and all(key in attributes for key in ENRICHMENT_KEYS)
+
+
+
+def extract_enrichments(fields: List[Dict]) -> Dict[str, Dict]:
+    """
+    Extracts the enrichment attributes (description, PHI/PII and HIPAA) of every field.
+
+    Parameters:
+    - fields (list): The list of enriched schema fields.
+
+    Returns:
+    - dict: The enrichment attributes, keyed by full field path. Fields without any
+      enrichment attributes are not included.
+    """
+    enrichments = {}
+    for path, field in index_by_path(fields).items():
+        attributes = {key: field[key] for key in ENRICHMENT_KEYS if key in field}
+        if attributes:
+            enrichments[path] = attributes
+    return enrichments
+
+
+
+def merge_enrichments(fields: List[Dict], enrichments: Dict[str, Dict], parent_path: str = "") -> List[Dict]:
+    """
+    Applies enrichment attributes to a copy of the schema.
+
+    The original schema determines the names, types, modes, order and nesting of
+    the result, only the enrichment attributes are taken from `enrichments`.
+
+    Parameters:
+    - fields (list): The list of original schema fields.
+    - enrichments (dict): The enrichment attributes, keyed by full field path.
+    - parent_path (str): The path of the parent field, empty for the top level.
+
+    Returns:
+    - list: The enriched copy of the schema.
+    """
+    merged = []
+
+    # The copies are built in depth-first order, every field is added to the copy of its parent
+    copies = []
+    for node in SchemaIR.from_fields(fields):
+        field = node.field
+        enriched_field = {key: copy.deepcopy(value) for key, value in field.items() 
+                          if key != "fields" or not node.has_fields}
+        enriched_field.update(enrichments.get(join_path(parent_path, node.path), {}))
+
+        if node.has_fields:
+            enriched_field["fields"] = []
+
+        copies.append(enriched_field)
+        (copies[node.parent]["fields"] if node.parent >= 0 else merged).append(enriched_field)
+    return merged
+
+
+
+def delta_enrichments(entries) -> Dict[str, Dict]:
+    """
+    Converts the entries of a delta response into enrichment attributes.
+
+    A delta response holds one entry per field, e.g. {"path": "period.start", 
+    "description": "...", "phi_pii": false, "hipaa": false}. A JSON object mapping
+    every path to its attributes is accepted as well.
+
+    Parameters:
+    - entries (list or dict): The parsed delta response.
+
+    Returns:
+    - dict: The enrichment attributes, keyed by full field path.
+    """
+    if isinstance(entries, dict):
+        entries = [dict(attributes, path=path) for path, attributes in entries.items() if isinstance(attributes, dict)]
+
+    enrichments = {}
+    for entry in entries:
+        path = entry.get("path") if isinstance(entry, dict) else None
+        if not isinstance(path, str):
+            continue
+
+        attributes = {key: entry[delta_key] for delta_key, key in DELTA_KEYS.items() if delta_key in entry}
+        if attributes:
+            enrichments[path] = attributes
+    return enrichments
+
+
+
+def strip_enrichments(fields: List[Dict]) -> List[Dict]:
+    """
+    Returns a copy of the schema without any enrichment attributes, so the attributes
+    merged into it afterwards are the only ones the result holds.
+
+    Parameters:
+    - fields (list): The list of schema fields.
+
+    Returns:
+    - list: The copy of the schema without description, PHI/PII and HIPAA attributes.
+    """
+    stripped = []
+    for field in fields:
+        stripped_field = {key: copy.deepcopy(value) for key, value in field.items()
+                          if key not in ENRICHMENT_KEYS and key != "fields"}
+
+        if "fields" in field:
+            stripped_field["fields"] = strip_enrichments(field["fields"])
+
+        stripped.append(stripped_field)
+    return stripped
+
+
+
+def complete_fields(fields: List[Dict], enrichments: Dict[str, Dict], parent_path: str = "") -> List[Dict]:
+    """
+    Returns the enriched copies of the fields for which every field of the subtree
+    has enrichment attributes, fields with missing attributes are left out.
+
+    Parameters:
+    - fields (list): The list of schema fields.
+    - enrichments (dict): The enrichment attributes, keyed by full field path.
+    - parent_path (str): The path of the parent field, empty for the top level.
+
+    Returns:
+    - list: The enriched copies of the complete fields.
+    """
+    complete = []
+    for field in fields:
+        path = join_path(parent_path, field.get("name", ""))
+        subtree_paths = [path] + list(index_by_path(field.get("fields") or [], path))
+        if all(sub_path in enrichments for sub_path in subtree_paths):
+            complete.extend(merge_enrichments([field], enrichments, parent_path))
+    return complete
+
+
+
+def compact_fields(fields: List[Dict]) -> List[Dict]:
+    """
+    Returns the minimal form of a schema sent to the LLM in compact prompt mode.
+
+    Only the name, type and mode of every field are kept, the mode only when it is
+    not NULLABLE (the BigQuery default), together with the subfields of RECORDs.
+
+    Parameters:
+    - fields (list): The list of schema fields.
+
+    Returns:
+    - list: The compact copy of the schema.
+    """
+    compacted = []
+    for field in fields:
+        compact_field = {"name": field.get("name", ""), "type": field.get("type", "")}
+
+        if field.get("mode") and field["mode"] != "NULLABLE":
+            compact_field["mode"] = field["mode"]
+
+        if field.get("fields"):
+            compact_field["fields"] = compact_fields(field["fields"])
+
+        compacted.append(compact_field)
+    return compacted
@@ -0,0 +1,177 @@
+import asyncio
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, List
+
+from logger_setup import logger, log_entry_exit
+
+# Columns which appear in (nearly) every FHIR table, and mean the same thing in all of them.
+# This list can be overridden with the 'enrichment.shared_fields' YAML setting.
+DEFAULT_SHARED_FIELDS = (
+    "lastupdated",
+    "hl7_message_date_time",
+    "hl7_message_date_time_UTC",
+    "hl7_message_control_id",
+    "meta_latest_source_date_time",
+    "intermediate_snapshot_creation_date_time",
+    "final_fhir_write_date_time",
+    "final_fhir_commit_date_time",
+    "version_id_fingerprint",
+    "meta_action_code",
+    "hl7_v2_source_interface",
+    "network_mnemonic",
+    "facility_mnemonic",
+    "patient_id",
+    "coid",
+    "insert_timestamp",
+)
+
+# A column observed in at least this many tables is treated as shared as well
+DEFAULT_SHARED_FIELD_MIN_TABLES = 3
+
+
+class SharedFieldRegistry:
+    """
+    A process-wide registry of the descriptions of columns shared by many FHIR tables.
+
+    Every shared column is enriched only once, the result is reused by all tables.
+    When several tables request the same column at the same time, the first request
+    performs the LLM call, and the others wait for its result (single-flight). The
+    registry can be used from several asyncio tasks, event loops and threads.
+
+    A column is shared when its name is in the configured list of shared fields, or
+    when it was observed (see `observe`) in at least `min_tables` table schemas. Only
+    top-level scalar columns are shared, nested fields are specific to their resource.
+    """
+
+    def __init__(self, shared_fields=DEFAULT_SHARED_FIELDS, min_tables=DEFAULT_SHARED_FIELD_MIN_TABLES):
+        """
+        Initializes the SharedFieldRegistry instance.
+
+        Parameters:
+        - shared_fields (iterable): The names of the columns that are always shared.
+        - min_tables (int): The number of observed tables after which a column is shared.
+        """
+        self.shared_fields = set(shared_fields)
+        self.min_tables = int(min_tables)
+
+        # The number of observed tables each (name, type, mode) column appears in
+        self._observed = Counter()
+
+        # The completed and the in-flight enrichments, keyed by column
+        self._results = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+        # Reuse counters, reported at the end of the run
+        self.reused = 0
+        self.enriched = 0
+
+
+
+    @staticmethod
+    def _column_key(field: Dict, model_name: str):
+        return (field.get("name", ""), (field.get("type") or "").upper(),
+                (field.get("mode") or "NULLABLE").upper(), model_name or "")
+
+
+
+    def observe(self, schema: List[Dict]):
+        """
+        Registers the top-level columns of a table schema, used to recognize shared columns.
+        """
+        columns = {self._column_key(field, "")[:3] for field in schema}
+        with self._lock:
+            self._observed.update(columns)
+
+
+
+    def is_shared(self, field: Dict) -> bool:
+        """
+        Returns True if the top-level field is a shared column.
+        """
+        if (field.get("type") or "").upper() in ("RECORD", "STRUCT") or field.get("fields"):
+            return False
+
+        if field.get("name") in self.shared_fields:
+            return True
+
+        return self._observed[self._column_key(field, "")[:3]] >= self.min_tables
+
+
+
+    @log_entry_exit
+    async def aenrich(self, fields: List[Dict], model_name: str,
+                      enrich: Callable[[List[Dict]], Awaitable[Dict[str, Dict]]]) -> Dict[str, Dict]:
+        """
+        Returns the enrichment attributes of shared columns, enriching each column only once.
+
+        Columns that are already known are returned immediately. Columns that are being
+        enriched by another table are awaited. The remaining columns are enriched with a
+        single call to `enrich`, on behalf of every table that requests them.
+
+        Parameters:
+        - fields (list): The shared top-level fields to enrich.
+        - model_name (str): The name of the LLM model, shared columns are kept per model.
+        - enrich: Coroutine function enriching a list of fields, returning the enrichment
+          attributes keyed by field name.
+
+        Returns:
+        - dict: The enrichment attributes keyed by field name. Columns the LLM failed to
+          describe are left out, so the caller can enrich them itself.
+        """
+        enrichments = {}
+        owned, waiting = [], []
+
+        with self._lock:
+            for field in fields:
+                key = self._column_key(field, model_name)
+
+                if key in self._results:
+                    enrichments[field["name"]] = self._results[key]
+                elif key in self._in_flight:
+                    waiting.append((field, self._in_flight[key]))
+                else:
+                    # This request becomes the owner of the column
+                    self._in_flight[key] = Future()
+                    owned.append(field)
+
+            self.reused += len(enrichments) + len(waiting)
+
+        if owned:
+            logger.info(f"Enriching {len(owned)} shared columns: {[field['name'] for field in owned]}")
+            results = {}
+            try:
+                results = await enrich(owned)
+            except Exception as e:
+                logger.error(f"Error enriching shared columns: {e}")
+            finally:
+                # Always resolve the futures, so no waiting table hangs
+                with self._lock:
+                    for field in owned:
+                        key = self._column_key(field, model_name)
+                        attributes = results.get(field["name"])
+                        if attributes:
+                            self._results[key] = attributes
+                            self.enriched += 1
+                        self._in_flight.pop(key).set_result(attributes)
+
+            enrichments.update({field["name"]: results[field["name"]]
+                                for field in owned if results.get(field["name"])})
+
+        for field, future in waiting:
+            # The future may belong to another event loop or thread, so we wrap it
+            attributes = await asyncio.wrap_future(future)
+            if attributes:
+                enrichments[field["name"]] = attributes
+
+        return enrichments
+
+
+
+    def log_stats(self):
+        """
+        Logs how many shared columns were enriched, and how many times they were reused.
+        """
+        logger.info(f"Shared columns: {self.enriched} enriched once, reused {self.reused} times.")
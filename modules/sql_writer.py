@@ -0,0 +1,68 @@
+import os
+import gzip
+from typing import Iterable, Union
+
+from logger_setup import logger, log_entry_exit
+
+# The size of the write buffer, the fragments are written to disk in blocks of this size
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+# SQL output files with this suffix are compressed
+GZIP_SUFFIX = ".gz"
+
+
+def open_sql_output(output_path: str, compress: bool = None, buffer_size: int = DEFAULT_BUFFER_SIZE):
+    """
+    Opens a SQL output file for writing text, buffered, and gzip compressed if requested.
+
+    Parameters:
+    - output_path (str): The location of the SQL output file.
+    - compress (bool, optional): Compress the file with gzip, defaults to True when
+      the location ends with ".gz".
+    - buffer_size (int): The size of the write buffer, in bytes.
+
+    Returns:
+    - A text file object.
+    """
+    if compress is None:
+        compress = output_path.endswith(GZIP_SUFFIX)
+
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if compress:
+        # The gzip file buffers the compressed output itself
+        return gzip.open(output_path, "wt", encoding="utf-8")
+    return open(output_path, "w", encoding="utf-8", buffering=buffer_size)
+
+
+
+@log_entry_exit
+def write_sql(fragments: Union[str, Iterable[str]], output_path: str, compress: bool = None,
+              buffer_size: int = DEFAULT_BUFFER_SIZE) -> int:
+    """
+    Streams SQL to a file. The fragments are written as they are produced (e.g. by
+    `FHIRResourceManager.iter_sql`), so the statement is never held in memory as a
+    whole, however many columns the table has.
+
+    Parameters:
+    - fragments (str or iterable): The SQL, as a single string or as fragments.
+    - output_path (str): The location of the SQL output file.
+    - compress (bool, optional): Compress the file with gzip, see `open_sql_output`.
+    - buffer_size (int): The size of the write buffer, in bytes.
+
+    Returns:
+    - int: The number of characters written.
+    """
+    if isinstance(fragments, str):
+        fragments = [fragments]
+
+    characters = 0
+    with open_sql_output(output_path, compress, buffer_size) as f:
+        for fragment in fragments:
+            f.write(fragment)
+            characters += len(fragment)
+
+    logger.info(f"Wrote {characters} characters of SQL to: '{output_path}'")
+    return characters
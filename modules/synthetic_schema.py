@@ -0,0 +1,116 @@
+import random
+from typing import Dict, List
+
+# Field names seen in the FHIR tables, used to build realistic synthetic schemas
+FHIR_FIELD_NAMES = [
+    "identifier", "status", "class", "type", "period", "start", "end", "subject", "reference",
+    "display", "code", "system", "value", "participant", "individual", "location", "diagnosis",
+    "condition", "rank", "hospitalization", "admit_source", "discharge_disposition", "extension",
+    "url", "text", "coding", "version", "priority", "service_provider", "episode_of_care",
+    "based_on", "reason_code", "length", "unit", "meta", "last_updated", "source", "profile",
+]
+
+SCALAR_TYPES = ["STRING", "STRING", "STRING", "INTEGER", "TIMESTAMP", "BOOLEAN", "FLOAT", "DATE"]
+
+# A few words to build descriptions of the requested length
+DESCRIPTION_WORDS = [
+    "the", "patient", "encounter", "clinical", "identifier", "of", "resource", "used", "for",
+    "billing", "and", "reporting", "date", "time", "code", "system", "reference", "status",
+]
+
+# Predefined schema shapes for the benchmark suite
+SCHEMA_PRESETS = {
+    # A typical table, a few hundred fields
+    "small":  {"width": 60,  "depth": 4,  "fanout": 6, "record_ratio": 0.2, "description_length": 200},
+    # Our largest tables, thousands of leaf fields nested up to 15 levels deep
+    "large":  {"width": 200, "depth": 15, "fanout": 8, "record_ratio": 0.3, "description_length": 600},
+    # Wide and shallow, many top-level columns
+    "wide":   {"width": 3000, "depth": 1, "fanout": 1, "record_ratio": 0.0, "description_length": 400},
+}
+
+
+def _description(rng: random.Random, length: int) -> str:
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(DESCRIPTION_WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)[:length]
+
+
+
+def _scalar(rng: random.Random, name: str, description_length: int) -> Dict:
+    return {
+        "name": name,
+        "type": rng.choice(SCALAR_TYPES),
+        "mode": "REPEATED" if rng.random() < 0.1 else "NULLABLE",
+        "description": _description(rng, description_length),
+    }
+
+
+
+def _record(rng: random.Random, name: str, levels: int, fanout: int, description_length: int) -> Dict:
+    """
+    Builds a RECORD with `fanout` subfields, the first of which is itself a RECORD
+    as long as there are levels left, so the RECORD is exactly `levels` levels deep.
+    """
+    fields = []
+    for index in range(fanout):
+        subfield_name = f"{rng.choice(FHIR_FIELD_NAMES)}_{index}"
+        if index == 0 and levels > 1:
+            fields.append(_record(rng, subfield_name, levels - 1, fanout, description_length))
+        else:
+            fields.append(_scalar(rng, subfield_name, description_length))
+
+    record = _scalar(rng, name, description_length)
+    record.update({"type": "RECORD", "fields": fields})
+    return record
+
+
+
+def generate_schema(width: int, depth: int, fanout: int, record_ratio: float,
+                    description_length: int, seed: int = 0) -> List[Dict]:
+    """
+    Generates a synthetic FHIR-like schema.
+
+    Parameters:
+    - width (int): The number of top-level fields.
+    - depth (int): The nesting depth of the RECORD fields, 1 means no nesting.
+    - fanout (int): The number of subfields of every RECORD.
+    - record_ratio (float): The fraction of the top-level fields that are RECORDs.
+    - description_length (int): The number of characters of every description.
+    - seed (int): The seed of the generator, the same seed gives the same schema.
+
+    Returns:
+    - list: The list of top-level schema fields.
+    """
+    rng = random.Random(seed)
+    schema = []
+    for index in range(width):
+        name = f"{rng.choice(FHIR_FIELD_NAMES)}_{index}"
+        if depth > 1 and fanout > 0 and rng.random() < record_ratio:
+            schema.append(_record(rng, name, depth - 1, fanout, description_length))
+        else:
+            schema.append(_scalar(rng, name, description_length))
+
+    # One empty RECORD, which BigQuery does not allow and the SQL generation removes
+    schema.append({"name": "empty_record", "type": "RECORD", "mode": "NULLABLE", "description": "", "fields": []})
+    return schema
+
+
+
+def count_fields(fields: List[Dict]):
+    """
+    Returns a tuple with the number of leaf fields and the maximum nesting depth.
+    """
+    leaves, depth = 0, 0
+    for field in fields:
+        if field.get("fields"):
+            sub_leaves, sub_depth = count_fields(field["fields"])
+            leaves += sub_leaves
+            depth = max(depth, sub_depth + 1)
+        else:
+            leaves += 1
+            depth = max(depth, 1)
+    return leaves, depth
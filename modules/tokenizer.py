@@ -0,0 +1,172 @@
+import os
+import threading
+from functools import lru_cache
+from typing import List
+
+from logger_setup import logger
+
+# The directory with the bundled tiktoken BPE files, for runners without network access.
+# The files are loaded from here explicitly, tiktoken never downloads them
+BUNDLED_TOKENIZER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tokenizers")
+
+# The bundled encodings, as defined by tiktoken (tiktoken_ext/openai_public.py): the
+# SHA-256 of the BPE file "<name>.tiktoken", the split pattern and the special tokens
+BUNDLED_ENCODINGS = {
+    "cl100k_base": {
+        "expected_hash": "223921b76ee99bde995b7ff738513eef100fb51d18c93597a113bcffe865b2a7",
+        "pat_str": r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+| ?[^\s\p{L}\p{N}]++[\r\n]*+|\s++$|\s*[\r\n]|\s+(?!\S)|\s""",
+        "special_tokens": {"<|endoftext|>": 100257, "<|fim_prefix|>": 100258, "<|fim_middle|>": 100259,
+                           "<|fim_suffix|>": 100260, "<|endofprompt|>": 100276},
+    },
+    "o200k_base": {
+        "expected_hash": "446a9538cb6c348e3516120d7c08b09f57c36495e2acfffe59a5bf8b0cfb1a2d",
+        "pat_str": "|".join([
+            r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]*[\p{Ll}\p{Lm}\p{Lo}\p{M}]+(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+            r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]+[\p{Ll}\p{Lm}\p{Lo}\p{M}]*(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+            r"""\p{N}{1,3}""",
+            r""" ?[^\s\p{L}\p{N}]+[\r\n/]*""",
+            r"""\s*[\r\n]+""",
+            r"""\s+(?!\S)""",
+            r"""\s+""",
+        ]),
+        "special_tokens": {"<|endoftext|>": 199999, "<|endofprompt|>": 200018},
+    },
+}
+
+# The model used when no model name is known
+DEFAULT_TOKENIZER_MODEL = "gpt-4"
+
+# Gemini does not publish a local tokenizer, Google documents roughly 4 characters per token
+GEMINI_CHARS_PER_TOKEN = 4
+
+# The encoding used for OpenAI models tiktoken does not know (yet)
+FALLBACK_ENCODING = "cl100k_base"
+
+
+class CharacterEstimator:
+    """
+    Estimates the number of tokens from the number of characters. Used for models
+    without a local tokenizer, and when a tiktoken encoding cannot be loaded.
+    """
+
+    def __init__(self, chars_per_token: float):
+        self.chars_per_token = float(chars_per_token)
+
+    def count(self, text: str) -> int:
+        return int(len(text) / self.chars_per_token + 0.5)
+
+    def count_many(self, texts: List[str]) -> List[int]:
+        return [self.count(text) for text in texts]
+
+
+
+class TiktokenCounter:
+    """
+    Counts tokens with a tiktoken encoding.
+    """
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def count_many(self, texts: List[str]) -> List[int]:
+        return [len(tokens) for tokens in self.encoding.encode_batch(texts, disallowed_special=())]
+
+
+
+# The token counter of every model name, shared by all threads. The counters of the
+# models using the same encoding share the encoding, see `_load_bundled_encoding`
+_counters = {}
+_counters_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _load_bundled_encoding(encoding_name: str):
+    """
+    Loads a tiktoken encoding from its bundled BPE file, or returns None if the 
+    encoding is not bundled. The file is checked against its published SHA-256.
+    Every encoding is loaded once per process, and shared by all the models using it.
+    """
+    definition = BUNDLED_ENCODINGS.get(encoding_name)
+    bpe_path = os.path.join(BUNDLED_TOKENIZER_DIR, f"{encoding_name}.tiktoken")
+    if definition is None or not os.path.isfile(bpe_path):
+        return None
+
+    import tiktoken
+    from tiktoken.load import load_tiktoken_bpe
+
+    return tiktoken.Encoding(name=encoding_name, pat_str=definition["pat_str"],
+                             mergeable_ranks=load_tiktoken_bpe(bpe_path, definition["expected_hash"]),
+                             special_tokens=definition["special_tokens"])
+
+
+
+def _load_counter(model: str):
+    """
+    Creates the token counter for a model. tiktoken is only imported here, so processes
+    which never count tokens do not pay for importing it or loading its BPE files.
+    """
+    if "gemini" in model.lower():
+        return CharacterEstimator(GEMINI_CHARS_PER_TOKEN)
+
+    try:
+        from tiktoken.model import encoding_name_for_model
+
+        try:
+            encoding_name = encoding_name_for_model(model)
+        except KeyError:
+            encoding_name = FALLBACK_ENCODING
+
+        encoding = _load_bundled_encoding(encoding_name)
+        if encoding is None:
+            # Never download the BPE file, the runner may have no network access
+            logger.warning(f"No bundled tiktoken encoding '{encoding_name}' for model '{model}' in "
+                           f"'{BUNDLED_TOKENIZER_DIR}', estimating tokens from characters instead.")
+            return CharacterEstimator(GEMINI_CHARS_PER_TOKEN)
+        return TiktokenCounter(encoding)
+
+    except Exception as e:
+        # tiktoken is not installed, or a bundled file is corrupt, an estimate is better than failing the run
+        logger.warning(f"Could not load a tiktoken encoding for model '{model}', "
+                       f"estimating tokens from characters instead: {e}")
+        return CharacterEstimator(GEMINI_CHARS_PER_TOKEN)
+
+
+
+def get_token_counter(model: str = None):
+    """
+    Returns the (memoized) token counter for a model.
+
+    Parameters:
+    - model (str, optional): The name of the LLM model, defaults to DEFAULT_TOKENIZER_MODEL.
+
+    Returns:
+    - A counter with `count(text)` and `count_many(texts)` methods.
+    """
+    model = model or DEFAULT_TOKENIZER_MODEL
+
+    counter = _counters.get(model)
+    if counter is None:
+        with _counters_lock:
+            counter = _counters.get(model)
+            if counter is None:
+                counter = _counters[model] = _load_counter(model)
+    return counter
+
+
+
+def count_tokens(text: str, model: str = None) -> int:
+    """
+    Counts the number of tokens in the given text, for the given model.
+    """
+    return get_token_counter(model).count(text)
+
+
+
+def count_tokens_many(texts: List[str], model: str = None) -> List[int]:
+    """
+    Counts the number of tokens of several texts in one batch, for the given model.
+    """
+    return get_token_counter(model).count_many(texts)
@@ -1,2 +1,18 @@
 GET_TABLE_DESCRIPTION = "get_table_description.txt"
-GENERATE_RESOURCE_SCHEMA_DESCRIPTIONS = "generate_resource_schema_with_descriptions.txt"
\ No newline at end of file
+GENERATE_RESOURCE_SCHEMA_DESCRIPTIONS = "generate_resource_schema_with_descriptions.txt"
+
+# The compact variant starts with the static instructions, so every chunk shares an
+# identical prefix, and receives the schema in a minimal compact JSON form
+GENERATE_RESOURCE_SCHEMA_DESCRIPTIONS_COMPACT = "generate_resource_schema_descriptions_compact.txt"
+
+# The delta variant asks the LLM for the enrichment attributes keyed by field path only,
+# instead of echoing the complete schema, the attributes are merged into the schema locally
+GENERATE_RESOURCE_SCHEMA_DESCRIPTIONS_DELTA = "generate_resource_schema_descriptions_delta.txt"
+
+# The input variables every prompt template must use, checked when the template is loaded
+PROMPT_INPUT_VARIABLES = {
+    GET_TABLE_DESCRIPTION: ["table_name", "description_length"],
+    GENERATE_RESOURCE_SCHEMA_DESCRIPTIONS: ["input_json_schema", "fhir_resource", "character_length"],
+    GENERATE_RESOURCE_SCHEMA_DESCRIPTIONS_COMPACT: ["input_json_schema", "fhir_resource", "character_length"],
+    GENERATE_RESOURCE_SCHEMA_DESCRIPTIONS_DELTA: ["input_json_schema", "fhir_resource", "character_length"],
+}
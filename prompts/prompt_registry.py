@@ -0,0 +1,149 @@
+import os
+import string
+import hashlib
+import threading
+from langchain_core.prompts import PromptTemplate
+
+from logger_setup import logger
+from prompts import prompt_names
+
+# The directory with the prompt templates, i.e. the directory of this file
+PROMPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class CompiledPrompt:
+    """
+    A prompt template loaded from disk and compiled into a `PromptTemplate`.
+
+    Attributes
+    ----------
+    name : str
+        The filename of the template.
+    text : str
+        The raw text of the template.
+    text_hash : str
+        The SHA-256 hex digest of the text, used in cache keys.
+    template : PromptTemplate
+        The compiled template.
+    mtime : float
+        The modification time of the file the template was loaded from.
+    """
+
+    def __init__(self, name: str, text: str, template: PromptTemplate, mtime: float):
+        self.name = name
+        self.text = text
+        self.text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        self.template = template
+        self.mtime = mtime
+
+    def format(self, **kwargs) -> str:
+        return self.template.format(**kwargs)
+
+
+
+class PromptRegistry:
+    """
+    Loads the prompt templates named in `prompt_names` once, and serves the compiled
+    templates from memory.
+
+    Every `get` only checks the modification time of the file, the template is read
+    and compiled again when the file changed on disk, so prompts can be edited while
+    a batch is running. The registry is shared by all threads and async tasks of the
+    process, see `get_prompt_registry`.
+    """
+
+    def __init__(self, prompts_dir: str = PROMPTS_DIR, input_variables: dict = None):
+        """
+        Parameters
+        ----------
+        prompts_dir : str, optional
+            The directory containing all prompt templates.
+        input_variables : dict, optional
+            The expected input variables, keyed by template name.
+            Defaults to `prompt_names.PROMPT_INPUT_VARIABLES`.
+        """
+        self.prompts_dir = prompts_dir
+        self.input_variables = input_variables if input_variables is not None else prompt_names.PROMPT_INPUT_VARIABLES
+        self._prompts = {}
+        self._lock = threading.Lock()
+
+
+
+    def _compile(self, name: str, mtime: float) -> CompiledPrompt:
+        """
+        Reads a template from disk, and checks it uses exactly the expected input variables.
+        """
+        with open(os.path.join(self.prompts_dir, name), "r", encoding="utf-8") as f:
+            text = f.read()
+
+        used = {field for _, field, _, _ in string.Formatter().parse(text) if field}
+        expected = self.input_variables.get(name)
+        if expected is not None and used != set(expected):
+            raise ValueError(f"Prompt template '{name}' uses the input variables {sorted(used)}, "
+                             f"expected {sorted(expected)}.")
+
+        template = PromptTemplate(input_variables=list(expected or sorted(used)), template=text)
+        logger.info(f"Loaded prompt template '{name}'.")
+        return CompiledPrompt(name, text, template, mtime)
+
+
+
+    def get(self, name: str) -> CompiledPrompt:
+        """
+        Returns the compiled prompt template, reloading it if the file changed.
+
+        Parameters
+        ----------
+        name : str
+            The filename of the template, see `prompt_names`.
+
+        Raises
+        ------
+        FileNotFoundError
+            If the template file does not exist.
+        ValueError
+            If the template does not use the expected input variables.
+        """
+        path = os.path.join(self.prompts_dir, name)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"Template file not found: {path}")
+        mtime = os.stat(path).st_mtime
+
+        prompt = self._prompts.get(name)
+        if prompt is not None and prompt.mtime == mtime:
+            return prompt
+
+        with self._lock:
+            prompt = self._prompts.get(name)
+            if prompt is None or prompt.mtime != mtime:
+                if prompt is not None:
+                    logger.info(f"Prompt template '{name}' changed on disk, reloading it.")
+                prompt = self._prompts[name] = self._compile(name, mtime)
+            return prompt
+
+
+
+    def load_all(self):
+        """
+        Loads every template named in the expected input variables, so a broken
+        template fails the run before any LLM call is made.
+        """
+        for name in self.input_variables:
+            self.get(name)
+
+
+
+# The registry shared by all threads, async tasks and batch runs of this process
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_prompt_registry() -> PromptRegistry:
+    """
+    Returns the process-wide prompt registry, creating it on first use.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = PromptRegistry()
+        return _registry
@@ -1,6 +1,7 @@
 import json
 import tkinter as tk
 from tkinter import ttk, filedialog
+from modules.schema_ir import SchemaIR
 
 class SchemaViewerApp:
     def __init__(self, root):
@@ -56,22 +57,20 @@ class SchemaViewerApp:
             self.populate_tree(schema_data)
 
     def populate_tree(self, schema, parent=""):
-        """ Recursively populates the tree with schema fields. """
+        """ Populates the tree with schema fields, walking the compiled schema. """
         self.tree.delete(*self.tree.get_children())  # Clear existing tree if starting fresh
 
-        def insert_nodes(fields, parent_node):
-            for field in fields:
-                values = (
-                    field.get("type", ""),
-                    field.get("description", ""),
-                    field.get("HIPAA", False),
-                    field.get("PHI/PII", False)
-                )
-                node_id = self.tree.insert(parent_node, "end", text=field["name"], values=values)
-                if "fields" in field and isinstance(field["fields"], list):  # Ensure fields exist and are a list
-                    insert_nodes(field["fields"], node_id)
-
-        insert_nodes(schema, parent)
+        # The nested fields follow their parent, so its tree node always exists
+        node_ids = []
+        for node in SchemaIR.from_fields(schema):
+            values = (
+                node.type,
+                node.description,
+                node.field.get("HIPAA", False),
+                node.field.get("PHI/PII", False)
+            )
+            parent_node = node_ids[node.parent] if node.parent >= 0 else parent
+            node_ids.append(self.tree.insert(parent_node, "end", text=node.name, values=values))
 
     def display_details(self, event):
         selected_item = self.tree.selection()